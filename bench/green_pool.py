@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Concurrency benchmark for nova_limits.GreenConnectionPool.  Runs many
+green threads, each issuing the Redis commands nova_preprocess()
+issues for a request, against a Redis server, first through the
+default redis.ConnectionPool and then through GreenConnectionPool,
+and reports the request rate, the request latency, and the number of
+connections opened.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import eventlet
+import redis
+
+
+def request(db, tenant):
+    """
+    Issue the Redis commands for a single request.
+
+    :param db: The database handle.
+    :param tenant: The ID of the tenant.
+    """
+
+    db.get('limit-class:%s' % tenant)
+
+    bucket_set = 'bucket_set:%s' % tenant
+    pipe = db.pipeline(transaction=False)
+    pipe.zremrangebyscore(bucket_set, 0, time.time())
+    pipe.expire(bucket_set, 86401)
+    pipe.execute()
+
+
+def worker(db, tenant, count, latencies):
+    """
+    Issue requests, recording their latencies.
+
+    :param db: The database handle.
+    :param tenant: The ID of the tenant.
+    :param count: The number of requests to issue.
+    :param latencies: A list to which to append the latencies.
+    """
+
+    for _i in range(count):
+        start = time.time()
+        request(db, tenant)
+        latencies.append(time.time() - start)
+
+
+def run(pool, threads, requests):
+    """
+    Run the benchmark through a connection pool.
+
+    :param pool: The connection pool.
+    :param threads: The number of green threads to run.
+    :param requests: The number of requests for each green thread.
+
+    :returns: A tuple of the elapsed time, the sorted list of
+              latencies, and the number of connections opened.
+    """
+
+    db = redis.StrictRedis(connection_pool=pool)
+    latencies = []
+
+    start = time.time()
+    gpool = eventlet.GreenPool(threads)
+    for i in range(threads):
+        gpool.spawn_n(worker, db, 'bench-%d' % i, requests, latencies)
+    gpool.waitall()
+    elapsed = time.time() - start
+
+    if hasattr(pool, '_created_connections'):
+        connections = pool._created_connections
+    else:
+        connections = len(pool._connections)
+    pool.disconnect()
+
+    return elapsed, sorted(latencies), connections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--host', '-H',
+                        default='localhost',
+                        help="Redis server host.  Defaults to localhost.")
+    parser.add_argument('--port', '-p',
+                        type=int,
+                        default=6379,
+                        help="Redis server port.  Defaults to 6379.")
+    parser.add_argument('--threads', '-t',
+                        type=int,
+                        default=500,
+                        help="Number of concurrent green threads.  "
+                        "Defaults to 500.")
+    parser.add_argument('--requests', '-r',
+                        type=int,
+                        default=20,
+                        help="Number of requests per green thread.  "
+                        "Defaults to 20.")
+    parser.add_argument('--pool-size', '-s',
+                        dest='sizes',
+                        type=int,
+                        action='append',
+                        help="GreenConnectionPool size to measure.  May "
+                        "be given more than once.  Defaults to 5, 10, "
+                        "and 20.")
+    args = parser.parse_args()
+
+    # Set up the environment as Nova does, then find nova_limits
+    eventlet.monkey_patch()
+    sys.path.insert(0, os.path.normpath(os.path.join(
+        os.path.abspath(__file__), os.pardir, os.pardir)))
+    import nova_limits
+
+    pools = [('redis.ConnectionPool',
+              redis.ConnectionPool(host=args.host, port=args.port))]
+    for size in args.sizes or [5, 10, 20]:
+        pools.append(('GreenConnectionPool(%d)' % size,
+                      nova_limits.GreenConnectionPool(
+                          max_connections=size, timeout=None,
+                          host=args.host, port=args.port)))
+
+    print "%-26s %10s %9s %9s %9s %12s" % ('pool', 'req/s', 'p50 ms',
+                                           'p99 ms', 'max ms', 'connections')
+    for desc, pool in pools:
+        try:
+            elapsed, latencies, connections = run(pool, args.threads,
+                                                  args.requests)
+        except redis.ConnectionError as exc:
+            print "%-26s failed: %s" % (desc, exc)
+            continue
+
+        print "%-26s %10.0f %9.2f %9.2f %9.2f %12d" % (
+            desc, len(latencies) / elapsed,
+            latencies[len(latencies) // 2] * 1000.0,
+            latencies[int(len(latencies) * 0.99)] * 1000.0,
+            latencies[-1] * 1000.0, connections)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Startup benchmark for nova_limits.  Measures, in fresh interpreters,
+the time taken to load each of the console scripts and of the
+Turnstile plugin entry points, and reports whether loading them
+pulled in Nova.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+# The objects to load, as (description, entry point) pairs; keep in
+# step with the entry points in setup.py
+TARGETS = [
+    ('limit_class console script', 'nova_limits:limit_class'),
+    ('limit_class_table console script', 'nova_limits:limit_class_table'),
+    ('limit_class_hitters console script',
+     'nova_limits:limit_class_hitters'),
+    ('limit_class_filter console script', 'nova_limits:limit_class_filter'),
+    ('limit_class_server console script', 'nova_limits:limit_class_server'),
+    ('limit_class_usage console script', 'nova_limits:limit_class_usage'),
+    ('limit_class_audit console script', 'nova_limits:limit_class_audit'),
+    ('limit_class_simulate console script',
+     'nova_limits:limit_class_simulate'),
+    ('limit_class_profile console script',
+     'nova_limits:limit_class_profile'),
+    ('turnstile.command', 'nova_limits:profile_command'),
+    ('turnstile.connection_pool', 'nova_limits:GreenConnectionPool'),
+    ('turnstile.middleware', 'nova_limits:NovaTurnstileMiddleware'),
+    ('turnstile.preprocessor', 'nova_limits:nova_preprocess'),
+    ('turnstile.postprocessor', 'nova_limits:nova_postprocess'),
+    ('turnstile.limit', 'nova_limits:NovaClassLimit'),
+    ('turnstile.formatter', 'nova_limits:nova_formatter'),
+]
+
+# The code run in the child interpreter; loads the entry point and
+# reports the elapsed time and whether Nova was imported
+CHILD = """
+import sys
+import time
+start = time.time()
+modname, _sep, attr = sys.argv[1].partition(':')
+getattr(__import__(modname), attr)
+elapsed = time.time() - start
+nova = [m for m in sys.modules if m == 'nova' or m.startswith('nova.')]
+sys.stdout.write('%r %d\\n' % (elapsed, bool(nova)))
+"""
+
+
+def measure(python, target, topdir):
+    """
+    Load an entry point in a fresh interpreter.
+
+    :param python: The Python interpreter to use.
+    :param target: The entry point to load, as "module:attr".
+    :param topdir: The directory containing nova_limits.py.
+
+    :returns: A tuple of the load time, in seconds, and a boolean
+              indicating whether Nova was imported.
+    """
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [topdir] + [p for p in [env.get('PYTHONPATH')] if p])
+    output = subprocess.Popen([python, '-c', CHILD, target], env=env,
+                              stdout=subprocess.PIPE).communicate()[0]
+    elapsed, nova = output.split()
+
+    return float(elapsed), nova == '1'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--repeat', '-r',
+                        type=int,
+                        default=10,
+                        help="Number of fresh interpreters to time for "
+                        "each entry point.  Defaults to 10.")
+    parser.add_argument('--python', '-p',
+                        default=sys.executable,
+                        help="Python interpreter to use.  Defaults to the "
+                        "interpreter running this script.")
+    args = parser.parse_args()
+
+    topdir = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                           os.pardir, os.pardir))
+
+    print "%-36s %9s %9s %9s  %s" % ('entry point', 'min ms', 'median ms',
+                                     'max ms', 'imports nova')
+    for desc, target in TARGETS:
+        times = []
+        nova = False
+        for _i in range(args.repeat):
+            elapsed, imported = measure(args.python, target, topdir)
+            times.append(elapsed * 1000.0)
+            nova = nova or imported
+        times.sort()
+
+        print "%-36s %9.1f %9.1f %9.1f  %s" % (
+            desc, times[0], times[len(times) // 2], times[-1],
+            'yes' if nova else 'no')
+
+
+if __name__ == '__main__':
+    main()
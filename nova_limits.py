@@ -13,13 +13,44 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import array
+import collections
+import contextlib
+import errno
+import fcntl
+import glob
+import hashlib
+import heapq
+import json
+import logging
+import marshal
+import math
+import mmap
+import os
+import re
+import socket
+import SocketServer
+import stat
 import string
+import struct
+import sys
+import tempfile
 import time
+import uuid
+import weakref
 
-from nova.api.openstack import wsgi
+import msgpack
+import redis
+import routes
 from turnstile import config
+from turnstile import database
 from turnstile import limits
+from turnstile import middleware
 from turnstile import tools
+from turnstile import utils
+
+
+LOG = logging.getLogger('nova_limits')
 
 
 class ParamsDict(dict):
@@ -36,286 +67,4950 @@ class ParamsDict(dict):
         return '{%s}' % key
 
 
-def nova_preprocess(midware, environ):
-    """
-    Pre-process requests to nova.  The tenant name is extracted from
-    the nova context, and the applicable rate limit class is looked up
-    in the database.  Both pieces of data are attached to the request
-    environment.  This preprocessor must be present to use the
-    NovaClassLimit rate limiting class.
+def _atomic_write(path, data):
     """
+    Write a file atomically.  The data is written to a temporary file
+    in the same directory, which is then renamed to the final name,
+    so readers see either the old file or the new one.
 
-    # First, figure out the tenant
-    context = environ.get('nova.context')
-    if context:
-        tenant = context.project_id
-    else:
-        # There *should* be a tenant by now, but let's be liberal
-        # in what we accept
-        tenant = '<NONE>'
-    environ['turnstile.nova.tenant'] = tenant
-
-    # Now, figure out the rate limit class
-    klass = midware.db.get('limit-class:%s' % tenant) or 'default'
-    klass = environ.setdefault('turnstile.nova.limitclass', klass)
+    :param path: The name of the file.
+    :param data: The contents of the file.
+    """
 
-    # Set up the nova quota class, if possible
-    if (context and hasattr(context, 'quota_class') and
-            context.quota_class is None):
-        context.quota_class = klass
+    dirname, basename = os.path.split(path)
+    fd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename,
+                                   dir=dirname or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, path)
+    except Exception:
+        with utils.ignore_except():
+            os.unlink(tmpname)
+        raise
 
-    # Tell Turnstile where to store the bucket keys
-    bucket_set = 'bucket_set:%s' % tenant
-    environ['turnstile.bucket_set'] = bucket_set
 
-    # Trim off expired buckets...
-    midware.db.zremrangebyscore(bucket_set, 0, time.time())
+# Stands in for a bucket which has fully drained, as indicated by its
+# expiration time in the bucket set.  Such buckets need not be loaded.
+DrainedBucket = collections.namedtuple('DrainedBucket', ['messages', 'expire'])
 
 
-def nova_postprocess(midware, environ):
+class ClassTable(object):
     """
-    Post-process requests to nova.  This processes all the buckets
-    associated with the rate limit class and inserts a nova-compatible
-    representation into the environment.  This allows the nova /limits
-    endpoint to report the rate limits and current usage.
+    A read-only table mapping tenants to rate-limit classes, stored in
+    a file which may be memory-mapped by every worker process on a
+    host.  The file is never modified in place; a refresher writes a
+    complete new table and renames it over the old one, so readers
+    need no locks.  They simply notice that the file has changed and
+    map the new one.
+
+    The file consists of a header, an array of entries sorted by a
+    hash of the tenant ID, and a string pool.  Each entry gives the
+    offset and length of a "<tenant>\\0<class>" record in the pool.
+    Tenants in the "default" class are not stored.
     """
 
-    # Get some handy information from the environment
-    klass = environ['turnstile.nova.limitclass']
-    bucket_set = environ['turnstile.bucket_set']
+    magic = 'NLCLSTB1'
+    header = struct.Struct('<8sdI')
+    entry = struct.Struct('<QII')
 
-    # We may need a formatter later on, so set one up
-    fmt = string.Formatter()
+    def __init__(self, path, max_age=None, recheck=1.0):
+        """
+        Initialize a ClassTable.
 
-    # Grab a list of the available buckets and index them by UUID
-    buckets = {}
-    for key in midware.db.zrange(bucket_set, 0, -1):
-        decoded_key = limits.BucketKey.decode(key)
+        :param path: The name of the class table file.
+        :param max_age: If provided, the maximum age, in seconds, of
+                        the table.  A table older than this is
+                        considered stale, and lookups will return
+                        None.
+        :param recheck: The interval, in seconds, between checks for
+                        a new version of the table file.
+        """
 
-        # Store the bucket key in the dictionary
-        buckets.setdefault(decoded_key.uuid, [])
-        buckets[decoded_key.uuid].append(decoded_key)
+        self.path = path
+        self.max_age = max_age
+        self.recheck = recheck
 
-    # Finally, translate Turnstile limits into Nova limits, so we can
-    # use Nova's /limits endpoint
-    lims = []
-    for turns_lim in midware.limits:
-        # If the limit has a rate_class, ensure it equals the
-        # appropriate one for the user.  If the limit does not have a
-        # rate_class, we want to include it in the final list.
-        if getattr(turns_lim, 'rate_class', klass) != klass:
-            continue
+        self._map = None
+        self._ident = None
+        self._generated = None
+        self._count = 0
+        self._next_check = 0
 
-        # Load up any available buckets
-        buck_list = []
-        for key in buckets.get(turns_lim.uuid, []):
-            # Load the bucket and save it
-            buck_list.append((ParamsDict(key.params), turns_lim.load(key)))
-
-        # Account for queries for the uri...
-        uri = turns_lim.uri
-        if turns_lim.queries:
-            uri = ('%s?%s' % (uri,
-                              '&'.join('%s={%s}' % (qstr, qstr) for qstr in
-                                       sorted(turns_lim.queries))))
-
-        # Translate some information squirreled away in the limit
-        verbs = turns_lim.verbs or ['GET', 'HEAD', 'POST', 'PUT', 'DELETE']
-        unit = turns_lim.unit.upper()
-        if unit.isdigit():
-            unit = 'UNKNOWN'
+    @staticmethod
+    def _hash(tenant):
+        """
+        Compute the hash of a tenant ID.  Returns a tuple of the hash
+        value and the tenant ID as a byte string.
+        """
 
-        # Figure out remaining and resetTime
-        if buck_list:
-            remaining = min(bucket.messages for _params, bucket in buck_list)
-            resetTime = max(bucket.expire for _params, bucket in buck_list)
-        else:
-            remaining = turns_lim.value
-            resetTime = time.time()
+        if isinstance(tenant, unicode):
+            tenant = tenant.encode('utf-8')
 
-        # Now, build a representation of the limit
-        for verb in verbs:
-            if len(buck_list) > 1:
-                # Generate one entry for each bucket
-                for params, bucket in buck_list:
-                    # Substitute (some of) the values in params to
-                    # make the URI more specific
-                    buck_uri = fmt.vformat(uri, (), params)
-                    lims.append(dict(
-                        verb=verb,
-                        URI=buck_uri,
-                        regex=buck_uri,
-                        value=turns_lim.value,
-                        unit=unit,
-                        remaining=bucket.messages,
-                        resetTime=bucket.expire,
-                    ))
+        return struct.unpack('<Q', hashlib.md5(tenant).digest()[:8])[0], tenant
 
-            lims.append(dict(
-                verb=verb,
-                URI=uri,
-                regex=uri,
-                value=turns_lim.value,
-                unit=unit,
+    def _refresh(self, now):
+        """
+        Check whether the table file has been replaced, and map the
+        new table if it has.
 
-                # These values are computed from the buckets...
-                remaining=remaining,
-                resetTime=resetTime,
-            ))
+        :param now: The current time.
+        """
 
-    # Save the limits for Nova to use
-    environ['nova.limits'] = lims
+        self._next_check = now + self.recheck
 
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # Table is gone
+            self._map = None
+            self._ident = None
+            return
 
-class NovaClassLimit(limits.Limit):
-    """
-    Rate limiting class for applying rate limits to classes of Nova
-    tenants.  The nova_limits:nova_preprocess preprocessor must be
-    configured for this limit class to match.
-    """
+        # Has it changed?
+        ident = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+        if ident == self._ident:
+            return
 
-    attrs = dict(
-        rate_class=dict(
-            desc=('The rate limiting class this limit applies to.  Required.'),
-            type=str,
-        ),
-    )
+        try:
+            with open(self.path, 'rb') as f:
+                table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, generated, count = self.header.unpack_from(table, 0)
+        except (EnvironmentError, ValueError, struct.error):
+            magic = None
 
-    def route(self, uri, route_args):
+        # Make sure it's actually a class table
+        if magic != self.magic:
+            self._map = None
+            self._ident = None
+            return
+
+        self._map = table
+        self._ident = ident
+        self._generated = generated
+        self._count = count
+
+    def lookup(self, tenant, now=None):
         """
-        Filter version identifiers off of the URI.
+        Look up the rate-limit class for a tenant.
+
+        :param tenant: The ID of the tenant.
+        :param now: The current time.  Optional.
+
+        :returns: The name of the rate-limit class, or None if the
+                  table is unavailable or stale.
         """
 
-        if uri.startswith('/v1.1/'):
-            return uri[5:]
-        elif uri.startswith('/v2/'):
-            return uri[3:]
+        if now is None:
+            now = time.time()
 
-        return uri
+        # See if there's a new table
+        if now >= self._next_check:
+            self._refresh(now)
 
-    def filter(self, environ, params, unused):
+        # Make sure we have a current table
+        table = self._map
+        if table is None or (self.max_age and
+                             now - self._generated > self.max_age):
+            return None
+
+        # Binary search for the first entry with the hash
+        hashval, tenant = self._hash(tenant)
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self.header.size + mid * self.entry.size
+            if self.entry.unpack_from(table, offset)[0] < hashval:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # Now walk all the entries with that hash
+        for idx in xrange(lo, self._count):
+            offset = self.header.size + idx * self.entry.size
+            entry_hash, rec_offset, rec_len = self.entry.unpack_from(
+                table, offset)
+            if entry_hash != hashval:
+                break
+
+            rec_tenant, _sep, klass = \
+                table[rec_offset:rec_offset + rec_len].partition('\0')
+            if rec_tenant == tenant:
+                return klass
+
+        return 'default'
+
+    @classmethod
+    def write(cls, path, mapping, now=None):
         """
-        Determines whether this limit applies to this request and
-        attaches the tenant name to the params.
+        Write a new class table file.  The table is written to a
+        temporary file, which is then atomically renamed to the
+        final name.
+
+        :param path: The name of the class table file.
+        :param mapping: A dictionary mapping tenant IDs to rate-limit
+                        class names.
+        :param now: The generation time to record in the table.
+                    Optional.
+
+        :returns: The number of tenants in the table.
         """
 
-        # Do we match?
-        if ('turnstile.nova.tenant' not in environ or
-                'turnstile.nova.limitclass' not in environ or
-                self.rate_class != environ['turnstile.nova.limitclass']):
-            raise limits.DeferLimit()
+        if now is None:
+            now = time.time()
 
-        # OK, add the tenant to the params
-        params['tenant'] = environ['turnstile.nova.tenant']
+        # Build the entries and the string pool
+        records = []
+        for tenant, klass in mapping.items():
+            if not klass or klass == 'default':
+                continue
+            hashval, tenant = cls._hash(tenant)
+            if isinstance(klass, unicode):
+                klass = klass.encode('utf-8')
+            records.append((hashval, '%s\0%s' % (tenant, klass)))
+        records.sort(key=lambda x: x[0])
 
+        entries = []
+        offset = cls.header.size + len(records) * cls.entry.size
+        for hashval, rec in records:
+            entries.append(cls.entry.pack(hashval, offset, len(rec)))
+            offset += len(rec)
 
-def nova_formatter(status, delay, limit, bucket, environ, start_response):
+        # Write the table and move it into place
+        _atomic_write(path, ''.join(
+            [cls.header.pack(cls.magic, now, len(records))] + entries +
+            [rec for _hashval, rec in records]))
+
+        return len(records)
+
+
+class ExpiringCache(collections.OrderedDict):
     """
-    Formats the over-limit response for the request.  This variant
-    utilizes Nova's OverLimitFault for consistency with Nova's
-    rate-limiting.
+    A bounded cache of values with expiration times.  When the cache
+    is full, the oldest entries are evicted first.  Entries are
+    stored as tuples of the value and the expiration time.
     """
 
-    # Build the error message based on the limit's values
-    args = dict(
-        value=limit.value,
-        verb=environ['REQUEST_METHOD'],
-        uri=limit.uri,
-        unit_string=limit.unit.upper(),
-    )
-    error = _("Only %(value)s %(verb)s request(s) can be "
-              "made to %(uri)s every %(unit_string)s.") % args
+    def __init__(self, size):
+        """
+        Initialize an ExpiringCache.
 
-    # Set up the rest of the arguments for wsgi.OverLimitFault
-    msg = _("This request was rate-limited.")
-    retry = time.time() + delay
+        :param size: The maximum number of entries in the cache.
+        """
 
-    # Convert to a fault class
-    fault = wsgi.OverLimitFault(msg, error, retry)
+        super(ExpiringCache, self).__init__()
+        self.size = size
 
-    # Now let's call it and return the result
-    return fault(environ, start_response)
+    def lookup(self, key, now):
+        """
+        Look up a value in the cache.
 
+        :param key: The key to look up.
+        :param now: The current time.
 
-def _report_limit_class(args, result):
+        :returns: The cached value, or None if it is not cached or
+                  has expired.
+        """
+
+        cached = self.get(key)
+        if cached is None or cached[1] <= now:
+            return None
+
+        return cached[0]
+
+    def store(self, key, value, expires):
+        """
+        Store a value in the cache.
+
+        :param key: The key to store the value under.
+        :param value: The value to store.
+        :param expires: The time at which the value expires.
+        """
+
+        # Evict the oldest entries if we've run out of room
+        self.pop(key, None)
+        while self and len(self) >= self.size:
+            self.popitem(last=False)
+
+        self[key] = (value, expires)
+
+
+def _hash_indexes(key, count, size):
     """
-    Report the rate-limit class for the tenant.  This is a
-    postprocessor for the limit_class() function, when being called in
-    console script mode.
+    Compute several independent indexes for a key, for use by
+    probabilistic data structures such as count-min sketches and
+    Bloom filters.
 
-    :param args: A Namespace object containing a 'tenant_id' attribute
-                 and a desired rate-limit class in the 'klass'
-                 attribute (which should be None if no change was
-                 requested).
-    :param result: The result of the limit_class() function call.
-                   This will be the previously configured rate-limit
-                   class for the tenant.
+    :param key: The key.
+    :param count: The number of indexes to compute.
+    :param size: The indexes will be less than this value.
 
-    :returns: None to indicate success.
+    :returns: A list of the indexes.
     """
 
-    print "Tenant %s:" % args.tenant_id
-    if args.klass:
-        print "  Previous rate-limit class: %s" % result
-        print "  New rate-limit class: %s" % args.klass
-    else:
-        print "  Configured rate-limit class: %s" % result
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
 
-    return None
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+    return [(h1 + i * h2) % size for i in range(count)]
 
 
-@tools.add_argument('conf_file',
-                    metavar='config',
-                    help="Name of the configuration file, for connecting "
-                    "to the Redis database.")
-@tools.add_argument('tenant_id',
-                    help="ID of the tenant.")
-@tools.add_argument('--debug', '-d',
-                    dest='debug',
-                    action='store_true',
-                    default=False,
-                    help="Run the tool in debug mode.")
-@tools.add_argument('--class', '-c',
-                    dest='klass',
-                    action='store',
-                    default=None,
-                    help="If specified, sets the class associated with "
-                    "the given tenant ID.")
-@tools.add_postprocessor(_report_limit_class)
-def limit_class(conf_file, tenant, klass=None):
+class ClassFilter(object):
+    """
+    A Bloom filter of the tenants with a rate-limit class other than
+    "default".  The filter is stored in the database as a bitmap,
+    using the same bit numbering as the Redis SETBIT command, so that
+    tenants may be added to it in place.  If a tenant is not in the
+    filter, there is no need to look up its rate-limit class.
     """
-    Set up or query limit classes associated with tenants.
 
-    :param conf_file: Name of the configuration file, for connecting
-                      to the Redis database.
-    :param tenant: The ID of the tenant.
-    :param klass: If provided, the name of the class to map the tenant
-                  to.
+    # The database key for the bitmap
+    key = 'limit-class-filter'
 
-    Returns the class associated with the given tenant.
-    """
+    # The number of bits set for each tenant
+    hashes = 4
 
-    # Connect to the database...
-    conf = config.Config(conf_file=conf_file)
-    db = conf.get_database()
+    def __init__(self, bits):
+        """
+        Initialize a ClassFilter.
 
-    # Get the key for the limit class...
-    key = 'limit-class:%s' % tenant
+        :param bits: The contents of the bitmap.
+        """
 
-    # Now, look up the tenant's current class
-    old_klass = db.get(key) or 'default'
+        self.bits = bytearray(bits)
 
-    # Do we need to change it?
-    if klass and klass != old_klass:
-        if klass == 'default':
-            # Resetting to the default
-            db.delete(key)
+    def __contains__(self, tenant):
+        """
+        Determine whether a tenant may be in the filter.
+
+        :param tenant: The ID of the tenant.
+
+        :returns: False if the tenant is definitely not in the filter,
+                  True if it may be.
+        """
+
+        return all(self.bits[idx >> 3] & (0x80 >> (idx & 7))
+                   for idx in self._indexes(len(self.bits), tenant))
+
+    @classmethod
+    def _indexes(cls, size, tenant):
+        """
+        Compute the indexes of the bits for a tenant.
+
+        :param size: The size of the bitmap, in bytes.
+        :param tenant: The ID of the tenant.
+        """
+
+        return _hash_indexes(tenant, cls.hashes, size * 8)
+
+    def add(self, tenant):
+        """
+        Add a tenant to the filter.
+
+        :param tenant: The ID of the tenant.
+        """
+
+        for idx in self._indexes(len(self.bits), tenant):
+            self.bits[idx >> 3] |= 0x80 >> (idx & 7)
+
+    @classmethod
+    def load(cls, db):
+        """
+        Load the filter from the database.
+
+        :param db: The database handle.
+
+        :returns: An instance of ClassFilter, or None if the filter
+                  has not been built.
+        """
+
+        bits = db.get(cls.key)
+        return cls(bits) if bits else None
+
+    def save(self, db):
+        """
+        Save the filter to the database, replacing any existing
+        filter.  The filter is written under a temporary key and then
+        renamed into place, so that the existing filter is replaced
+        atomically.
+
+        :param db: The database handle.
+        """
+
+        tmp_key = '%s:%d' % (self.key, os.getpid())
+        db.set(tmp_key, str(self.bits))
+        db.rename(tmp_key, self.key)
+
+    @classmethod
+    def update(cls, db, *tenants):
+        """
+        Add tenants to the filter in the database.  Does nothing if
+        the filter has not been built.
+
+        :param db: The database handle.
+
+        Remaining positional arguments are the IDs of the tenants.
+        """
+
+        size = db.strlen(cls.key)
+        if not size or not tenants:
+            return
+
+        pipe = db.pipeline(transaction=False)
+        for tenant in tenants:
+            for idx in cls._indexes(size, tenant):
+                pipe.setbit(cls.key, idx, 1)
+        pipe.execute()
+
+
+class CountMinSketch(object):
+    """
+    A count-min sketch.  This is a fixed-size table of counters,
+    "depth" rows of "width" counters each, from which the count
+    associated with any key may be estimated.  Estimates are never
+    too low, and with high probability are too high by no more than a
+    small fraction of the total count.
+    """
+
+    def __init__(self, width=2048, depth=4, rows=None):
+        """
+        Initialize a CountMinSketch.
+
+        :param width: The number of counters in each row.
+        :param depth: The number of rows.
+        :param rows: If provided, a list of lists of counters, such
+                     as generated by the "rows" attribute, used to
+                     initialize the sketch.
+        """
+
+        self.width = width
+        self.depth = depth
+        if rows:
+            self.rows = [array.array('L', row) for row in rows]
         else:
-            # Changing to a new value
-            db.set(key, klass)
+            self.rows = [array.array('L', [0]) * width
+                         for _i in range(depth)]
 
-    return old_klass
+    def _indexes(self, key):
+        """
+        Compute the index of the counter for the key in each row.
+        """
+
+        return _hash_indexes(key, self.depth, self.width)
+
+    def add(self, key, count=1):
+        """
+        Add to the count for a key.
+
+        :param key: The key.
+        :param count: The amount to add to the count.
+
+        :returns: The new estimated count for the key.
+        """
+
+        estimate = None
+        for row, idx in zip(self.rows, self._indexes(key)):
+            row[idx] += count
+            if estimate is None or row[idx] < estimate:
+                estimate = row[idx]
+
+        return estimate
+
+    def estimate(self, key):
+        """
+        Estimate the count for a key.
+
+        :param key: The key.
+
+        :returns: The estimated count for the key.
+        """
+
+        return min(row[idx] for row, idx in zip(self.rows,
+                                                self._indexes(key)))
+
+    def merge(self, other):
+        """
+        Merge the counts from another sketch into this one.  The
+        sketches must have the same dimensions.
+
+        :param other: The other CountMinSketch.
+        """
+
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Cannot merge a %dx%d sketch into a %dx%d "
+                             "sketch" % (other.width, other.depth,
+                                         self.width, self.depth))
+
+        for row, other_row in zip(self.rows, other.rows):
+            for idx, count in enumerate(other_row):
+                row[idx] += count
+
+
+class TopK(object):
+    """
+    Tracks the keys with the highest counts, using a count-min sketch
+    to estimate the counts and a heap to track the top keys.  Memory
+    use is fixed, regardless of the number of distinct keys.
+    """
+
+    def __init__(self, top=20, width=2048, depth=4, sketch=None):
+        """
+        Initialize a TopK.
+
+        :param top: The number of top keys to track.
+        :param width: The width of the count-min sketch.
+        :param depth: The depth of the count-min sketch.
+        :param sketch: If provided, the CountMinSketch to use.
+        """
+
+        self.top = top
+        self.sketch = sketch or CountMinSketch(width, depth)
+        self.candidates = {}
+        self._heap = []
+
+    def _evict(self):
+        """
+        Evict the key with the lowest count from the candidates.
+        """
+
+        while self._heap:
+            count, key = heapq.heappop(self._heap)
+
+            # Skip stale heap entries
+            if self.candidates.get(key) == count:
+                del self.candidates[key]
+                return
+
+    def _floor(self):
+        """
+        Retrieve the lowest count among the candidates.
+        """
+
+        while self._heap:
+            count, key = self._heap[0]
+            if self.candidates.get(key) == count:
+                return count
+
+            # Discard stale heap entries
+            heapq.heappop(self._heap)
+
+        return 0
+
+    def add(self, key, count=1):
+        """
+        Add to the count for a key.
+
+        :param key: The key.
+        :param count: The amount to add to the count.
+        """
+
+        estimate = self.sketch.add(key, count)
+
+        # Only interested in keys that make the cut
+        if key not in self.candidates and len(self.candidates) >= self.top:
+            if estimate <= self._floor():
+                return
+            self._evict()
+
+        self.candidates[key] = estimate
+        heapq.heappush(self._heap, (estimate, key))
+
+        # Keep the heap from growing without bound
+        if len(self._heap) > 4 * self.top:
+            self._heap = [(c, k) for k, c in self.candidates.items()]
+            heapq.heapify(self._heap)
+
+    def items(self):
+        """
+        Retrieve the top keys.
+
+        :returns: A list of tuples of the key and its estimated
+                  count, in order of decreasing count.
+        """
+
+        return sorted(self.candidates.items(), key=lambda x: (-x[1], x[0]))
+
+    def dehydrate(self):
+        """
+        Return a dict representing this TopK.
+        """
+
+        return dict(
+            top=self.top,
+            width=self.sketch.width,
+            depth=self.sketch.depth,
+            rows=[row.tolist() for row in self.sketch.rows],
+            candidates=self.candidates.keys(),
+        )
+
+    @classmethod
+    def hydrate(cls, data):
+        """
+        Given a dict, as generated by dehydrate(), generate an
+        appropriate instance of TopK.
+        """
+
+        topk = cls(data['top'], sketch=CountMinSketch(
+            data['width'], data['depth'], data['rows']))
+        for key in data['candidates']:
+            topk.candidates[key] = topk.sketch.estimate(key)
+        topk._heap = [(c, k) for k, c in topk.candidates.items()]
+        heapq.heapify(topk._heap)
+
+        return topk
+
+    def merge(self, other):
+        """
+        Merge the counts from another TopK into this one.
+
+        :param other: The other TopK.
+        """
+
+        self.sketch.merge(other.sketch)
+
+        # Re-estimate all the candidates and keep the top ones
+        keys = set(self.candidates) | set(other.candidates)
+        counts = sorted(((self.sketch.estimate(k), k) for k in keys),
+                        reverse=True)[:self.top]
+        self.candidates = dict((k, c) for c, k in counts)
+        self._heap = counts
+        heapq.heapify(self._heap)
+
+
+class HeavyHitters(object):
+    """
+    Counts requests and rejections per tenant and per rate-limit
+    class, in fixed memory, for a single worker.  The counts are
+    periodically dumped, as JSON, to a file in a directory or to a
+    local (Unix domain) socket, and then reset; the limit_class_hitters
+    command merges the dumps from all the workers.
+    """
+
+    def __init__(self, dump=None, interval=60.0, top=20, width=2048,
+                 depth=4, timeout=1.0, now=None):
+        """
+        Initialize a HeavyHitters.
+
+        :param dump: The directory to dump the counts to, or the name
+                     of a Unix domain socket, prefixed with "unix:".
+                     If not given, the counts are not dumped.
+        :param interval: The interval, in seconds, between dumps.
+        :param top: The number of top tenants to track.
+        :param width: The width of the count-min sketches.
+        :param depth: The depth of the count-min sketches.
+        :param timeout: The timeout, in seconds, for sending the
+                        counts to a Unix domain socket.  The request
+                        which triggers the dump waits for it, so it
+                        should be short.
+        :param now: The current time.  Optional.
+        """
+
+        self.dump_to = dump
+        self.interval = interval
+        self.top = top
+        self.width = width
+        self.depth = depth
+        self.timeout = timeout
+        self.reset(time.time() if now is None else now)
+
+    def reset(self, now):
+        """
+        Reset the counts.
+
+        :param now: The current time.
+        """
+
+        self.start = now
+        self.next_dump = now + self.interval
+        self.requests = TopK(self.top, self.width, self.depth)
+        self.rejections = TopK(self.top, self.width, self.depth)
+        self.classes = {}
+
+    def request(self, tenant, klass, now):
+        """
+        Count a request.  If it's time, the counts are dumped.
+
+        :param tenant: The ID of the tenant.
+        :param klass: The name of the rate-limit class.
+        :param now: The current time.
+        """
+
+        if now >= self.next_dump:
+            self.dump(now)
+
+        self.requests.add(tenant)
+        self.classes.setdefault(klass, [0, 0])[0] += 1
+
+    def reject(self, tenant, klass):
+        """
+        Count a rejected request.
+
+        :param tenant: The ID of the tenant.
+        :param klass: The name of the rate-limit class.
+        """
+
+        self.rejections.add(tenant)
+        self.classes.setdefault(klass, [0, 0])[1] += 1
+
+    def dehydrate(self, now):
+        """
+        Return a dict representing the counts.
+
+        :param now: The current time.
+        """
+
+        return dict(
+            pid=os.getpid(),
+            host=socket.gethostname(),
+            start=self.start,
+            end=now,
+            requests=self.requests.dehydrate(),
+            rejections=self.rejections.dehydrate(),
+            classes=self.classes,
+        )
+
+    def dump(self, now):
+        """
+        Dump the counts and reset them.  Errors are logged, but
+        otherwise ignored; if the counts cannot be sent to a Unix
+        domain socket within the timeout, they are dropped.
+
+        :param now: The current time.
+        """
+
+        if self.dump_to:
+            data = json.dumps(self.dehydrate(now))
+            try:
+                if self.dump_to.startswith('unix:'):
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.settimeout(self.timeout)
+                    try:
+                        sock.connect(self.dump_to[5:])
+                        sock.sendall(data + '\n')
+                    finally:
+                        sock.close()
+                else:
+                    _atomic_write(os.path.join(
+                        self.dump_to, 'hitters.%d.json' % os.getpid()), data)
+            except (socket.error, socket.timeout):
+                LOG.exception("Failed to send heavy hitters to %s; "
+                              "dropping the dump" % self.dump_to)
+            except Exception:
+                LOG.exception("Failed to dump heavy hitters to %s" %
+                              self.dump_to)
+
+        self.reset(now)
+
+
+class GreenConnectionPool(redis.BlockingConnectionPool):
+    """
+    A Redis connection pool for use under eventlet.  At most
+    max_connections connections are opened, and they are reused, most
+    recently used first; a green thread needing a connection when all
+    are in use yields to the other green threads until one is
+    released, rather than opening yet another connection.  To use
+    this pool, set "redis.connection_pool" to "nova_limits" in the
+    Turnstile configuration.
+
+    If eventlet is not available, this behaves like
+    redis.BlockingConnectionPool.  Note that the socket module must
+    be monkey-patched by eventlet for the connections themselves not
+    to block other green threads; Nova does this.
+    """
+
+    def __init__(self, max_connections=10, timeout=20, **kwargs):
+        """
+        Initialize a GreenConnectionPool.
+
+        :param max_connections: The maximum number of connections to
+                                open.
+        :param timeout: The number of seconds to wait for a
+                        connection to be released, or "none" to wait
+                        forever.  Defaults to 20.
+
+        Remaining keyword arguments are passed to the connection
+        class.
+        """
+
+        # Only import eventlet if we're actually going to use it
+        try:
+            from eventlet import queue
+        except ImportError:
+            import Queue as queue
+
+        # Options from the configuration file are strings
+        if isinstance(timeout, basestring):
+            timeout = None if timeout.lower() == 'none' else float(timeout)
+
+        super(GreenConnectionPool, self).__init__(
+            max_connections=int(max_connections), timeout=timeout,
+            queue_class=queue.LifoQueue, **kwargs)
+
+
+class InFlightLimit(object):
+    """
+    Describes an in-flight (concurrency) limit which caused a request
+    to be rejected.  Passed to the formatter in place of a
+    turnstile.limits.Limit; nova_formatter() recognizes it and
+    reports the concurrency limit rather than a rate limit.
+    """
+
+    def __init__(self, db, scope, name, value):
+        """
+        Initialize an InFlightLimit.
+
+        :param db: The database handle.
+        :param scope: The scope of the limit; "tenant" or "class".
+        :param name: The ID of the tenant or the name of the
+                     rate-limit class.
+        :param value: The maximum number of requests in flight.
+        """
+
+        self.db = db
+        self.scope = scope
+        self.name = name
+        self.value = value
+
+    def format(self, status, headers, environ, bucket, delay):
+        """
+        Formats a response entity, for when nova_formatter() is not
+        the configured formatter.  Returns a tuple of the status code
+        and the formatted entity.
+        """
+
+        headers['Content-Type'] = 'text/plain'
+        return status, ("Only %d request(s) can be in progress at once "
+                        "for this %s." % (self.value, self.scope))
+
+
+class InFlight(object):
+    """
+    Tracks the number of requests in flight for each tenant and each
+    rate-limit class, and enforces limits on them.  By default, the
+    counts are local to the worker; if shared, they are kept in the
+    database, under the keys "inflight:<tenant>" and
+    "inflight-class:<class>", so the limits apply across all workers.
+    Each shared key is a sorted set with one member for each request
+    in flight, scored by the time at which it is presumed to have
+    been leaked by a worker which died.
+    """
+
+    def __init__(self, tenant_limits=None, class_limits=None, shared=False,
+                 ttl=300, retry=1.0):
+        """
+        Initialize an InFlight.
+
+        :param tenant_limits: A dictionary mapping the name of a
+                              rate-limit class to the maximum number
+                              of requests each tenant in that class
+                              may have in flight.
+        :param class_limits: A dictionary mapping the name of a
+                             rate-limit class to the maximum number
+                             of requests all tenants in that class may
+                             have in flight.
+        :param shared: If True, the counts are kept in the database.
+        :param ttl: The time, in seconds, after which a request is
+                    no longer counted in the shared counts, so that
+                    requests leaked by a worker which dies are
+                    discarded.
+        :param retry: The number of seconds after which a rejected
+                      request may be retried.
+        """
+
+        self.tenant_limits = tenant_limits or {}
+        self.class_limits = class_limits or {}
+        self.shared = shared
+        self.ttl = ttl
+        self.retry = retry
+        self.counts = {}
+
+    @staticmethod
+    def parse(value):
+        """
+        Parse a list of limits, of the form "<class>:<limit>",
+        separated by whitespace or commas.
+
+        :param value: The list of limits.
+
+        :returns: A dictionary mapping class names to limits.
+        """
+
+        result = {}
+        for item in value.replace(',', ' ').split():
+            klass, _sep, limit = item.partition(':')
+            result[klass] = int(limit)
+
+        return result
+
+    def _keys(self, tenant, klass):
+        """
+        Determine the counts applicable to a request.
+
+        :param tenant: The ID of the tenant.
+        :param klass: The name of the rate-limit class.
+
+        :returns: A list of tuples of the key, the limit, the scope,
+                  and the tenant ID or class name.
+        """
+
+        keys = []
+        if klass in self.tenant_limits:
+            keys.append(('inflight:%s' % tenant, self.tenant_limits[klass],
+                         'tenant', tenant))
+        if klass in self.class_limits:
+            keys.append(('inflight-class:%s' % klass,
+                         self.class_limits[klass], 'class', klass))
+
+        return keys
+
+    def acquire(self, db, tenant, klass):
+        """
+        Count a request as in flight, if doing so does not exceed the
+        limits.  If the shared counts cannot be updated, the local
+        counts are used instead.
+
+        :param db: The database handle.
+        :param tenant: The ID of the tenant.
+        :param klass: The name of the rate-limit class.
+
+        :returns: A tuple of a callable which must be called when the
+                  request is no longer in flight, and None; or, if
+                  the request is rejected, None and an InFlightLimit
+                  describing the exceeded limit.
+        """
+
+        keys = self._keys(tenant, klass)
+        if not keys:
+            return (lambda: None), None
+
+        if self.shared:
+            try:
+                return self._acquire_shared(db, keys)
+            except Exception:
+                LOG.exception("Failed to update shared in-flight counts")
+
+        # Check the local counts before incrementing any of them
+        for key, limit, scope, name in keys:
+            if self.counts.get(key, 0) >= limit:
+                return None, InFlightLimit(db, scope, name, limit)
+
+        for key, _limit, _scope, _name in keys:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+        def release():
+            for key, _limit, _scope, _name in keys:
+                self.counts[key] -= 1
+                if self.counts[key] <= 0:
+                    del self.counts[key]
+
+        return release, None
+
+    def _acquire_shared(self, db, keys):
+        """
+        Count a request as in flight in the database.  See acquire().
+
+        :param db: The database handle.
+        :param keys: The counts applicable to the request, as returned
+                     by _keys().
+        """
+
+        # Discard the requests whose deadlines have passed, add this
+        # one, and count them, in one round trip
+        member = str(uuid.uuid4())
+        now = time.time()
+        pipe = db.pipeline(transaction=False)
+        for key, _limit, _scope, _name in keys:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, now + self.ttl, member)
+            pipe.zcard(key)
+            pipe.expire(key, self.ttl)
+        counts = pipe.execute()[2::4]
+
+        def release():
+            pipe = db.pipeline(transaction=False)
+            for key, _limit, _scope, _name in keys:
+                pipe.zrem(key, member)
+            try:
+                pipe.execute()
+            except Exception:
+                LOG.exception("Failed to update shared in-flight counts")
+
+        for count, (key, limit, scope, name) in zip(counts, keys):
+            if count > limit:
+                release()
+                return None, InFlightLimit(db, scope, name, limit)
+
+        return release, None
+
+
+class _InFlightBody(object):
+    """
+    Wraps the iterable returned by an application, so that the request
+    is counted as in flight until the response body has been sent.
+    """
+
+    def __init__(self, app_iter, release):
+        """
+        Initialize an _InFlightBody.
+
+        :param app_iter: The iterable returned by the application.
+        :param release: A callable to call when the iterable is
+                        closed.
+        """
+
+        self.app_iter = app_iter
+        self.release = release
+
+    def __iter__(self):
+        """
+        Iterate over the response body.
+        """
+
+        return iter(self.app_iter)
+
+    def close(self):
+        """
+        Close the iterable returned by the application, and release
+        the request's in-flight counts.
+        """
+
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if self.release:
+                self.release()
+                self.release = None
+
+
+class AdaptiveLimits(object):
+    """
+    Scales the limits of each rate-limit class according to the
+    latency of the requests made by its tenants, using additive
+    increase, multiplicative decrease (AIMD).  Each worker measures
+    the latency of its requests and periodically adds the totals for
+    each interval in which requests completed to the database; once
+    per interval, one worker compares the mean latency of each class
+    during the previous interval to the target, and adjusts the
+    class's multiplier.  The adjustment waits until one flush interval
+    into the next interval, so that the workers have added their
+    totals for the previous interval; the totals of a worker which
+    handles no requests in that time are left out.  The multipliers
+    are kept in the database, in the hash "limit-multipliers", and
+    each worker reloads them whenever it adds its totals.
+    """
+
+    key = 'limit-multipliers'
+
+    def __init__(self, target, interval=30.0, increase=0.05, decrease=0.5,
+                 minimum=0.1, maximum=2.0, min_requests=10, flush=1.0):
+        """
+        Initialize an AdaptiveLimits.
+
+        :param target: The target mean latency, in seconds.
+        :param interval: The interval, in seconds, between
+                         adjustments of the multipliers.
+        :param increase: The amount added to the multiplier of a
+                         class whose mean latency is within the
+                         target.
+        :param decrease: The factor by which the multiplier of a class
+                         whose mean latency exceeds the target is
+                         multiplied.
+        :param minimum: The minimum multiplier.
+        :param maximum: The maximum multiplier.
+        :param min_requests: The minimum number of requests during an
+                             interval for a class's multiplier to be
+                             adjusted.
+        :param flush: The interval, in seconds, between additions of
+                      the worker's totals to the database.
+        """
+
+        self.target = target
+        self.interval = interval
+        self.increase = increase
+        self.decrease = decrease
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_requests = min_requests
+        self.flush = flush
+
+        self.multipliers = {}
+        self.latency = {}
+        self.next_flush = None
+        self.window = None
+
+    def multiplier(self, klass):
+        """
+        Retrieve the current multiplier for a rate-limit class.
+
+        :param klass: The name of the rate-limit class.
+        """
+
+        return self.multipliers.get(
+            klass, max(min(1.0, self.maximum), self.minimum))
+
+    def record(self, klass, latency, now):
+        """
+        Record the latency of a request.
+
+        :param klass: The name of the rate-limit class.
+        :param latency: The latency of the request, in seconds.
+        :param now: The time the request completed.
+        """
+
+        window = int(now // self.interval)
+        stats = self.latency.setdefault(window, {}).setdefault(
+            klass, [0.0, 0])
+        stats[0] += latency
+        stats[1] += 1
+
+    def update(self, db, now):
+        """
+        If it's time, add the worker's totals to the database and
+        reload the multipliers.  The first worker to do so in each
+        interval also adjusts the multipliers.  Errors are logged, but
+        otherwise ignored.
+
+        :param db: The database handle.
+        :param now: The current time.
+        """
+
+        if self.next_flush is not None and now < self.next_flush:
+            return
+        self.next_flush = now + self.flush
+
+        # The previous interval is adjusted one flush interval late
+        window = int((now - self.flush) // self.interval)
+        latency, self.latency = self.latency, {}
+        try:
+            # Add our totals for each interval and reload the
+            # multipliers in one round trip
+            pipe = db.pipeline(transaction=False)
+            for req_window, totals in sorted(latency.items()):
+                key = 'limit-latency:%d' % req_window
+                for klass, (total, count) in sorted(totals.items()):
+                    pipe.hincrbyfloat(key, '%s:sum' % klass, total)
+                    pipe.hincrby(key, '%s:count' % klass, count)
+                pipe.expire(key, int(math.ceil(self.interval * 3)))
+            pipe.hgetall(self.key)
+            self.multipliers = dict((klass, float(value)) for klass, value in
+                                    pipe.execute()[-1].items())
+
+            # Adjust the multipliers once per interval
+            if window != self.window:
+                self.window = window
+                if db.set('limit-adjust:%d' % (window - 1), now, nx=True,
+                          ex=int(math.ceil(self.interval * 3))):
+                    self.adjust(db, window - 1)
+        except Exception:
+            LOG.exception("Failed to update the adaptive limits")
+
+    def adjust(self, db, window):
+        """
+        Adjust the multipliers, based on the latency of the requests
+        during an interval.
+
+        :param db: The database handle.
+        :param window: The number of the interval.
+
+        :returns: A dictionary of the adjusted multipliers.
+        """
+
+        totals = {}
+        for field, value in db.hgetall('limit-latency:%d' % window).items():
+            klass, _sep, kind = field.rpartition(':')
+            totals.setdefault(klass, {})[kind] = float(value)
+
+        adjusted = {}
+        for klass, stats in totals.items():
+            count = stats.get('count', 0)
+            if count < self.min_requests or count <= 0:
+                continue
+
+            mult = self.multiplier(klass)
+            if stats.get('sum', 0.0) / count > self.target:
+                mult = max(mult * self.decrease, self.minimum)
+            else:
+                mult = min(mult + self.increase, self.maximum)
+            adjusted[klass] = mult
+
+        if adjusted:
+            db.hmset(self.key, adjusted)
+            self.multipliers.update(adjusted)
+
+        return adjusted
+
+
+class _GreenProfile(object):
+    """
+    A cProfile profiler confined to the green thread which created
+    it.  The profile hook is not saved and restored when greenlets
+    switch, so, while enabled, a cProfile profiler would also profile
+    every other green thread which runs while the request waits, such
+    as on the database.  The profiler is therefore suspended whenever
+    its green thread switches out, and resumed when it switches back
+    in.  Without greenlet, this is simply a cProfile profiler.
+    """
+
+    def __init__(self):
+        """
+        Initialize a _GreenProfile.  The profiler is not enabled.
+        """
+
+        # Only import cProfile if we're actually going to use it
+        import cProfile
+
+        self.profile = cProfile.Profile()
+        self.enabled = False
+
+        # Watch for switches of green threads
+        self.greenlet = None
+        try:
+            import greenlet
+        except ImportError:
+            pass
+        else:
+            self.greenlet = greenlet
+            self.current = greenlet.getcurrent()
+            self.previous = greenlet.settrace(self._switch)
+
+    def _switch(self, event, args):
+        """
+        Suspend or resume the profiler when greenlets switch.  Called
+        by greenlet.
+
+        :param event: The event; "switch" or "throw".
+        :param args: A tuple of the greenlets switched from and to.
+        """
+
+        if self.enabled and event in ('switch', 'throw'):
+            origin, target = args
+            if target is self.current:
+                self.profile.enable()
+            elif origin is self.current:
+                self.profile.disable()
+
+        if self.previous:
+            self.previous(event, args)
+
+    def enable(self):
+        """
+        Enable the profiler.
+        """
+
+        self.enabled = True
+        self.profile.enable()
+
+    def disable(self):
+        """
+        Disable the profiler.
+        """
+
+        self.enabled = False
+        self.profile.disable()
+
+    def close(self):
+        """
+        Disable the profiler, and stop watching for switches of green
+        threads.
+        """
+
+        self.disable()
+        if self.greenlet:
+            self.greenlet.settrace(self.previous)
+            self.greenlet = None
+
+
+class Profiler(object):
+    """
+    Profiles a sample of the requests passing through the Turnstile
+    middleware, for a single worker.  One request in every "rate"
+    requests is profiled, as is any request carrying the trigger
+    header from a trusted address.  Only the middleware's own
+    processing for that request is profiled--the preprocessors, the
+    limits, the postprocessors, and the formatter--not the Nova
+    application, nor other green threads (see _GreenProfile).  The
+    profiles are aggregated, and the aggregate is periodically written
+    to "profile.<pid>.prof" in a directory; the limit_class_profile
+    command merges the files from all the workers.
+    """
+
+    def __init__(self, rate=0, header=None, trusted=None, dump=None,
+                 interval=60.0):
+        """
+        Initialize a Profiler.
+
+        :param rate: Profile one request in every "rate" requests.  If
+                     0, requests are only profiled if they carry the
+                     trigger header.
+        :param header: The name of the trigger header, e.g.,
+                       "X-Profile-Limits".  Optional.
+        :param trusted: A list of the addresses from which the trigger
+                        header is accepted.
+        :param dump: The directory to write the profiles to.  If not
+                     given, the profiles are not written.
+        :param interval: The interval, in seconds, between writes of
+                         the profiles.
+        """
+
+        self.rate = rate
+        self.header = None
+        if header:
+            self.header = 'HTTP_%s' % header.upper().replace('-', '_')
+        self.trusted = set(trusted or [])
+        self.dump_to = dump
+        self.interval = interval
+
+        self.count = 0
+        self.active = False
+        self.stats = None
+        self.samples = 0
+        self.next_dump = None
+
+    def sample(self, environ):
+        """
+        Determine whether a request should be profiled.  Only one
+        request at a time is profiled.
+
+        :param environ: The WSGI environment for the request.
+
+        :returns: True if the request should be profiled.
+        """
+
+        if self.active:
+            return False
+
+        if (self.header and environ.get(self.header) and
+                environ.get('REMOTE_ADDR') in self.trusted):
+            return True
+
+        if self.rate > 0:
+            self.count += 1
+            if self.count >= self.rate:
+                self.count = 0
+                return True
+
+        return False
+
+    def start(self):
+        """
+        Begin profiling a request.
+
+        :returns: The profiler for the request, a _GreenProfile,
+                  which should be passed to stop().  The profiler may
+                  be disabled to exclude parts of the request from the
+                  profile.
+        """
+
+        self.active = True
+        prof = _GreenProfile()
+        prof.enable()
+
+        return prof
+
+    def stop(self, prof, now=None):
+        """
+        Finish profiling a request, adding its profile to the
+        aggregate.  If it's time, the aggregate is written out.
+
+        :param prof: The profiler returned by start().
+        :param now: The current time.  Optional.
+        """
+
+        prof.close()
+        self.active = False
+
+        # Only needed once a request has been profiled
+        import pstats
+
+        if self.stats is None:
+            self.stats = pstats.Stats(prof.profile)
+        else:
+            self.stats.add(prof.profile)
+        self.samples += 1
+
+        now = time.time() if now is None else now
+        if self.next_dump is None or now >= self.next_dump:
+            self.dump(now)
+
+    def dump(self, now):
+        """
+        Write out the aggregated profiles.  The file contains all the
+        profiles collected by the worker, so it is simply replaced
+        each time.  Errors are logged, but otherwise ignored.
+
+        :param now: The current time.
+        """
+
+        self.next_dump = now + self.interval
+
+        if self.dump_to and self.stats is not None:
+            try:
+                _atomic_write(os.path.join(
+                    self.dump_to, 'profile.%d.prof' % os.getpid()),
+                    marshal.dumps(self.stats.stats))
+            except Exception:
+                LOG.exception("Failed to dump profiles to %s" %
+                              self.dump_to)
+
+
+def profile_command(daemon, rate=None):
+    """
+    Process the "profile" control message, which changes the sampling
+    rate of the request profiler of every worker, without restarting
+    them.  To use, issue the "profile" command with the Turnstile
+    turnstile_command tool, e.g., "turnstile_command <config> profile
+    100" to profile one request in every 100, or "turnstile_command
+    <config> profile 0" to stop sampling requests.  When sampling is
+    stopped, the aggregated profiles are written out immediately.
+
+    :param daemon: The control daemon; used to get at the
+                   middleware.
+    :param rate: The new sampling rate.  If not given, the rate
+                 configured with the "profile" option is restored.
+    """
+
+    state = _get_state(daemon.middleware)
+    profiler = state.profiler
+
+    if rate is None:
+        rate = state.profile_rate
+    if int(rate) > 0 and not profiler.dump_to:
+        raise ValueError("The profile_dir option is required to "
+                         "profile requests")
+    profiler.rate = int(rate)
+    profiler.count = 0
+
+    if profiler.rate <= 0:
+        profiler.dump(time.time())
+
+
+class _NovaState(object):
+    """
+    Per-middleware state for the nova_limits processors.  Options
+    are drawn from the "nova_limits" section of the Turnstile
+    configuration, i.e., "nova_limits.<option>" in the paste file.
+    """
+
+    def __init__(self, conf):
+        """
+        Initialize the state from the Turnstile configuration.
+
+        :param conf: The turnstile.config.Config object.
+        """
+
+        nl_conf = conf['nova_limits']
+
+        # Set up the shared class table
+        self.class_table = None
+        if nl_conf.get('class_table'):
+            max_age = float(nl_conf.get('class_table_max_age', 300)) or None
+            self.class_table = ClassTable(
+                nl_conf['class_table'], max_age=max_age,
+                recheck=float(nl_conf.get('class_table_recheck', 1.0)))
+
+        # Set up the local class cache
+        self.class_cache_ttl = float(nl_conf.get('class_cache_ttl', 0))
+        self.class_cache = ExpiringCache(
+            int(nl_conf.get('class_cache_size', 10000)))
+
+        # Set up the mirror of the class filter
+        self.class_filter_enabled = config.Config.to_bool(
+            nl_conf.get('class_filter', 'no'))
+        self.class_filter_refresh = float(
+            nl_conf.get('class_filter_refresh', 60))
+        self.class_filter = None
+        self.class_filter_expires = None
+
+        # Buckets expiring within this many seconds are treated as
+        # having drained
+        self.bucket_grace = float(nl_conf.get('bucket_grace', 0))
+
+        # Limit on the number of buckets tracked in each bucket set
+        self.bucket_set_max = int(nl_conf.get('bucket_set_max', 0))
+
+        # Set up the limits cache
+        self.limits_cache = None
+        self.limits_cache_ttl = float(nl_conf.get('limits_cache_ttl', 60))
+        if config.Config.to_bool(nl_conf.get('limits_cache', 'no')):
+            self.limits_cache = ExpiringCache(
+                int(nl_conf.get('limits_cache_size', 10000)))
+
+        # Set up heavy hitter tracking
+        self.hitters = None
+        if config.Config.to_bool(nl_conf.get('hitters', 'no')):
+            self.hitters = HeavyHitters(
+                dump=nl_conf.get('hitters_dump'),
+                interval=float(nl_conf.get('hitters_interval', 60)),
+                top=int(nl_conf.get('hitters_top', 20)),
+                width=int(nl_conf.get('hitters_width', 2048)),
+                depth=int(nl_conf.get('hitters_depth', 4)),
+                timeout=float(nl_conf.get('hitters_timeout', 1.0)))
+
+        # Rate-limit class inheritance; maps each class to its parent
+        self.class_parents = {}
+        for item in nl_conf.get('class_parents', '').replace(',', ' ').split():
+            child, _sep, parent = item.partition(':')
+            self.class_parents[child] = parent
+
+        # Check for inheritance cycles now, rather than when a request
+        # first needs the limits of one of the classes
+        for klass in sorted(self.class_parents):
+            self._class_chain(klass)
+
+        # Set up the in-flight limits
+        self.inflight = None
+        tenant_limits = InFlight.parse(nl_conf.get('inflight_tenant', ''))
+        class_limits = InFlight.parse(nl_conf.get('inflight_class', ''))
+        if tenant_limits or class_limits:
+            self.inflight = InFlight(
+                tenant_limits, class_limits,
+                shared=config.Config.to_bool(
+                    nl_conf.get('inflight_shared', 'no')),
+                ttl=int(nl_conf.get('inflight_ttl', 300)),
+                retry=float(nl_conf.get('inflight_retry', 1.0)))
+
+        # Set up the adaptive limits
+        self.adaptive = None
+        if config.Config.to_bool(nl_conf.get('adaptive', 'no')):
+            self.adaptive = AdaptiveLimits(
+                target=float(nl_conf.get('adaptive_target', 1.0)),
+                interval=float(nl_conf.get('adaptive_interval', 30)),
+                increase=float(nl_conf.get('adaptive_increase', 0.05)),
+                decrease=float(nl_conf.get('adaptive_decrease', 0.5)),
+                minimum=float(nl_conf.get('adaptive_min', 0.1)),
+                maximum=float(nl_conf.get('adaptive_max', 2.0)),
+                min_requests=int(nl_conf.get('adaptive_min_requests', 10)),
+                flush=float(nl_conf.get('adaptive_flush', 1.0)))
+
+        # Set up the request profiler; the sampling rate may be changed
+        # at run time, with the "profile" control command.  The
+        # profiles may reveal details of the requests, so they aren't
+        # written to a shared directory by default.
+        self.profile_rate = int(nl_conf.get('profile', 0))
+        if ((self.profile_rate or nl_conf.get('profile_header')) and
+                not nl_conf.get('profile_dir')):
+            raise ValueError("The profile_dir option is required to "
+                             "profile requests")
+        self.profiler = Profiler(
+            rate=self.profile_rate,
+            header=nl_conf.get('profile_header'),
+            trusted=nl_conf.get('profile_trusted',
+                                '127.0.0.1, ::1').replace(',', ' ').split(),
+            dump=nl_conf.get('profile_dir'),
+            interval=float(nl_conf.get('profile_interval', 60)))
+
+        # Warm-up configuration
+        self.warmup_enabled = config.Config.to_bool(
+            nl_conf.get('warmup', 'no'))
+        self.warmup_budget = float(nl_conf.get('warmup_budget', 2.0))
+        self.warmup_batch = int(nl_conf.get('warmup_batch', 500))
+
+        # Per-limit data, indexed by rate-limit class
+        self.limit_sum = None
+        self.class_limits = {}
+        self.class_uuids = {}
+        self.class_cacheable = {}
+        self.bucket_set_ttl = None
+
+    def get_class(self, tenant, now):
+        """
+        Look up the rate-limit class for a tenant in the local class
+        cache.
+
+        :param tenant: The ID of the tenant.
+        :param now: The current time.
+
+        :returns: The name of the rate-limit class, or None if it is
+                  not cached.
+        """
+
+        return self.class_cache.lookup(tenant, now)
+
+    def set_class(self, tenant, klass, now):
+        """
+        Save the rate-limit class for a tenant in the local class
+        cache.  Does nothing if the cache is not enabled.
+
+        :param tenant: The ID of the tenant.
+        :param klass: The name of the rate-limit class.
+        :param now: The current time.
+        """
+
+        if self.class_cache_ttl <= 0:
+            return
+
+        self.class_cache.store(tenant, klass, now + self.class_cache_ttl)
+
+    def may_have_class(self, db, tenant, now):
+        """
+        Check the mirror of the class filter to see if a tenant may
+        have a rate-limit class other than "default".  The mirror is
+        reloaded from the database every class_filter_refresh seconds.
+
+        :param db: The database handle.
+        :param tenant: The ID of the tenant.
+        :param now: The current time.
+
+        :returns: False if the tenant definitely has the "default"
+                  rate-limit class, True otherwise.
+        """
+
+        if not self.class_filter_enabled:
+            return True
+
+        if (self.class_filter_expires is None or
+                now >= self.class_filter_expires):
+            self.class_filter_expires = now + self.class_filter_refresh
+            try:
+                self.class_filter = ClassFilter.load(db)
+            except Exception:
+                LOG.exception("Failed to load the class filter")
+                self.class_filter = None
+
+        return self.class_filter is None or tenant in self.class_filter
+
+    def _check_limits(self, midware):
+        """
+        Discard the per-limit data if the limits have changed.
+
+        :param midware: The Turnstile middleware.
+        """
+
+        if midware.limit_sum != self.limit_sum:
+            self.limit_sum = midware.limit_sum
+            self.class_limits = {}
+            self.class_uuids = {}
+            self.class_cacheable = {}
+            self.bucket_set_ttl = None
+
+    def get_bucket_set_ttl(self, midware):
+        """
+        Retrieve the expiration time to apply to a bucket set.  No
+        bucket outlives the longest unit of any limit, so a bucket set
+        given this expiration time whenever a request is made does not
+        expire before its buckets.
+
+        :param midware: The Turnstile middleware.
+
+        :returns: The expiration time, in seconds, or 0 if there are
+                  no limits.
+        """
+
+        self._check_limits(midware)
+
+        if self.bucket_set_ttl is None:
+            self.bucket_set_ttl = int(math.ceil(max(
+                [lim.unit_value for lim in midware.limits] or [-1]))) + 1
+
+        return self.bucket_set_ttl
+
+    def get_limits(self, midware, klass):
+        """
+        Retrieve the limits applicable to a rate-limit class.  The
+        translation of each limit into its Nova representation is
+        computed once and cached until the limits change.
+
+        :param midware: The Turnstile middleware.
+        :param klass: The name of the rate-limit class.
+
+        :returns: A list of tuples, each consisting of the limit, its
+                  URI (with any queries), the list of verbs, and the
+                  name of the unit.
+        """
+
+        self._check_limits(midware)
+
+        if klass not in self.class_limits:
+            self._compile(midware, klass)
+
+        return self.class_limits[klass]
+
+    def get_limit_set(self, midware, klass):
+        """
+        Retrieve the UUIDs of the NovaClassLimit limits applicable to
+        a rate-limit class, including those inherited from its
+        ancestors.
+
+        :param midware: The Turnstile middleware.
+        :param klass: The name of the rate-limit class.
+
+        :returns: A frozenset of limit UUIDs.
+        """
+
+        self._check_limits(midware)
+
+        if klass not in self.class_uuids:
+            self._compile(midware, klass)
+
+        return self.class_uuids[klass]
+
+    def is_cacheable(self, midware, klass):
+        """
+        Determine whether the limits of a rate-limit class may be
+        cached.  Only NovaClassLimit limits bump the version of a
+        tenant's buckets when they update them, so the limits of a
+        class are not cached if any of them is another kind of limit.
+
+        :param midware: The Turnstile middleware.
+        :param klass: The name of the rate-limit class.
+
+        :returns: True if the limits may be cached, False otherwise.
+        """
+
+        self._check_limits(midware)
+
+        if klass not in self.class_cacheable:
+            self._compile(midware, klass)
+
+        return self.class_cacheable[klass]
+
+    def _class_chain(self, klass):
+        """
+        Compute the chain of ancestors of a rate-limit class.
+
+        :param klass: The name of the rate-limit class.
+
+        :returns: A list of the names of the class and its ancestors,
+                  beginning with the class itself.
+        """
+
+        chain = [klass]
+        while chain[-1] in self.class_parents:
+            parent = self.class_parents[chain[-1]]
+            if parent in chain:
+                cycle = chain[chain.index(parent):] + [parent]
+                raise ValueError("Rate-limit class %r inherits from itself: "
+                                 "%s" % (parent, ' -> '.join(cycle)))
+            chain.append(parent)
+
+        return chain
+
+    def _compile(self, midware, klass):
+        """
+        Compile the flat table of limits applicable to a rate-limit
+        class.  A limit for the class overrides any limit with the
+        same URI, verbs, queries, requirements, parameters used, and
+        unit for one of its ancestors; limits which are not
+        NovaClassLimit limits apply to all classes.
+
+        :param midware: The Turnstile middleware.
+        :param klass: The name of the rate-limit class.
+        """
+
+        chain = self._class_chain(klass)
+
+        # Select the nearest definition of each limit
+        selected = {}
+        for turns_lim in midware.limits:
+            rate_class = getattr(turns_lim, 'rate_class', None)
+            if rate_class is None or rate_class not in chain:
+                continue
+
+            # Without inheritance, there's nothing to override
+            ident = _limit_ident(turns_lim) if len(chain) > 1 else None
+            depth = chain.index(rate_class)
+            if ident not in selected or depth < selected[ident][0]:
+                selected[ident] = (depth, [turns_lim.uuid])
+            elif depth == selected[ident][0]:
+                selected[ident][1].append(turns_lim.uuid)
+        uuids = frozenset(lim_uuid for _depth, lim_uuids in selected.values()
+                          for lim_uuid in lim_uuids)
+
+        # Build the table, in the order the limits are listed
+        lims = []
+        for turns_lim in midware.limits:
+            # If the limit has a rate_class, ensure it's one of the
+            # selected ones.  If the limit does not have a
+            # rate_class, we want to include it in the final list.
+            if (hasattr(turns_lim, 'rate_class') and
+                    turns_lim.uuid not in uuids):
+                continue
+
+            lims.append((turns_lim,) + _translate_limit(turns_lim))
+
+        self.class_limits[klass] = lims
+        self.class_uuids[klass] = uuids
+        self.class_cacheable[klass] = all(
+            isinstance(entry[0], NovaClassLimit) for entry in lims)
+
+    def warmup(self, midware):
+        """
+        Warm up the local class cache and the per-limit data.  The
+        rate-limit classes of recently active tenants--those with a
+        bucket set--are fetched in batches until the warm-up time
+        budget runs out.  This is run in the background by
+        _get_state().
+
+        :param midware: The Turnstile middleware.
+        """
+
+        deadline = time.time() + self.warmup_budget
+        db = midware.db
+
+        def tenants():
+            # Check the deadline as the keys arrive, so that a slow
+            # scan can't overrun the budget
+            for key in db.scan_iter(match='bucket_set:*',
+                                    count=self.warmup_batch):
+                if time.time() >= deadline:
+                    return
+                yield key[len('bucket_set:'):]
+
+        try:
+            classes = set(['default'])
+            if self.class_cache_ttl > 0:
+                for batch in _batches(tenants(), self.warmup_batch):
+                    now = time.time()
+                    for tenant, klass in zip(batch, db.mget(
+                            ['limit-class:%s' % t for t in batch])):
+                        klass = klass or 'default'
+                        self.set_class(tenant, klass, now)
+                        classes.add(klass)
+
+            # The limits may not have been loaded yet, if the warm-up
+            # was started by the middleware
+            if isinstance(midware, middleware.TurnstileMiddleware):
+                with midware.mapper_lock:
+                    midware.recheck_limits()
+
+            # Precompute the per-limit data for the classes we saw
+            for klass in classes:
+                self.get_limits(midware, klass)
+        except Exception:
+            LOG.exception("Failed to warm up nova_limits")
+
+
+# Maps middleware instances to their _NovaState
+_states = weakref.WeakKeyDictionary()
+
+
+def _get_state(midware):
+    """
+    Retrieve the _NovaState for the middleware, creating it if
+    necessary.  If so configured, a new state is warmed up in a
+    separate green thread, so that no request waits for the warm-up.
+    """
+
+    state = _states.get(midware)
+    if state is None:
+        state = _states[midware] = _NovaState(midware.conf)
+        if state.warmup_enabled:
+            # Only import eventlet if we're actually going to use it
+            import eventlet
+            eventlet.spawn_n(state.warmup, midware)
+
+    return state
+
+
+def _lookup_class(midware, tenant):
+    """
+    Look up the rate-limit class for a tenant.  The shared class
+    table is consulted first, if one is configured; otherwise, or if
+    the table is unavailable or stale, the local class cache is
+    checked, and finally the class is looked up in the database--
+    unless the class filter shows that the tenant has the "default"
+    class.
+    """
+
+    state = _get_state(midware)
+    if state.class_table:
+        klass = state.class_table.lookup(tenant)
+        if klass:
+            return klass
+
+    now = time.time()
+    klass = state.get_class(tenant, now)
+    if klass:
+        return klass
+
+    if state.may_have_class(midware.db, tenant, now):
+        klass = midware.db.get('limit-class:%s' % tenant) or 'default'
+    else:
+        klass = 'default'
+    state.set_class(tenant, klass, now)
+
+    return klass
+
+
+def _limit_ident(turns_lim):
+    """
+    Compute the identity of a limit, for the purpose of overriding
+    limits inherited from a parent rate-limit class.
+
+    :param turns_lim: The Turnstile limit.
+
+    :returns: A tuple of the limit's URI, verbs, queries,
+              requirements, parameters used, and unit value.
+    """
+
+    return (turns_lim.uri, tuple(sorted(turns_lim.verbs)),
+            tuple(sorted(turns_lim.queries)),
+            tuple(sorted(turns_lim.requirements.items())),
+            tuple(sorted(turns_lim.use)), turns_lim.unit_value)
+
+
+def _translate_limit(turns_lim):
+    """
+    Translate some information squirreled away in a Turnstile limit
+    into the form Nova expects.
+
+    :param turns_lim: The Turnstile limit.
+
+    :returns: A tuple of the URI (accounting for any queries), the
+              list of verbs, and the name of the unit.
+    """
+
+    # Account for queries for the uri...
+    uri = turns_lim.uri
+    if turns_lim.queries:
+        uri = ('%s?%s' % (uri,
+                          '&'.join('%s={%s}' % (qstr, qstr) for qstr in
+                                   sorted(turns_lim.queries))))
+
+    # Translate some information squirreled away in the limit
+    verbs = turns_lim.verbs or ['GET', 'HEAD', 'POST', 'PUT', 'DELETE']
+    unit = turns_lim.unit.upper()
+    if unit.isdigit():
+        unit = 'UNKNOWN'
+
+    return uri, verbs, unit
+
+
+# Matches the path of the Nova /limits endpoint
+_LIMITS_RE = re.compile(r'/limits(\.[a-z]+)?$')
+
+
+def _limits_request(environ):
+    """
+    Determine whether a request retrieves the limits from the Nova
+    /limits endpoint.
+
+    :param environ: The WSGI environment for the request.
+    """
+
+    return (environ.get('REQUEST_METHOD') == 'GET' and
+            _LIMITS_RE.search(environ.get('PATH_INFO', '')) is not None)
+
+
+def _version_ttl(environ):
+    """
+    Determine the expiration time of a tenant's limits version, from
+    the "nova_limits.limits_version_ttl" configuration option
+    (default 1 day).
+
+    :param environ: The WSGI environment for the request.
+    """
+
+    return int(environ['turnstile.conf']['nova_limits'].get(
+        'limits_version_ttl', 86400))
+
+
+def _bump_version(db, environ):
+    """
+    Bump the version of a tenant's buckets, if one of them was
+    updated by a NovaClassLimit during this request.  Atomic
+    NovaClassLimit limits bump the version in the script which
+    updates the bucket; this accounts for those bumps, and bumps the
+    version once for all the other buckets updated.  The version key
+    expires after _version_ttl() seconds.
+
+    :param db: The database handle.
+    :param environ: The WSGI environment for the request.
+
+    :returns: None if no bucket was updated; otherwise, a tuple of
+              the version before and the version after this
+              request's updates.  If another request updated a bucket
+              at the same time, the version before is not one any
+              request saw, which is safe for the limits cache.
+    """
+
+    bumps = environ.pop('turnstile.nova.bumps', 0)
+    version = environ.pop('turnstile.nova.version', None)
+
+    if environ.pop('turnstile.nova.updated', False):
+        # Bump the version and refresh its expiration in one round
+        # trip
+        key = environ['turnstile.nova.version_key']
+        pipe = db.pipeline(transaction=False)
+        pipe.incr(key)
+        pipe.expire(key, _version_ttl(environ))
+        version = pipe.execute()[0]
+        bumps += 1
+
+    if not bumps:
+        return None
+
+    return version - bumps, version
+
+
+def nova_preprocess(midware, environ):
+    """
+    Pre-process requests to nova.  The tenant name is extracted from
+    the nova context, and the applicable rate limit class is looked up
+    in the database.  Both pieces of data are attached to the request
+    environment.  This preprocessor must be present to use the
+    NovaClassLimit rate limiting class.
+    """
+
+    # First, figure out the tenant
+    context = environ.get('nova.context')
+    if context:
+        tenant = context.project_id
+    else:
+        # There *should* be a tenant by now, but let's be liberal
+        # in what we accept
+        tenant = '<NONE>'
+    environ['turnstile.nova.tenant'] = tenant
+
+    # Now, figure out the rate limit class
+    klass = _lookup_class(midware, tenant)
+    klass = environ.setdefault('turnstile.nova.limitclass', klass)
+
+    # If classes inherit limits, tell NovaClassLimit which limits
+    # apply to the class
+    state = _get_state(midware)
+    if state.class_parents:
+        environ['turnstile.nova.limit_set'] = state.get_limit_set(midware,
+                                                                  klass)
+
+    # Set up the nova quota class, if possible
+    if (context and hasattr(context, 'quota_class') and
+            context.quota_class is None):
+        context.quota_class = klass
+
+    # Tell Turnstile where to store the bucket keys
+    bucket_set = 'bucket_set:%s' % tenant
+    environ['turnstile.bucket_set'] = bucket_set
+
+    # If the limits are cached, NovaClassLimit needs to know where to
+    # record changes to the buckets
+    if state.limits_cache is not None:
+        environ['turnstile.nova.version_key'] = 'limits_version:%s' % tenant
+
+    # Count the request; the formatter counts rejections
+    if state.hitters is not None:
+        state.hitters.request(tenant, klass, time.time())
+        environ['turnstile.nova.hitters'] = state.hitters
+
+    # Scale the limits by the current multiplier for the class
+    if state.adaptive is not None:
+        state.adaptive.update(midware.db, time.time())
+        environ['turnstile.nova.multiplier'] = state.adaptive.multiplier(
+            klass)
+
+    # Trim off expired buckets--and the oldest buckets, if there are
+    # too many--and keep the bucket set from outliving its buckets
+    pipe = midware.db.pipeline(transaction=False)
+    pipe.zremrangebyscore(bucket_set, 0, time.time())
+    if state.bucket_set_max > 0:
+        pipe.zremrangebyrank(bucket_set, 0, -(state.bucket_set_max + 1))
+    ttl = state.get_bucket_set_ttl(midware)
+    if ttl > 0:
+        pipe.expire(bucket_set, ttl)
+
+        # If the bucket set doesn't exist yet, the expiration does
+        # nothing; it must be set again once the buckets have been
+        # registered
+        environ['turnstile.nova.bucket_set_ttl'] = ttl
+    pipe.execute()
+
+
+def _expire_bucket_set(db, environ):
+    """
+    Set the expiration time of a tenant's bucket set, after the limits
+    have registered their buckets in it.  Turnstile creates the bucket
+    set, without an expiration time, if it didn't exist when
+    nova_preprocess() set the expiration time.
+
+    :param db: The database handle.
+    :param environ: The WSGI environment for the request.
+    """
+
+    ttl = environ.pop('turnstile.nova.bucket_set_ttl', None)
+    if ttl and environ.get('turnstile.bucket_set'):
+        db.expire(environ['turnstile.bucket_set'], ttl)
+
+
+def _index_buckets(entries):
+    """
+    Index the entries of a bucket set by limit UUID.
+
+    :param entries: A list of tuples of bucket key and expiration
+                    time, as returned by ZRANGE with scores.
+
+    :returns: A dictionary mapping limit UUIDs to lists of tuples of
+              the decoded bucket key and the expiration time.
+    """
+
+    buckets = {}
+    for key, expire in entries:
+        decoded_key = limits.BucketKey.decode(key)
+        buckets.setdefault(decoded_key.uuid, [])
+        buckets[decoded_key.uuid].append((decoded_key, expire))
+
+    return buckets
+
+
+def _build_limits(class_limits, buckets, load, now, drained,
+                  multiplier=1.0):
+    """
+    Translate Turnstile limits and their buckets into the Nova
+    representation of the limits, as reported by Nova's /limits
+    endpoint.
+
+    :param class_limits: The limits applicable to the rate-limit
+                         class, as returned by _NovaState.get_limits().
+    :param buckets: The tenant's buckets, as returned by
+                    _index_buckets().
+    :param load: A callable taking a limit and a decoded bucket key,
+                 and returning the bucket.  Only called for buckets
+                 which have not drained.
+    :param now: The current time.
+    :param drained: Buckets expiring before this time are treated as
+                    having drained.
+    :param multiplier: The multiplier applied to the values of the
+                       NovaClassLimit limits by the adaptive limits.
+
+    :returns: A list of dictionaries describing the limits.
+    """
+
+    # We may need a formatter later on, so set one up
+    fmt = string.Formatter()
+
+    lims = []
+    for turns_lim, uri, verbs, unit in class_limits:
+        # Only NovaClassLimit limits are scaled
+        scale = 1.0
+        if isinstance(turns_lim, NovaClassLimit):
+            scale = multiplier
+        value = int(math.floor(turns_lim.value * scale))
+
+        # Load up any available buckets
+        buck_list = []
+        for key, expire in buckets.get(turns_lim.uuid, []):
+            if expire <= drained:
+                # The bucket has reset, so there's no need to load it
+                bucket = DrainedBucket(turns_lim.value, expire)
+            else:
+                # Load the bucket
+                bucket = load(turns_lim, key)
+
+            # Save the bucket
+            buck_list.append((ParamsDict(key.params), bucket))
+
+        # Figure out remaining and resetTime
+        if buck_list:
+            remaining = min(bucket.messages for _params, bucket in buck_list)
+            resetTime = max(bucket.expire for _params, bucket in buck_list)
+        else:
+            remaining = turns_lim.value
+            resetTime = now
+        remaining = int(math.floor(remaining * scale))
+
+        # Now, build a representation of the limit
+        for verb in verbs:
+            # For weighted limits, report the units each request uses
+            extra = {}
+            if isinstance(turns_lim, NovaClassLimit) and turns_lim.cost:
+                extra['cost'] = turns_lim.units(verb)
+            if scale != 1.0:
+                extra['multiplier'] = scale
+
+            if len(buck_list) > 1:
+                # Generate one entry for each bucket
+                for params, bucket in buck_list:
+                    # Substitute (some of) the values in params to
+                    # make the URI more specific
+                    buck_uri = fmt.vformat(uri, (), params)
+                    lims.append(dict(
+                        verb=verb,
+                        URI=buck_uri,
+                        regex=buck_uri,
+                        value=value,
+                        unit=unit,
+                        remaining=int(math.floor(bucket.messages * scale)),
+                        resetTime=bucket.expire,
+                        **extra
+                    ))
+
+            lims.append(dict(
+                verb=verb,
+                URI=uri,
+                regex=uri,
+                value=value,
+                unit=unit,
+
+                # These values are computed from the buckets...
+                remaining=remaining,
+                resetTime=resetTime,
+                **extra
+            ))
+
+    return lims
+
+
+def nova_postprocess(midware, environ):
+    """
+    Post-process requests to nova.  This processes all the buckets
+    associated with the rate limit class and inserts a nova-compatible
+    representation into the environment.  This allows the nova /limits
+    endpoint to report the rate limits and current usage.
+    """
+
+    # Get some handy information from the environment
+    klass = environ['turnstile.nova.limitclass']
+    bucket_set = environ['turnstile.bucket_set']
+    multiplier = environ.get('turnstile.nova.multiplier', 1.0)
+    state = _get_state(midware)
+    now = time.time()
+
+    # Keep the bucket set from outliving its buckets
+    _expire_bucket_set(midware.db, environ)
+
+    # If the limits are cached, see if the cached copy is current
+    cacheable = False
+    if state.limits_cache is not None:
+        versions = _bump_version(midware.db, environ)
+        cacheable = state.is_cacheable(midware, klass)
+    if cacheable:
+        if versions is None:
+            version = int(midware.db.get(
+                environ['turnstile.nova.version_key']) or 0)
+            versions = (version, version)
+
+        # A request for the limits doesn't make the cached copy
+        # stale by updating the buckets itself; otherwise, polling
+        # /limits under a matching limit would never use the cache.
+        # The copy is then kept for the next request.
+        seen, version = versions
+        if not _limits_request(environ):
+            seen = version
+        tenant = environ['turnstile.nova.tenant']
+        ident = (klass, midware.limit_sum, version, multiplier)
+        cached = state.limits_cache.lookup(tenant, now)
+        if cached and cached[0] == (klass, midware.limit_sum, seen,
+                                    multiplier):
+            if seen != version:
+                state.limits_cache.store(tenant, (ident,) + cached[1:],
+                                         cached[2])
+            environ['nova.limits'] = cached[1]
+            environ['turnstile.nova.etag'] = cached[3]
+            return
+
+    # Buckets expiring before this time have fully drained
+    drained = now + state.bucket_grace
+
+    # Grab a list of the available buckets and their expiration
+    # times.  While we're at it, figure out when the first live
+    # bucket drains, since that changes the limits.
+    entries = midware.db.zrange(bucket_set, 0, -1, withscores=True)
+    cache_expires = now + state.limits_cache_ttl
+    for _key, expire in entries:
+        if expire > drained:
+            cache_expires = min(cache_expires, expire - state.bucket_grace)
+
+    # Finally, translate Turnstile limits into Nova limits, so we can
+    # use Nova's /limits endpoint
+    lims = _build_limits(state.get_limits(midware, klass),
+                         _index_buckets(entries),
+                         lambda turns_lim, key: turns_lim.load(key),
+                         now, drained, multiplier)
+
+    # Save the limits for Nova to use
+    environ['nova.limits'] = lims
+
+    # Cache the limits, along with an entity tag identifying them for
+    # NovaTurnstileMiddleware
+    if cacheable:
+        etag = '"%s"' % hashlib.md5(
+            repr(ident + (cache_expires,))).hexdigest()
+        environ['turnstile.nova.etag'] = etag
+        state.limits_cache.store(tenant, (ident, lims, cache_expires, etag),
+                                 cache_expires)
+
+
+# Updates a bucket and registers it in the bucket set, in one round
+# trip.  This mirrors turnstile.limits.BucketLoader and
+# NovaBucket.delay(); the bucket records are the same, so the
+# compactor works on buckets updated either way.
+#
+# The tenant's limits version, if there is one, is bumped in the same
+# round trip; the new version is returned after the bucket state.
+#
+# KEYS: bucket key, bucket set (or ""), compactor key, limits version
+#       key (or "")
+# ARGV: update record, update UUID, update time, unit value, cost of
+#       a single unit, epsilon, maximum updates (0 to never
+#       summarize), maximum age of a summarize record, summarize
+#       record, expiration time of the bucket set (0 for none),
+#       expiration time of the limits version
+_BUCKET_SCRIPT = """
+local key, bucket_set, compactor_key = KEYS[1], KEYS[2], KEYS[3]
+local version_key = KEYS[4]
+local update_uuid, now = ARGV[2], tonumber(ARGV[3])
+local unit_value, cost = tonumber(ARGV[4]), tonumber(ARGV[5])
+local eps, max_updates = tonumber(ARGV[6]), tonumber(ARGV[7])
+local max_age, bucket_set_ttl = tonumber(ARGV[8]), tonumber(ARGV[10])
+
+redis.call('RPUSH', key, ARGV[1])
+
+local last, nxt, level, delay = nil, nil, 0, nil
+local updates, summarized, summarize_ts = 0, false, nil
+local done = false
+for _, raw in ipairs(redis.call('LRANGE', key, 0, -1)) do
+    local rec = cmsgpack.unpack(raw)
+    if rec.bucket then
+        if not done then
+            last, nxt = rec.bucket.last, rec.bucket.next
+            level = rec.bucket.level or 0
+        end
+    elseif rec.update then
+        if not done then
+            local t = rec.update.time
+            if not last or last == 0 then
+                last = t
+            elseif t < last then
+                t = last
+            end
+            level = math.max(level - (t - last), 0)
+            last = t
+
+            local units = 1
+            if type(rec.update.params) == 'table' and
+                    rec.update.params.cost then
+                units = rec.update.params.cost
+            end
+
+            local difference = level + cost * units - unit_value
+            if difference >= eps then
+                nxt, delay = t + difference, difference
+            else
+                level, nxt, delay = level + cost * units, t, nil
+            end
+            updates = updates + 1
+        end
+    elseif rec.summarize then
+        summarized = true
+        if not summarize_ts or rec.summarize > summarize_ts then
+            summarize_ts = rec.summarize
+        end
+    end
+
+    if rec.uuid == update_uuid then
+        done = true
+    end
+end
+
+if max_updates > 0 and
+        ((summarized and summarize_ts + max_age <= now) or
+         (not summarized and updates >= max_updates)) then
+    redis.call('RPUSH', key, ARGV[9])
+    redis.call('ZADD', compactor_key, math.ceil(now), key)
+end
+
+local expire = math.ceil(last + level)
+redis.call('EXPIREAT', key, expire)
+if bucket_set ~= '' then
+    redis.call('ZADD', bucket_set, expire, key)
+    if bucket_set_ttl > 0 then
+        redis.call('EXPIRE', bucket_set, bucket_set_ttl)
+    end
+end
+
+local version = false
+if version_key and version_key ~= '' then
+    version = redis.call('INCR', version_key)
+    redis.call('EXPIRE', version_key, tonumber(ARGV[11]))
+end
+
+local function fmt(value)
+    return value and string.format('%.17g', value) or false
+end
+return {fmt(delay), fmt(last), fmt(nxt), fmt(level), version}
+"""
+
+
+def _strip_version(uri):
+    """
+    Filter the version identifier off of a Nova URI.
+
+    :param uri: The URI.
+    """
+
+    if uri.startswith('/v1.1/'):
+        return uri[5:]
+    elif uri.startswith('/v2/'):
+        return uri[3:]
+
+    return uri
+
+
+class NovaBucket(limits.Bucket):
+    """
+    Bucket for NovaClassLimit.  Each request may consume several
+    units of the limit, as recorded in the "cost" parameter of its
+    update record; requests without a recorded cost consume a single
+    unit.
+    """
+
+    def delay(self, params, now=None):
+        """Determine delay until next request."""
+
+        if now is None:
+            now = time.time()
+
+        # Initialize last...
+        if not self.last:
+            self.last = now
+        elif now < self.last:
+            now = self.last
+
+        # How much has leaked out?
+        leaked = now - self.last
+
+        # Update the last message time
+        self.last = now
+
+        # Update the water level
+        self.level = max(self.level - leaked, 0)
+
+        # Are we too full?
+        cost = self.limit.unit_cost * params.get('cost', 1)
+        difference = self.level + cost - self.limit.unit_value
+        if difference >= self.eps:
+            self.next = now + difference
+            return difference
+
+        # OK, raise the water level and set next to an appropriate
+        # value
+        self.level += cost
+        self.next = now
+
+        return None
+
+
+class NovaClassLimit(limits.Limit):
+    """
+    Rate limiting class for applying rate limits to classes of Nova
+    tenants.  The nova_limits:nova_preprocess preprocessor must be
+    configured for this limit class to match.
+    """
+
+    attrs = dict(
+        rate_class=dict(
+            desc=('The rate limiting class this limit applies to.  Required.'),
+            type=str,
+        ),
+        atomic=dict(
+            desc=('A boolean which, if True, causes the bucket to be '
+                  'updated and registered in the bucket set by a single '
+                  'server-side script.  Defaults to False.'),
+            type=bool,
+            default=False,
+        ),
+        cost=dict(
+            desc=('A mapping of HTTP verbs to the number of units of the '
+                  'limit consumed by a request using that verb; the "*" '
+                  'entry applies to verbs not listed.  Requests consume '
+                  'a single unit by default.  The "value" of the limit is '
+                  'then the permissible number of units per unit time.'),
+            type=dict,
+            subtype=int,
+            default=lambda: {},  # Make sure we don't use the *same* dict
+            xform=lambda cost: dict((verb.upper(), units)
+                                    for verb, units in cost.items()),
+        ),
+    )
+
+    bucket_class = NovaBucket
+
+    # Shadow the cost property of turnstile.limits.Limit, so that the
+    # cost attribute may be set; see unit_cost
+    cost = None
+
+    @property
+    def unit_cost(self):
+        """
+        Retrieve the amount by which a single unit increases the water
+        level in the bucket.
+        """
+
+        return float(self.unit_value) / float(self.value)
+
+    def units(self, verb):
+        """
+        Determine the number of units of the limit consumed by a
+        request.
+
+        :param verb: The HTTP verb of the request.
+        """
+
+        return self.cost.get(verb.upper(), self.cost.get('*', 1))
+
+    def route(self, uri, route_args):
+        """
+        Filter version identifiers off of the URI.
+        """
+
+        return _strip_version(uri)
+
+    def filter(self, environ, params, unused):
+        """
+        Determines whether this limit applies to this request and
+        attaches the tenant name to the params.
+        """
+
+        # Do we match?  If classes inherit limits, the preprocessor
+        # has determined which limits apply to the class
+        if ('turnstile.nova.tenant' not in environ or
+                'turnstile.nova.limitclass' not in environ):
+            raise limits.DeferLimit()
+        elif 'turnstile.nova.limit_set' in environ:
+            if self.uuid not in environ['turnstile.nova.limit_set']:
+                raise limits.DeferLimit()
+        elif self.rate_class != environ['turnstile.nova.limitclass']:
+            raise limits.DeferLimit()
+
+        # OK, add the tenant to the params
+        params['tenant'] = environ['turnstile.nova.tenant']
+
+        # The bucket is about to be updated, so the tenant's limits
+        # version will need to be bumped; the atomic script bumps it
+        # itself
+        if 'turnstile.nova.version_key' in environ and not self.atomic:
+            environ['turnstile.nova.updated'] = True
+
+        # Record the cost of weighted requests in the update record;
+        # the adaptive limits scale the cost inversely
+        multiplier = environ.get('turnstile.nova.multiplier', 1.0)
+        if self.cost or multiplier != 1.0:
+            cost = self.units(environ.get('REQUEST_METHOD', ''))
+            if multiplier != 1.0:
+                cost /= float(multiplier)
+            return dict(cost=cost)
+
+    def _filter(self, environ, params):
+        """
+        Performs final filtering of the request to determine if this
+        limit applies.  Returns False if the limit does not apply or
+        if the call should not be limited, or True to apply the limit.
+
+        If the "atomic" attribute is set, the bucket is updated, its
+        expiration set, and the bucket added to the bucket set by a
+        single server-side script; otherwise, this is the same as
+        turnstile.limits.Limit._filter().
+        """
+
+        if not self.atomic:
+            return super(NovaClassLimit, self)._filter(environ, params)
+
+        # Search for required query arguments
+        if self.queries:
+            if 'QUERY_STRING' not in environ:
+                return False
+
+            available = set(qstr.partition('=')[0] for qstr in
+                            environ['QUERY_STRING'].split('&'))
+            if not set(self.queries).issubset(available):
+                return False
+
+        # Use only the parameters listed in use; we'll add the others
+        # back later
+        unused = dict((key, value) for key, value in params.items()
+                      if key not in self.use)
+        for key in unused:
+            del params[key]
+
+        # Set up any additional params required to get the bucket
+        try:
+            additional = self.filter(environ, params, unused) or {}
+        except limits.DeferLimit:
+            return False
+
+        # Compute the bucket key and update the parameters
+        key = self.key(params)
+        params.update(unused)
+        params.update(additional)
+
+        # Set up the records the script may need to push
+        now = time.time()
+        update_uuid = str(uuid.uuid4())
+        update = msgpack.dumps(dict(
+            uuid=update_uuid,
+            update=dict(params=params, time=now),
+        ))
+        summarize = msgpack.dumps(dict(summarize=now,
+                                       uuid=str(uuid.uuid4())))
+
+        # Determine how the compactor is configured
+        max_updates = 0
+        max_age = 600
+        compactor_key = 'compactor'
+        if 'turnstile.conf' in environ:
+            compactor = environ['turnstile.conf']['compactor']
+            try:
+                max_updates = int(compactor['max_updates'])
+            except (KeyError, ValueError):
+                pass
+            try:
+                max_age = int(compactor['max_age'])
+            except (KeyError, ValueError):
+                pass
+            compactor_key = compactor.get('compactor_key', compactor_key)
+
+        # Update the bucket
+        script = getattr(self, '_bucket_script', None)
+        if script is None:
+            script = self._bucket_script = self.db.register_script(
+                _BUCKET_SCRIPT)
+        version_key = environ.get('turnstile.nova.version_key')
+        delay, last, next_, level, version = script(
+            keys=[key, environ.get('turnstile.bucket_set') or '',
+                  compactor_key, version_key or ''],
+            args=[update, update_uuid, repr(now),
+                  repr(float(self.unit_value)), repr(self.unit_cost),
+                  repr(self.bucket_class.eps), max_updates, max_age,
+                  summarize,
+                  environ.get('turnstile.nova.bucket_set_ttl', 0),
+                  _version_ttl(environ) if version_key else 0])
+
+        # Keep track of the tenant's limits version; see
+        # _bump_version()
+        if version is not None:
+            environ['turnstile.nova.version'] = int(version)
+            environ['turnstile.nova.bumps'] = environ.get(
+                'turnstile.nova.bumps', 0) + 1
+
+        # If we found a delay, store the particulars in the
+        # environment
+        if delay is not None:
+            bucket = self.bucket_class(self.db, self, key, last=float(last),
+                                       next=float(next_), level=float(level))
+            environ.setdefault('turnstile.delay', [])
+            environ['turnstile.delay'].append((float(delay), self, bucket))
+
+        # Should we continue the route scan?
+        return not self.continue_scan
+
+
+def _etag_match(if_none_match, etag):
+    """
+    Determine whether an If-None-Match header matches an entity tag.
+    Uses the weak comparison function, as required for
+    If-None-Match.
+
+    :param if_none_match: The value of the If-None-Match header.
+    :param etag: The entity tag.
+
+    :returns: True if the header matches the entity tag, False
+              otherwise.
+    """
+
+    if not if_none_match:
+        return False
+
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == opaque:
+            return True
+
+    return False
+
+
+class NovaTurnstileMiddleware(middleware.TurnstileMiddleware):
+    """
+    Turnstile middleware with support for conditional requests to the
+    Nova /limits endpoint.  When the nova_limits limits cache is
+    enabled, responses from /limits carry an entity tag identifying
+    the cached copy of the limits, and requests with a matching
+    If-None-Match header receive a "304 Not Modified" response without
+    Nova being called.  When in-flight limits are configured, requests
+    which would exceed them are rejected using the configured
+    formatter, and a sample of the requests may be profiled (see
+    Profiler).  To use, configure the Turnstile middleware with
+    "turnstile = nova_limits".
+    """
+
+    def __init__(self, app, local_conf):
+        """
+        Initialize the middleware.  The application is wrapped so
+        that in-flight limits and conditional requests can be handled
+        after the postprocessors have run.
+        """
+
+        super(NovaTurnstileMiddleware, self).__init__(app, local_conf)
+
+        self.nova_app = app
+        self.app = self.call_app
+
+        # Set up the state now, so the warm-up starts with the worker
+        # rather than with its first request
+        _get_state(self)
+
+    def __call__(self, environ, start_response):
+        """
+        Process a request, profiling it if it is selected by the
+        request profiler.
+        """
+
+        profiler = _get_state(self).profiler
+        if not profiler.sample(environ):
+            return super(NovaTurnstileMiddleware, self).__call__(
+                environ, start_response)
+
+        prof = environ['turnstile.nova.profile'] = profiler.start()
+        try:
+            return super(NovaTurnstileMiddleware, self).__call__(
+                environ, start_response)
+        finally:
+            profiler.stop(prof)
+
+    def call_app(self, environ, start_response):
+        """
+        Call the Nova application, enforcing the in-flight limits and
+        measuring the latency for the adaptive limits.  The request is
+        counted as in flight until its response body has been sent.
+        """
+
+        # In-flight limits are only enforced once nova_preprocess()
+        # has identified the tenant
+        state = _states.get(self)
+        tenant = environ.get('turnstile.nova.tenant')
+        if (not state or not tenant or
+                (state.inflight is None and state.adaptive is None)):
+            return self.conditional_app(environ, start_response)
+
+        klass = environ.get('turnstile.nova.limitclass')
+        release = None
+        if state.inflight is not None:
+            release, limit = state.inflight.acquire(self.db, tenant, klass)
+            if limit:
+                return self.formatter(state.inflight.retry, limit, None,
+                                      environ, start_response)
+
+        start = time.time()
+
+        def done():
+            if release:
+                release()
+            if state.adaptive is not None:
+                now = time.time()
+                state.adaptive.record(klass, now - start, now)
+
+        try:
+            result = self.conditional_app(environ, start_response)
+        except Exception:
+            done()
+            raise
+
+        return _InFlightBody(result, done)
+
+    def conditional_app(self, environ, start_response):
+        """
+        Call the Nova application, handling conditional requests for
+        the Nova /limits endpoint.
+        """
+
+        # The Nova application is not profiled
+        prof = environ.get('turnstile.nova.profile')
+        if prof:
+            prof.disable()
+
+        # Only interested in retrievals of cached limits
+        etag = environ.get('turnstile.nova.etag')
+        if not etag or not _limits_request(environ):
+            return self.nova_app(environ, start_response)
+
+        # Does the client already have the current limits?  If so,
+        # there's no need to call Nova at all
+        if _etag_match(environ.get('HTTP_IF_NONE_MATCH'), etag):
+            start_response('304 Not Modified', [('ETag', etag)])
+            return []
+
+        # Only tag successful responses
+        def tagging_start_response(status, headers, exc_info=None):
+            if status.startswith('200'):
+                headers = list(headers) + [('ETag', etag)]
+            return start_response(status, headers, exc_info)
+
+        return self.nova_app(environ, tagging_start_response)
+
+
+def nova_formatter(status, delay, limit, bucket, environ, start_response):
+    """
+    Formats the over-limit response for the request.  This variant
+    utilizes Nova's OverLimitFault for consistency with Nova's
+    rate-limiting.
+    """
+
+    # Nova is only needed here, so it is imported on demand; this
+    # keeps the limit_class command and the Turnstile entry points
+    # from paying for importing all of Nova.  Note that this must be
+    # done before using _(), which Nova installs.
+    from nova.api.openstack import wsgi
+
+    # Build the error message based on the limit's values
+    if isinstance(limit, InFlightLimit):
+        args = dict(value=limit.value, scope=limit.scope)
+        error = _("Only %(value)s request(s) can be in progress at "
+                  "once for this %(scope)s.") % args
+    else:
+        args = dict(
+            value=limit.value,
+            verb=environ['REQUEST_METHOD'],
+            uri=limit.uri,
+            unit_string=limit.unit.upper(),
+        )
+        if isinstance(limit, NovaClassLimit):
+            # Report the value as scaled by the adaptive limits
+            args['value'] = int(math.floor(limit.value * environ.get(
+                'turnstile.nova.multiplier', 1.0)))
+            args['cost'] = limit.units(args['verb'])
+        if isinstance(limit, NovaClassLimit) and limit.cost:
+            error = _("Only %(value)s unit(s) of requests can be made to "
+                      "%(uri)s every %(unit_string)s; each %(verb)s "
+                      "request uses %(cost)s unit(s).") % args
+        else:
+            error = _("Only %(value)s %(verb)s request(s) can be "
+                      "made to %(uri)s every %(unit_string)s.") % args
+
+    # Set up the rest of the arguments for wsgi.OverLimitFault
+    msg = _("This request was rate-limited.")
+    retry = time.time() + delay
+
+    # Convert to a fault class
+    fault = wsgi.OverLimitFault(msg, error, retry)
+
+    # Buckets may have been updated even though the request was
+    # rate-limited
+    _bump_version(limit.db, environ)
+    _expire_bucket_set(limit.db, environ)
+
+    # Count the rejection, if we're tracking heavy hitters
+    hitters = environ.get('turnstile.nova.hitters')
+    if hitters is not None:
+        hitters.reject(environ.get('turnstile.nova.tenant'),
+                       environ.get('turnstile.nova.limitclass'))
+
+    # Now let's call it and return the result
+    return fault(environ, start_response)
+
+
+def _report_limit_class(args, result):
+    """
+    Report the rate-limit class for the tenant.  This is a
+    postprocessor for the limit_class() function, when being called in
+    console script mode.
+
+    :param args: A Namespace object containing a 'tenant_id' attribute
+                 and a desired rate-limit class in the 'klass'
+                 attribute (which should be None if no change was
+                 requested).
+    :param result: The result of the limit_class() function call.
+                   This will be the previously configured rate-limit
+                   class for the tenant.
+
+    :returns: None to indicate success.
+    """
+
+    print "Tenant %s:" % args.tenant_id
+    if args.klass:
+        print "  Previous rate-limit class: %s" % result
+        print "  New rate-limit class: %s" % args.klass
+    else:
+        print "  Configured rate-limit class: %s" % result
+
+    return None
+
+
+@tools.add_argument('conf_file',
+                    metavar='config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('tenant_id',
+                    help="ID of the tenant.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_argument('--class', '-c',
+                    dest='klass',
+                    action='store',
+                    default=None,
+                    help="If specified, sets the class associated with "
+                    "the given tenant ID.")
+@tools.add_postprocessor(_report_limit_class)
+def limit_class(conf_file, tenant, klass=None):
+    """
+    Set up or query limit classes associated with tenants.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param tenant: The ID of the tenant.
+    :param klass: If provided, the name of the class to map the tenant
+                  to.
+
+    Returns the class associated with the given tenant.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    db = conf.get_database()
+
+    return _set_class(db, tenant, klass)
+
+
+def _set_class(db, tenant, klass=None):
+    """
+    Set up or query the limit class associated with a tenant.
+
+    :param db: The database handle.
+    :param tenant: The ID of the tenant.
+    :param klass: If provided, the name of the class to map the tenant
+                  to.
+
+    Returns the class previously associated with the given tenant.
+    """
+
+    # Get the key for the limit class...
+    key = 'limit-class:%s' % tenant
+
+    # Now, look up the tenant's current class
+    old_klass = db.get(key) or 'default'
+
+    # Do we need to change it?
+    if klass and klass != old_klass:
+        if klass == 'default':
+            # Resetting to the default
+            db.delete(key)
+        else:
+            # Changing to a new value
+            db.set(key, klass)
+            ClassFilter.update(db, tenant)
+
+    return old_klass
 
 
 # For backwards compatibility
 _limit_class = limit_class
+
+
+def _batches(iterable, size):
+    """
+    Split an iterable into lists of at most the given size.
+
+    :param iterable: The iterable to split up.
+    :param size: The maximum number of items in each batch.
+
+    :returns: A generator yielding the lists.
+    """
+
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def _scan_classes(db, batch_size=1000):
+    """
+    Scan the database for all the tenants with a configured
+    rate-limit class.
+
+    :param db: The database handle.
+    :param batch_size: The number of keys to retrieve at a time.
+
+    :returns: A generator yielding tuples of the tenant ID and the
+              name of the rate-limit class.
+    """
+
+    for keys in _batches(db.scan_iter(match='limit-class:*',
+                                      count=batch_size), batch_size):
+        for key, klass in zip(keys, db.mget(keys)):
+            if klass:
+                yield key[len('limit-class:'):], klass
+
+
+def _report_class_table(args, result):
+    """
+    Report the number of tenants written to the class table.  This
+    is a postprocessor for the limit_class_table() function, when
+    being called in console script mode.
+
+    :param args: A Namespace object.
+    :param result: The result of the limit_class_table() function
+                   call.  This will be the number of tenants written
+                   to the class table, or an error message.
+
+    :returns: None to indicate success, or the error message.
+    """
+
+    if isinstance(result, basestring):
+        return result
+
+    print "Wrote %d tenant(s) to the class table" % result
+
+    return None
+
+
+@tools.add_argument('conf_file',
+                    metavar='config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('--table', '-t',
+                    dest='path',
+                    action='store',
+                    default=None,
+                    help="Name of the class table file.  Defaults to the "
+                    "'class_table' option in the [nova_limits] section of "
+                    "the configuration file.")
+@tools.add_argument('--interval', '-i',
+                    dest='interval',
+                    metavar='SECS',
+                    type=float,
+                    action='store',
+                    default=None,
+                    help="If specified, keep refreshing the class table "
+                    "every SECS seconds.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_postprocessor(_report_class_table)
+def limit_class_table(conf_file, path=None, interval=None):
+    """
+    Build the shared tenant class table from the Redis database.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param path: Name of the class table file.  If not given, the
+                 'class_table' option in the [nova_limits] section of
+                 the configuration file is used.
+    :param interval: If given, the table is rebuilt every interval
+                     seconds, and this function never returns.
+
+    Returns the number of tenants written to the class table.  Only
+    one refresher may run for a given table; a lock file (the table
+    name with ".lock" appended) is used to ensure this.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    db = conf.get_database()
+
+    # Figure out the table file
+    path = path or conf['nova_limits'].get('class_table')
+    if not path:
+        raise ValueError("No class table file configured")
+
+    # Make sure we're the only refresher
+    with open(path + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise ValueError("Another refresher is running for %s" % path)
+
+        while True:
+            count = ClassTable.write(path, dict(_scan_classes(db)))
+            if not interval:
+                return count
+
+            time.sleep(interval)
+
+
+def _load_hitters(files):
+    """
+    Load heavy hitter dumps.
+
+    :param files: A list of dump files, or of directories containing
+                  dump files.  Each line of a file must contain one
+                  dump.
+
+    :returns: A generator of dicts, as generated by
+              HeavyHitters.dehydrate().
+    """
+
+    for fname in files:
+        if os.path.isdir(fname):
+            names = sorted(glob.glob(os.path.join(fname, 'hitters.*.json')))
+        else:
+            names = [fname]
+
+        for name in names:
+            with open(name) as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def _report_hitters(args, result):
+    """
+    Report the heavy hitters.  This is a postprocessor for the
+    limit_class_hitters() function, when being called in console
+    script mode.
+
+    :param args: A Namespace object.
+    :param result: The result of the limit_class_hitters() function
+                   call.  This will be a dict, or an error message.
+
+    :returns: None to indicate success, or the error message.
+    """
+
+    if isinstance(result, basestring):
+        return result
+
+    if not result['dumps']:
+        print "No heavy hitter dumps found"
+        return None
+
+    print "Merged %d dump(s) covering %s to %s" % (
+        result['dumps'],
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(result['start'])),
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(result['end'])))
+
+    for title, key in (("requests", 'requests'),
+                       ("rejections", 'rejections')):
+        print
+        print "Top tenants by %s (estimated):" % title
+        for tenant, count in result[key]:
+            print "    %-40s %10d" % (tenant, count)
+
+    print
+    print "Rate-limit classes:"
+    print "    %-40s %10s %10s" % ('class', 'requests', 'rejections')
+    for klass, (requests, rejections) in sorted(result['classes'].items()):
+        print "    %-40s %10d %10d" % (klass, requests, rejections)
+
+    return None
+
+
+def _merge_hitters(dumps, top):
+    """
+    Merge heavy hitter dumps.
+
+    :param dumps: An iterable of dicts, as generated by
+                  HeavyHitters.dehydrate().
+    :param top: The number of top tenants to report.
+
+    :returns: A dict, as described for limit_class_hitters().
+    """
+
+    result = dict(dumps=0, start=None, end=None, classes={})
+    merged = {}
+    for dump in dumps:
+        result['dumps'] += 1
+        if result['start'] is None or dump['start'] < result['start']:
+            result['start'] = dump['start']
+        if result['end'] is None or dump['end'] > result['end']:
+            result['end'] = dump['end']
+
+        for key in ('requests', 'rejections'):
+            topk = TopK.hydrate(dump[key])
+            if key in merged:
+                merged[key].merge(topk)
+            else:
+                merged[key] = topk
+
+        for klass, counts in dump['classes'].items():
+            totals = result['classes'].setdefault(klass, [0, 0])
+            totals[0] += counts[0]
+            totals[1] += counts[1]
+
+    for key in ('requests', 'rejections'):
+        result[key] = merged[key].items()[:top] if key in merged else []
+
+    return result
+
+
+class _HittersHandler(SocketServer.StreamRequestHandler):
+    """
+    Handles a connection from a worker sending heavy hitter dumps, as
+    by HeavyHitters.dump().  Each line must contain one dump.
+    """
+
+    # Don't let a stuck worker hold up the other workers
+    timeout = 5.0
+
+    def handle(self):
+        """
+        Read dumps until the connection is closed.
+        """
+
+        try:
+            for line in iter(self.rfile.readline, ''):
+                if line.strip():
+                    self.server.dumps.append(json.loads(line))
+        except Exception:
+            LOG.exception("Failed to read heavy hitter dumps")
+
+
+class _HittersServer(SocketServer.UnixStreamServer):
+    """
+    Server for the limit_class_hitters command in listening mode.
+    Connections are handled one at a time; the dumps received are
+    accumulated in the "dumps" attribute.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize a _HittersServer.
+
+        :param path: The path to the Unix domain socket.
+        """
+
+        SocketServer.UnixStreamServer.__init__(self, path, _HittersHandler)
+        self.dumps = []
+
+
+def _listen_hitters(path, mode, interval, top):
+    """
+    Listen for heavy hitter dumps on a Unix domain socket, and report
+    the merged dumps every interval.
+
+    :param path: The path to the Unix domain socket.
+    :param mode: The permissions of the socket, as an octal string.
+    :param interval: The interval, in seconds, between reports.
+    :param top: The number of top tenants to report.
+
+    Runs until interrupted, then returns the merged dumps received
+    since the last report.
+    """
+
+    with _claim_socket(path):
+        # Make sure the socket is never more accessible than desired
+        old_umask = os.umask(0777)
+        try:
+            server = _HittersServer(path)
+        finally:
+            os.umask(old_umask)
+
+        try:
+            os.chmod(path, int(mode, 8))
+
+            next_report = time.time() + interval
+            while True:
+                server.timeout = max(next_report - time.time(), 0.0)
+                server.handle_request()
+
+                now = time.time()
+                if now >= next_report:
+                    dumps, server.dumps = server.dumps, []
+                    _report_hitters(None, _merge_hitters(dumps, top))
+                    print
+                    sys.stdout.flush()
+                    next_report = now + interval
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+        return _merge_hitters(server.dumps, top)
+
+
+@tools.add_argument('files',
+                    metavar='file',
+                    nargs='*',
+                    help="Heavy hitter dump files, or directories "
+                    "containing them.")
+@tools.add_argument('--top', '-t',
+                    type=int,
+                    action='store',
+                    default=20,
+                    help="Number of top tenants to report.  Defaults "
+                    "to 20.")
+@tools.add_argument('--listen', '-l',
+                    action='store',
+                    default=None,
+                    help="Instead of reading dump files, listen on the "
+                    "given Unix domain socket for dumps sent by the "
+                    "workers, and report the merged dumps periodically.")
+@tools.add_argument('--interval', '-i',
+                    type=float,
+                    action='store',
+                    default=60.0,
+                    help="When listening, the interval, in seconds, "
+                    "between reports.  Defaults to 60.")
+@tools.add_argument('--mode', '-m',
+                    action='store',
+                    default='0600',
+                    help="When listening, the permissions of the socket, "
+                    "in octal.  Defaults to 0600.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_postprocessor(_report_hitters)
+def limit_class_hitters(files, top=20, listen=None, interval=60.0,
+                        mode='0600'):
+    """
+    Merge the heavy hitter dumps from several workers.
+
+    :param files: A list of dump files, or of directories containing
+                  dump files.
+    :param top: The number of top tenants to report.
+    :param listen: If given, the path of a Unix domain socket to
+                   listen on for dumps, instead of reading files.  The
+                   dumps received are merged and reported every
+                   interval, until interrupted.
+    :param interval: When listening, the interval, in seconds,
+                     between reports.
+    :param mode: When listening, the permissions of the socket, as an
+                 octal string.
+
+    Returns a dict with the keys "dumps" (the number of dumps
+    merged), "start" and "end" (the time range covered by the dumps),
+    "requests" and "rejections" (lists of tuples of tenant and
+    estimated count, in order of decreasing count), and "classes" (a
+    dict mapping each rate-limit class to a list of the number of
+    requests and the number of rejections).  When listening, the
+    dumps are those received since the last report.
+    """
+
+    if listen:
+        if files:
+            raise ValueError("Dump files cannot be given with --listen")
+        return _listen_hitters(listen, mode, interval, top)
+    elif not files:
+        raise ValueError("No dump files given")
+
+    return _merge_hitters(_load_hitters(files), top)
+
+
+def _report_class_filter(args, result):
+    """
+    Report the number of tenants added to the class filter.  This is
+    a postprocessor for the limit_class_filter() function, when being
+    called in console script mode.
+
+    :param args: A Namespace object.
+    :param result: The result of the limit_class_filter() function
+                   call.  This will be the number of tenants added to
+                   the class filter, or an error message.
+
+    :returns: None to indicate success, or the error message.
+    """
+
+    if isinstance(result, basestring):
+        return result
+
+    print "Added %d tenant(s) to the class filter" % result
+
+    return None
+
+
+@tools.add_argument('conf_file',
+                    metavar='config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('--size', '-s',
+                    type=int,
+                    action='store',
+                    default=1048576,
+                    help="Size of the class filter, in bits.  Defaults "
+                    "to 1048576.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_postprocessor(_report_class_filter)
+def limit_class_filter(conf_file, size=1048576):
+    """
+    Rebuild the class filter from the Redis database.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param size: The size of the class filter, in bits.  This is
+                 rounded up to a multiple of 8.
+
+    Returns the number of tenants added to the class filter.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    db = conf.get_database()
+
+    # Build the filter
+    class_filter = ClassFilter(bytearray((size + 7) // 8))
+    count = 0
+    for tenant, _klass in _scan_classes(db):
+        class_filter.add(tenant)
+        count += 1
+
+    class_filter.save(db)
+
+    # A tenant whose class was set while we were scanning may have
+    # been added only to the filter we just replaced; scan again to
+    # add it to the new filter.  Tenants whose class is set from now
+    # on are added to the new filter by _set_class().
+    for batch in _batches(_scan_classes(db), 1000):
+        ClassFilter.update(db, *[tenant for tenant, _klass in batch])
+
+    return count
+
+
+class _LimitClassHandler(SocketServer.StreamRequestHandler):
+    """
+    Handles a connection to the limit_class_server.  Each command is
+    a single line; the response to each command is a single line
+    beginning with "ok" or "error".  The commands are:
+
+    get <tenant>
+        Responds with the rate-limit class of the tenant.
+
+    set <tenant> <class>
+        Sets the rate-limit class of the tenant, and responds with
+        its previous class.
+
+    bulk <count>
+        Must be followed by <count> lines, each containing a tenant
+        and a rate-limit class, separated by whitespace.  The classes
+        of all the tenants are set, and the response is the number of
+        tenants.
+
+    quit
+        Closes the connection.
+    """
+
+    def handle(self):
+        """
+        Handle commands until the connection is closed.
+        """
+
+        for line in iter(self.rfile.readline, ''):
+            args = line.split()
+            if not args:
+                continue
+            elif args[0] == 'quit':
+                break
+
+            try:
+                result = self.command(*args)
+            except Exception as exc:
+                LOG.exception("Failed to process %r" % line)
+                result = 'error %s' % str(exc).replace('\n', ' ')
+
+            self.wfile.write(result + '\n')
+            self.wfile.flush()
+
+    def command(self, cmd, *args):
+        """
+        Process a command.
+
+        :param cmd: The command.
+
+        Remaining positional arguments are the arguments to the
+        command.
+
+        :returns: The response line, without the newline.
+        """
+
+        db = self.server.db
+
+        if cmd == 'get' and len(args) == 1:
+            return 'ok %s' % _set_class(db, args[0])
+        elif cmd == 'set' and len(args) == 2:
+            return 'ok %s' % _set_class(db, args[0], args[1])
+        elif cmd == 'bulk' and len(args) == 1 and args[0].isdigit():
+            return 'ok %d' % self.bulk(db, int(args[0]))
+
+        return 'error invalid command %r' % ' '.join((cmd,) + args)
+
+    def bulk(self, db, count):
+        """
+        Read tenants and their rate-limit classes and set them, in a
+        single round trip.
+
+        :param db: The database handle.
+        :param count: The number of lines to read.
+
+        :returns: The number of tenants.
+        """
+
+        # Read all the lines first, so an error leaves the connection
+        # usable
+        mapping = []
+        for _i in range(count):
+            fields = self.rfile.readline().split()
+            if len(fields) != 2:
+                raise ValueError("Expected a tenant and a rate-limit class")
+            mapping.append(fields)
+
+        pipe = db.pipeline(transaction=False)
+        for tenant, klass in mapping:
+            if klass == 'default':
+                pipe.delete('limit-class:%s' % tenant)
+            else:
+                pipe.set('limit-class:%s' % tenant, klass)
+        pipe.execute()
+
+        ClassFilter.update(db, *[tenant for tenant, klass in mapping
+                                 if klass != 'default'])
+
+        return len(mapping)
+
+
+class _LimitClassServer(SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+    """
+    Server for the limit_class_server command.  Each connection is
+    handled in its own thread; all the threads share the database
+    handle, and thus its connection pool.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, db):
+        """
+        Initialize a _LimitClassServer.
+
+        :param path: The path to the Unix domain socket.
+        :param db: The database handle.
+        """
+
+        SocketServer.UnixStreamServer.__init__(self, path,
+                                               _LimitClassHandler)
+        self.db = db
+
+
+@contextlib.contextmanager
+def _claim_socket(path):
+    """
+    Claim the path of a Unix domain socket for a server.  A lock file
+    ensures that only one server uses the path at a time.  A socket
+    left behind by a previous server is removed, but anything at the
+    path which is not a socket, or a socket on which a server is
+    still listening, is left alone.
+
+    :param path: The path to the Unix domain socket.
+
+    Raises ValueError if the path cannot be claimed.
+    """
+
+    with open(path + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise ValueError("Another server is running for %s" % path)
+
+        try:
+            mode = os.stat(path).st_mode
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise ValueError("%s exists and is not a socket" % path)
+
+            # See if a server is still listening on the socket
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+            except socket.error:
+                # Left behind by a previous server
+                os.unlink(path)
+            else:
+                raise ValueError("Another server is listening on %s" % path)
+            finally:
+                sock.close()
+
+        yield
+
+
+@tools.add_argument('conf_file',
+                    metavar='config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('path',
+                    help="Path of the Unix domain socket to listen on.")
+@tools.add_argument('--mode', '-m',
+                    action='store',
+                    default='0600',
+                    help="Permissions of the socket, in octal.  Defaults "
+                    "to 0600.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+def limit_class_server(conf_file, path, mode='0600'):
+    """
+    Serve requests to set up or query limit classes associated with
+    tenants over a Unix domain socket.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param path: The path to the Unix domain socket.
+    :param mode: The permissions of the socket, as an octal string.
+
+    Runs until interrupted.  See _LimitClassHandler for the protocol.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    db = conf.get_database()
+
+    with _claim_socket(path):
+        # Make sure the socket is never more accessible than desired
+        old_umask = os.umask(0777)
+        try:
+            server = _LimitClassServer(path, db)
+        finally:
+            os.umask(old_umask)
+
+        try:
+            os.chmod(path, int(mode, 8))
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+
+# Stands in for the Turnstile middleware, for commands which need the
+# limits applicable to rate-limit classes
+_LimitSource = collections.namedtuple('_LimitSource', ['limits', 'limit_sum'])
+
+
+def _tenant_usage(db, conf, tenants, batch_size=100):
+    """
+    Compute the current usage of the limits for many tenants.  The
+    work is done in batches of tenants, with two pipelined round
+    trips to the database for each batch: one to fetch the rate-limit
+    classes and bucket sets (and, if the adaptive limits are enabled,
+    the multipliers), and one to fetch the buckets which have not
+    drained.
+
+    :param db: The database handle.
+    :param conf: The turnstile.config.Config object.
+    :param tenants: An iterable of tenant IDs.
+    :param batch_size: The number of tenants in each batch.
+
+    :returns: A generator of tuples of the tenant ID, its rate-limit
+              class, and the Nova representation of its limits, as
+              generated by _build_limits().
+    """
+
+    # Load the limits
+    key = conf['control'].get('limits_key', 'limits')
+    source = _LimitSource(database.limits_hydrate(db, db.zrange(key, 0, -1)),
+                          None)
+    state = _NovaState(conf)
+
+    for batch in _batches(tenants, batch_size):
+        # Fetch the classes and the bucket sets
+        pipe = db.pipeline(transaction=False)
+        for tenant in batch:
+            pipe.get('limit-class:%s' % tenant)
+            pipe.zrange('bucket_set:%s' % tenant, 0, -1, withscores=True)
+        if state.adaptive is not None:
+            pipe.hgetall(state.adaptive.key)
+        results = pipe.execute()
+        if state.adaptive is not None:
+            state.adaptive.multipliers = dict(
+                (klass, float(value)) for klass, value in
+                results[-1].items())
+
+        now = time.time()
+        drained = now + state.bucket_grace
+
+        # Figure out which buckets need to be loaded
+        tenant_data = []
+        to_load = []
+        for i, tenant in enumerate(batch):
+            klass = results[2 * i] or 'default'
+            class_limits = state.get_limits(source, klass)
+            buckets = _index_buckets(results[2 * i + 1])
+
+            for turns_lim, _uri, _verbs, _unit in class_limits:
+                for bucket_key, expire in buckets.get(turns_lim.uuid, []):
+                    if expire > drained:
+                        to_load.append((turns_lim, bucket_key))
+
+            tenant_data.append((tenant, klass, class_limits, buckets))
+
+        # Fetch the buckets
+        pipe = db.pipeline(transaction=False)
+        for _turns_lim, bucket_key in to_load:
+            if bucket_key.version == 1:
+                pipe.get(str(bucket_key))
+            else:
+                pipe.lrange(str(bucket_key), 0, -1)
+        loaded = {}
+        for (turns_lim, bucket_key), raw in zip(to_load, pipe.execute()):
+            if bucket_key.version == 1:
+                bucket = (turns_lim.bucket_class.hydrate(
+                    db, msgpack.loads(raw), turns_lim, str(bucket_key))
+                    if raw else turns_lim.bucket_class(db, turns_lim,
+                                                       str(bucket_key)))
+            else:
+                bucket = limits.BucketLoader(turns_lim.bucket_class, db,
+                                             turns_lim, str(bucket_key),
+                                             raw).bucket
+            loaded[str(bucket_key)] = bucket
+
+        # Translate the limits
+        for tenant, klass, class_limits, buckets in tenant_data:
+            multiplier = (1.0 if state.adaptive is None else
+                          state.adaptive.multiplier(klass))
+            yield tenant, klass, _build_limits(
+                class_limits, buckets,
+                lambda turns_lim, bucket_key: loaded[str(bucket_key)],
+                now, drained, multiplier)
+
+
+@tools.add_argument('conf_file',
+                    metavar='config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('tenants',
+                    metavar='tenant_id',
+                    nargs='*',
+                    help="IDs of the tenants to report on.")
+@tools.add_argument('--pattern', '-p',
+                    action='store',
+                    default=None,
+                    help="Report on the tenants with buckets whose IDs "
+                    "match this glob-style pattern, instead of on the "
+                    "listed tenants.")
+@tools.add_argument('--batch', '-b',
+                    dest='batch_size',
+                    type=int,
+                    action='store',
+                    default=100,
+                    help="Number of tenants to process at a time.  "
+                    "Defaults to 100.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+def limit_class_usage(conf_file, tenants=None, pattern=None,
+                      batch_size=100):
+    """
+    Report the current usage of the limits for many tenants.  For
+    each tenant, a line containing a JSON object is written to
+    standard output as soon as it is computed; the object has the
+    keys "tenant", "class", and "limits", the last being the limits as
+    reported by Nova's /limits endpoint, including "remaining" and
+    "resetTime".
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param tenants: A list of the IDs of the tenants to report on.
+    :param pattern: If given, the tenants with buckets whose IDs match
+                    this glob-style pattern are reported on, instead
+                    of those listed in tenants.
+    :param batch_size: The number of tenants to process at a time.
+
+    Returns None.
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    db = conf.get_database()
+
+    # Figure out the tenants
+    if pattern:
+        tenants = (key[len('bucket_set:'):] for key in
+                   db.scan_iter(match='bucket_set:%s' % pattern,
+                                count=batch_size))
+    elif not tenants:
+        raise ValueError("No tenants specified")
+
+    for tenant, klass, lims in _tenant_usage(db, conf, tenants, batch_size):
+        record = {'tenant': tenant, 'class': klass, 'limits': lims}
+        sys.stdout.write(json.dumps(record) + '\n')
+        sys.stdout.flush()
+
+
+class _MemoryAudit(object):
+    """
+    Samples the keys used by nova_limits and measures their memory
+    use, for the limit_class_audit command.  Memory use is measured
+    with the MEMORY USAGE command, if the server supports it (Redis
+    4.0 or later), and is otherwise estimated from the length of the
+    key and of its serialized value, as returned by DUMP.
+    """
+
+    def __init__(self, db, sample=0.1, batch_size=100, pause=0.1):
+        """
+        Initialize a _MemoryAudit.
+
+        :param db: The database handle.
+        :param sample: The fraction of the tenants to sample.  The
+                       same tenants are sampled on each run.
+        :param batch_size: The number of keys to process at a time.
+        :param pause: The number of seconds to pause after each
+                      batch, to limit the load on the server.
+        """
+
+        self.db = db
+        self.sample = sample
+        self.batch_size = batch_size
+        self.pause = pause
+
+        # See if MEMORY USAGE is available
+        try:
+            db.execute_command('MEMORY', 'USAGE', ClassFilter.key)
+            self.method = 'MEMORY USAGE'
+        except redis.ResponseError:
+            self.method = 'DUMP'
+
+    def sampled(self, tenant):
+        """
+        Determine whether a tenant is in the sample.
+
+        :param tenant: The ID of the tenant.
+        """
+
+        return _hash_indexes(tenant, 1, 1000000)[0] < self.sample * 1000000
+
+    def _measure(self, pipe, key):
+        """
+        Queue up the measurement of a key's memory use.
+
+        :param pipe: The pipeline.
+        :param key: The key.
+        """
+
+        if self.method == 'MEMORY USAGE':
+            pipe.execute_command('MEMORY', 'USAGE', key)
+        else:
+            pipe.dump(key)
+
+    def _size(self, key, result):
+        """
+        Convert the result of a measurement into a size, in bytes.
+
+        :param key: The key.
+        :param result: The result of the measurement.
+        """
+
+        if result is None:
+            return 0
+        elif self.method == 'MEMORY USAGE':
+            return int(result)
+
+        return len(key) + len(result)
+
+    def _scan(self, pattern):
+        """
+        Scan for keys, pausing after each batch.
+
+        :param pattern: The pattern to match.
+
+        :returns: A generator of lists of keys.
+        """
+
+        for keys in _batches(self.db.scan_iter(match=pattern,
+                                               count=self.batch_size),
+                             self.batch_size):
+            yield keys
+            if self.pause:
+                time.sleep(self.pause)
+
+    def audit_classes(self):
+        """
+        Count the limit-class keys and measure the sampled ones.
+
+        :returns: A tuple of the number of keys, the number of keys
+                  sampled, and the total size of the sampled keys.
+        """
+
+        count = sampled = size = 0
+        for keys in self._scan('limit-class:*'):
+            count += len(keys)
+            keys = [key for key in keys
+                    if self.sampled(key[len('limit-class:'):])]
+            if not keys:
+                continue
+
+            pipe = self.db.pipeline(transaction=False)
+            for key in keys:
+                self._measure(pipe, key)
+            sampled += len(keys)
+            size += sum(self._size(key, result)
+                        for key, result in zip(keys, pipe.execute()))
+
+        return count, sampled, size
+
+    def audit_tenants(self):
+        """
+        Count the tenants with buckets, and measure the bucket sets
+        and buckets of the sampled ones.
+
+        :returns: A tuple of the number of tenants with buckets and a
+                  list of tuples, one for each sampled tenant, of the
+                  tenant ID, its rate-limit class, its number of
+                  buckets, and the total size of its bucket set and
+                  buckets.
+        """
+
+        count = 0
+        tenants = []
+        for keys in self._scan('bucket_set:*'):
+            count += len(keys)
+            batch = [key[len('bucket_set:'):] for key in keys]
+            batch = [tenant for tenant in batch if self.sampled(tenant)]
+            if not batch:
+                continue
+
+            # Get the classes, the buckets, and the bucket set sizes
+            pipe = self.db.pipeline(transaction=False)
+            for tenant in batch:
+                pipe.get('limit-class:%s' % tenant)
+                pipe.zrange('bucket_set:%s' % tenant, 0, -1)
+                self._measure(pipe, 'bucket_set:%s' % tenant)
+            results = pipe.execute()
+
+            # Measure the buckets
+            pipe = self.db.pipeline(transaction=False)
+            for i in range(len(batch)):
+                for bucket_key in results[3 * i + 1]:
+                    self._measure(pipe, bucket_key)
+            sizes = iter(pipe.execute())
+
+            for i, tenant in enumerate(batch):
+                bucket_keys = results[3 * i + 1]
+                size = self._size('bucket_set:%s' % tenant,
+                                  results[3 * i + 2])
+                for bucket_key in bucket_keys:
+                    size += self._size(bucket_key, next(sizes))
+                tenants.append((tenant, results[3 * i] or 'default',
+                                len(bucket_keys), size))
+
+        return count, tenants
+
+
+def _summarize_audit(class_keys, tenant_count, tenants, top=10):
+    """
+    Summarize the results of a memory audit.
+
+    :param class_keys: A tuple of the number of limit-class keys, the
+                       number sampled, and their total size, as
+                       returned by _MemoryAudit.audit_classes().
+    :param tenant_count: The number of tenants with buckets.
+    :param tenants: The sampled tenants, as returned by
+                    _MemoryAudit.audit_tenants().
+    :param top: The maximum number of outliers to report.
+
+    :returns: A dictionary summarizing the audit.
+    """
+
+    count, sampled, size = class_keys
+    summary = dict(
+        limit_class=dict(
+            keys=count,
+            sampled=sampled,
+            average=float(size) / sampled if sampled else 0.0,
+        ),
+        tenants=tenant_count,
+        sampled=len(tenants),
+        classes={},
+        outliers=[],
+    )
+    summary['limit_class']['total'] = (summary['limit_class']['average'] *
+                                       count)
+
+    # Group the sampled tenants by class, and extrapolate
+    for tenant, klass, buckets, size in tenants:
+        stats = summary['classes'].setdefault(klass, dict(
+            sampled=0, buckets=0, size=0))
+        stats['sampled'] += 1
+        stats['buckets'] += buckets
+        stats['size'] += size
+    for stats in summary['classes'].values():
+        stats['tenants'] = (float(tenant_count) * stats['sampled'] /
+                            len(tenants))
+        stats['average'] = float(stats['size']) / stats['sampled']
+        stats['buckets'] = float(stats['buckets']) / stats['sampled']
+        stats['total'] = stats['average'] * stats['tenants']
+
+    # Find the tenants using more than 3 standard deviations above the
+    # mean
+    if tenants:
+        sizes = [size for _tenant, _klass, _buckets, size in tenants]
+        mean = float(sum(sizes)) / len(sizes)
+        stddev = math.sqrt(sum((x - mean) ** 2 for x in sizes) / len(sizes))
+        outliers = sorted((t for t in tenants if t[3] > mean + 3 * stddev),
+                          key=lambda t: -t[3])
+        summary['outliers'] = [
+            dict(tenant=tenant, klass=klass, buckets=buckets, size=size)
+            for tenant, klass, buckets, size in outliers[:top]]
+
+    return summary
+
+
+def _project_audit(summary, history, days):
+    """
+    Project the growth in memory use from the previous audit recorded
+    in a history file, and record this audit in the history file.
+
+    :param summary: The summary of the audit, as returned by
+                    _summarize_audit().  Projections are added to it.
+    :param history: The name of the history file.  Each line contains
+                    a JSON object recording the time of an audit and
+                    the total memory use of each class.
+    :param days: The number of days ahead to project memory use.
+    """
+
+    record = dict(
+        time=summary['time'],
+        limit_class=summary['limit_class']['total'],
+        classes=dict((klass, stats['total'])
+                     for klass, stats in summary['classes'].items()),
+    )
+
+    # Find the previous audit
+    previous = None
+    if os.path.exists(history):
+        with open(history) as f:
+            for line in f:
+                if line.strip():
+                    previous = json.loads(line)
+
+    # Project the growth
+    if previous and previous['time'] < record['time']:
+        elapsed = (record['time'] - previous['time']) / 86400.0
+        summary['days'] = days
+        totals = [(summary['limit_class'], record['limit_class'],
+                   previous['limit_class'])]
+        for klass, stats in summary['classes'].items():
+            totals.append((stats, record['classes'][klass],
+                           previous['classes'].get(klass, 0.0)))
+
+        for stats, current, last in totals:
+            stats['growth'] = (current - last) / elapsed
+            stats['projected'] = max(current + stats['growth'] * days, 0.0)
+
+    with open(history, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def _report_audit(args, result):
+    """
+    Report the results of a memory audit.  This is a postprocessor
+    for the limit_class_audit() function, when being called in
+    console script mode.
+
+    :param args: A Namespace object.
+    :param result: The result of the limit_class_audit() function
+                   call.  This will be a dictionary, or an error
+                   message.
+
+    :returns: None to indicate success, or the error message.
+    """
+
+    if isinstance(result, basestring):
+        return result
+
+    projected = 'days' in result
+    print "Memory use measured with %s; sampled %d of %d tenant(s)" % (
+        result['method'], result['sampled'], result['tenants'])
+
+    lc = result['limit_class']
+    print
+    print "limit-class keys: %d, average %.0f bytes, total %.0f bytes" % (
+        lc['keys'], lc['average'], lc['total'])
+    if projected:
+        print "    growth %.0f bytes/day, projected %.0f bytes in %d days" % (
+            lc['growth'], lc['projected'], result['days'])
+
+    print
+    header = "%-20s %10s %10s %12s %14s" % (
+        'class', 'tenants', 'buckets', 'avg bytes', 'total bytes')
+    if projected:
+        header += " %12s %14s" % ('bytes/day', 'in %d days' % result['days'])
+    print header
+    for klass, stats in sorted(result['classes'].items()):
+        line = "%-20s %10d %10.1f %12.0f %14.0f" % (
+            klass, stats['tenants'], stats['buckets'], stats['average'],
+            stats['total'])
+        if projected:
+            line += " %12.0f %14.0f" % (stats['growth'], stats['projected'])
+        print line
+
+    if result['outliers']:
+        print
+        print "Outliers (more than 3 standard deviations above the mean):"
+        for outlier in result['outliers']:
+            print "    %-30s %-20s %6d bucket(s) %10d bytes" % (
+                outlier['tenant'], outlier['klass'], outlier['buckets'],
+                outlier['size'])
+
+    return None
+
+
+@tools.add_argument('conf_file',
+                    metavar='config',
+                    help="Name of the configuration file, for connecting "
+                    "to the Redis database.")
+@tools.add_argument('--sample', '-s',
+                    type=float,
+                    action='store',
+                    default=0.1,
+                    help="Fraction of the tenants to sample.  Defaults to "
+                    "0.1.")
+@tools.add_argument('--batch', '-b',
+                    dest='batch_size',
+                    type=int,
+                    action='store',
+                    default=100,
+                    help="Number of keys to process at a time.  Defaults "
+                    "to 100.")
+@tools.add_argument('--pause', '-p',
+                    type=float,
+                    action='store',
+                    default=0.1,
+                    help="Seconds to pause after each batch, to limit the "
+                    "load on the database.  Defaults to 0.1.")
+@tools.add_argument('--top', '-t',
+                    type=int,
+                    action='store',
+                    default=10,
+                    help="Maximum number of outliers to report.  Defaults "
+                    "to 10.")
+@tools.add_argument('--history', '-H',
+                    action='store',
+                    default=None,
+                    help="Name of a file recording the results of each "
+                    "audit.  If given, growth is projected from the "
+                    "previous audit.")
+@tools.add_argument('--days', '-D',
+                    type=int,
+                    action='store',
+                    default=30,
+                    help="Number of days ahead to project growth.  "
+                    "Defaults to 30.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_postprocessor(_report_audit)
+def limit_class_audit(conf_file, sample=0.1, batch_size=100, pause=0.1,
+                      top=10, history=None, days=30):
+    """
+    Audit the memory used by the nova_limits keys in the Redis
+    database, grouped by rate-limit class.
+
+    :param conf_file: Name of the configuration file, for connecting
+                      to the Redis database.
+    :param sample: The fraction of the tenants to sample.
+    :param batch_size: The number of keys to process at a time.
+    :param pause: The number of seconds to pause after each batch.
+    :param top: The maximum number of outliers to report.
+    :param history: If given, the name of a file recording the
+                    results of each audit, from which growth is
+                    projected.
+    :param days: The number of days ahead to project growth.
+
+    Returns a dictionary summarizing the audit; see
+    _summarize_audit() and _project_audit().
+    """
+
+    # Connect to the database...
+    conf = config.Config(conf_file=conf_file)
+    db = conf.get_database()
+
+    audit = _MemoryAudit(db, sample, batch_size, pause)
+    class_keys = audit.audit_classes()
+    tenant_count, tenants = audit.audit_tenants()
+
+    summary = _summarize_audit(class_keys, tenant_count, tenants, top)
+    summary['method'] = audit.method
+    summary['time'] = time.time()
+
+    if history:
+        _project_audit(summary, history, days)
+
+    return summary
+
+
+class _Simulator(object):
+    """
+    Replays requests through a set of limits, offline, for the
+    limit_class_simulate command.  Requests are processed in batches:
+    each request is matched against the limits, and the resulting
+    bucket updates are applied together.  If numpy is available, the
+    bucket updates of a batch are applied as array operations;
+    otherwise, they are applied one at a time.
+    """
+
+    # The smallest round of bucket updates worth applying as array
+    # operations, and the smallest fraction of a batch's updates which
+    # must be applied in such rounds for them to be worth the cost of
+    # setting up; see _apply_vector()
+    min_round = 64
+    min_vector = 0.75
+
+    def __init__(self, lims, classes=None, class_parents='',
+                 vectorize=True, cache_size=100000):
+        """
+        Initialize a _Simulator.
+
+        :param lims: The list of limits, in order.
+        :param classes: A dictionary mapping tenant IDs to rate-limit
+                        classes.  Tenants not listed have the
+                        "default" class.
+        :param class_parents: The rate-limit class inheritance, as for
+                              the "class_parents" option.
+        :param vectorize: If False, numpy is not used even if it is
+                          available.
+        :param cache_size: The maximum number of request paths for
+                           which the matching limits are cached.
+        """
+
+        self.limits = lims
+        self.classes = classes or {}
+        self.cache_size = cache_size
+
+        # Only import numpy if we're actually going to use it
+        self.numpy = None
+        if vectorize:
+            try:
+                import numpy
+                self.numpy = numpy
+            except ImportError:
+                pass
+
+        # Class inheritance is resolved as for nova_preprocess()
+        self.state = _NovaState(config.Config(conf_dict={
+            'nova_limits.class_parents': class_parents,
+        }))
+        self.source = _LimitSource(lims, 'simulation')
+
+        # Set up a mapper which finds all the limits matching a path
+        self.mapper = routes.Mapper(register=False)
+        for idx, lim in enumerate(lims):
+            kwargs = dict(conditions=dict(function=self._candidate(idx)))
+            if lim.verbs:
+                kwargs['conditions']['method'] = lim.verbs
+            if lim.requirements:
+                kwargs['requirements'] = lim.requirements
+            self.mapper.connect(None, lim.route(lim.uri, kwargs), **kwargs)
+        self.matches = {}
+
+        # The buckets, indexed by limit and parameters, and their
+        # state, as parallel arrays
+        self.buckets = {}
+        self.last = self._array(0)
+        self.level = self._array(0)
+
+        # The results
+        self.requests = 0
+        self.rejected = 0
+        self.skipped = 0
+        self.class_counts = {}
+        self.tenant_counts = {}
+        self.limit_counts = [[0, 0] for _lim in lims]
+
+    def _array(self, count):
+        """
+        Allocate an array of bucket state.  Buckets which have never
+        been updated have a state of NaN.
+
+        :param count: The number of buckets.
+        """
+
+        if self.numpy:
+            return self.numpy.empty(count) + float('nan')
+        return array.array('d', [float('nan')]) * count
+
+    def _candidate(self, idx):
+        """
+        Construct a route condition which collects the limit and the
+        route parameters, then continues the route scan.
+
+        :param idx: The index of the limit.
+        """
+
+        def condition(environ, match_dict):
+            environ['nova_limits.candidates'].append((idx, match_dict))
+            return False
+
+        return condition
+
+    def _match(self, verb, path):
+        """
+        Find the limits matching a request, ignoring the rate-limit
+        class and the queries.  Everything about a limit which does
+        not depend on the tenant is computed here, so that it is
+        cached with the match.
+
+        :param verb: The HTTP verb of the request.
+        :param path: The path of the request, without the query
+                     string.
+
+        :returns: A list of tuples of the limit index, the route
+                  parameters used by the limit, the amount by which
+                  the request raises the water level, the capacity
+                  and epsilon of the bucket, the queries required by
+                  the limit, the limit's rate-limit class (None for
+                  limits which are not NovaClassLimit limits), the
+                  limit's UUID, and whether the limit continues the
+                  scan.
+        """
+
+        candidates = self.matches.get((verb, path))
+        if candidates is None:
+            if len(self.matches) >= self.cache_size:
+                self.matches.clear()
+
+            environ = {
+                'REQUEST_METHOD': verb,
+                'PATH_INFO': path,
+                'nova_limits.candidates': [],
+            }
+            self.mapper.routematch(environ=environ)
+
+            candidates = []
+            for idx, match_dict in environ['nova_limits.candidates']:
+                lim = self.limits[idx]
+                params = tuple(sorted((key, value) for key, value in
+                                      match_dict.items() if key in lim.use))
+                if isinstance(lim, NovaClassLimit):
+                    rate_class = lim.rate_class
+                    water = lim.unit_cost * lim.units(verb)
+                else:
+                    rate_class = None
+                    water = lim.cost
+                candidates.append((idx, params, water, float(lim.unit_value),
+                                   lim.bucket_class.eps,
+                                   frozenset(lim.queries), rate_class,
+                                   lim.uuid, lim.continue_scan))
+            self.matches[(verb, path)] = candidates
+
+        return candidates
+
+    def _updates(self, tenant, klass, verb, path):
+        """
+        Determine the bucket updates for a request, as NovaClassLimit
+        would make them.
+
+        :param tenant: The ID of the tenant.
+        :param klass: The name of the rate-limit class.
+        :param verb: The HTTP verb of the request.
+        :param path: The path of the request, which may include a
+                     query string.
+
+        :returns: A list of tuples of the limit index, the bucket
+                  index, the amount by which the request raises the
+                  water level, the capacity of the bucket, and the
+                  epsilon.
+        """
+
+        path, _sep, query = _strip_version(path).partition('?')
+        available = None
+        limit_set = None
+        if self.state.class_parents:
+            limit_set = self.state.get_limit_set(self.source, klass)
+
+        updates = []
+        for (idx, params, water, capacity, eps, queries, rate_class,
+             lim_uuid, continue_scan) in self._match(verb, path):
+            # Does the limit apply?
+            if queries:
+                if available is None:
+                    available = set(qstr.partition('=')[0]
+                                    for qstr in query.split('&'))
+                if not queries.issubset(available):
+                    continue
+            if rate_class is None:
+                bucket_key = (idx, params)
+            elif (lim_uuid in limit_set if limit_set is not None
+                  else rate_class == klass):
+                bucket_key = (idx, params, tenant)
+            else:
+                continue
+
+            # Find the bucket
+            bucket = self.buckets.get(bucket_key)
+            if bucket is None:
+                bucket = self.buckets[bucket_key] = len(self.buckets)
+
+            updates.append((idx, bucket, water, capacity, eps))
+
+            if not continue_scan:
+                break
+
+        return updates
+
+    def _grow(self):
+        """
+        Make room in the bucket state for any new buckets.
+        """
+
+        missing = len(self.buckets) - len(self.last)
+        if missing <= 0:
+            return
+
+        # Grow by at least half, so growth is amortized
+        missing = max(missing, len(self.last) // 2)
+        if self.numpy:
+            self.last = self.numpy.concatenate((self.last,
+                                                self._array(missing)))
+            self.level = self.numpy.concatenate((self.level,
+                                                 self._array(missing)))
+        else:
+            self.last.extend(self._array(missing))
+            self.level.extend(self._array(missing))
+
+    def _apply(self, buckets, times, water, capacity, eps, state=None):
+        """
+        Apply bucket updates in order, one at a time.  The arguments
+        are parallel sequences describing the updates.
+
+        :param buckets: The bucket indexes.
+        :param times: The times of the requests.
+        :param water: The amounts by which the requests raise the
+                      water levels.
+        :param capacity: The capacities of the buckets.
+        :param eps: The epsilons of the buckets.
+        :param state: A tuple of the lists of the last update times
+                      and the water levels of the buckets.  Defaults
+                      to the simulator's own.
+
+        :returns: A list of booleans indicating which updates were
+                  delayed.
+        """
+
+        last_arr, level_arr = state or (self.last, self.level)
+        delayed = []
+        for bucket, now, cost, cap, epsilon in zip(buckets, times, water,
+                                                   capacity, eps):
+            last = last_arr[bucket]
+            if last != last:
+                # A new bucket
+                last, level = now, 0.0
+            else:
+                level = level_arr[bucket]
+                if now < last:
+                    now = last
+            level = max(level - (now - last), 0.0)
+
+            if level + cost - cap >= epsilon:
+                delayed.append(True)
+            else:
+                delayed.append(False)
+                level += cost
+
+            last_arr[bucket] = now
+            level_arr[bucket] = level
+
+        return delayed
+
+    def _apply_vector(self, buckets, times, water, capacity, eps):
+        """
+        Apply bucket updates using numpy.  The updates are applied in
+        rounds: the first update to each bucket in the first round,
+        the second in the second, and so on, so that each round
+        updates each bucket at most once.  Each round costs a fixed
+        number of array operations, so only the rounds of at least
+        min_round updates are applied as array operations; the rounds
+        only get smaller, and the rest of the updates, which go to the
+        few buckets getting the most updates, are applied one at a
+        time by _apply().  If the rounds of array operations would
+        cover less than min_vector of the updates, all the updates are
+        applied by _apply().  See _apply() for the arguments.
+        """
+
+        np = self.numpy
+        bucket_arr = np.asarray(buckets, dtype=np.int64)
+        count = len(bucket_arr)
+
+        # The number of rounds of at least min_round updates is the
+        # min_round-th largest number of updates to a bucket
+        per_bucket = np.bincount(bucket_arr)
+        per_bucket = np.sort(per_bucket[per_bucket > 0])[::-1]
+        rounds = 0
+        if len(per_bucket) >= self.min_round:
+            rounds = int(per_bucket[self.min_round - 1])
+        if np.minimum(per_bucket, rounds).sum() < self.min_vector * count:
+            return self._apply_copy(bucket_arr, times, water, capacity, eps)
+
+        buckets = bucket_arr
+        times = np.asarray(times, dtype=np.float64)
+        water = np.asarray(water, dtype=np.float64)
+        capacity = np.asarray(capacity, dtype=np.float64)
+        eps = np.asarray(eps, dtype=np.float64)
+
+        # Rank each update among the updates to its bucket
+        order = np.argsort(buckets, kind='mergesort')
+        ordered = buckets[order]
+        index = np.arange(count)
+        starts = np.where(np.concatenate(([True],
+                                          ordered[1:] != ordered[:-1])),
+                          index, 0)
+        rank = np.empty(count, dtype=np.int64)
+        rank[order] = index - np.maximum.accumulate(starts)
+
+        # Group the updates by rank, preserving their order
+        by_rank = np.argsort(rank, kind='mergesort')
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(rank))))
+
+        delayed = np.zeros(count, dtype=bool)
+        for start, end in zip(bounds[:rounds], bounds[1:rounds + 1]):
+            sel = by_rank[start:end]
+            bucket = buckets[sel]
+            now = times[sel]
+
+            last = self.last[bucket]
+            new = np.isnan(last)
+            last = np.where(new, now, last)
+            level = np.where(new, 0.0, self.level[bucket])
+            now = np.maximum(now, last)
+            level = np.maximum(level - (now - last), 0.0)
+
+            over = level + water[sel] - capacity[sel] >= eps[sel]
+            self.last[bucket] = now
+            self.level[bucket] = np.where(over, level, level + water[sel])
+            delayed[sel] = over
+
+        # Apply the rest one at a time; each bucket's updates are
+        # still in order
+        sel = by_rank[bounds[rounds]:]
+        if len(sel):
+            delayed[sel] = self._apply_copy(
+                buckets[sel], times[sel].tolist(), water[sel].tolist(),
+                capacity[sel].tolist(), eps[sel].tolist())
+
+        return delayed.tolist()
+
+    def _apply_copy(self, buckets, times, water, capacity, eps):
+        """
+        Apply bucket updates in order, one at a time, when the bucket
+        state is kept in numpy arrays.  Indexing the arrays one
+        element at a time is slow, so the updates are applied to
+        lists copied from the state of the buckets involved, which
+        are then copied back.  See _apply() for the arguments; the
+        bucket indexes must be a numpy array.
+        """
+
+        np = self.numpy
+        present = np.bincount(buckets) > 0
+        uniq = np.flatnonzero(present)
+        local = (np.cumsum(present) - 1)[buckets]
+        state = (self.last[uniq].tolist(), self.level[uniq].tolist())
+        delayed = self._apply(local.tolist(), times, water, capacity, eps,
+                              state)
+        self.last[uniq], self.level[uniq] = state
+
+        return delayed
+
+    def run(self, events):
+        """
+        Replay a batch of requests.
+
+        :param events: A list of tuples of the time, the tenant ID,
+                       the HTTP verb, and the path of each request.
+                       The requests must be in time order.
+        """
+
+        # Determine the bucket updates for each request
+        requests = []
+        limit_idx, buckets, times, water, capacity, eps = (
+            [], [], [], [], [], [])
+        for now, tenant, verb, path in events:
+            klass = self.classes.get(tenant, 'default')
+            requests.append((tenant, klass, len(limit_idx)))
+            for update in self._updates(tenant, klass, verb, path):
+                limit_idx.append(update[0])
+                buckets.append(update[1])
+                times.append(now)
+                water.append(update[2])
+                capacity.append(update[3])
+                eps.append(update[4])
+        self._grow()
+
+        # Apply the updates
+        apply = self._apply_vector if self.numpy else self._apply
+        delayed = []
+        if limit_idx:
+            delayed = apply(buckets, times, water, capacity, eps)
+
+        # Tally the results; a request is rejected if any of its
+        # buckets delayed it
+        ends = [start for _tenant, _klass, start in requests[1:]]
+        ends.append(len(delayed))
+        for (tenant, klass, start), end in zip(requests, ends):
+            rejected = 0
+            for i in range(start, end):
+                stats = self.limit_counts[limit_idx[i]]
+                stats[0] += 1
+                if delayed[i]:
+                    stats[1] += 1
+                    rejected = 1
+
+            self.requests += 1
+            self.rejected += rejected
+            for counts, key in ((self.class_counts, klass),
+                                (self.tenant_counts, (tenant, klass))):
+                stats = counts.setdefault(key, [0, 0])
+                stats[0] += 1
+                stats[1] += rejected
+
+    def results(self, top=20):
+        """
+        Summarize the results of the simulation.
+
+        :param top: The maximum number of tenants to report.
+
+        :returns: A dictionary summarizing the results.
+        """
+
+        tenants = heapq.nlargest(
+            top, ((stats[1], tenant, klass, stats[0])
+                  for (tenant, klass), stats in self.tenant_counts.items()
+                  if stats[1]))
+
+        return dict(
+            requests=self.requests,
+            rejected=self.rejected,
+            skipped=self.skipped,
+            buckets=len(self.buckets),
+            classes=dict((klass, dict(requests=stats[0], rejected=stats[1]))
+                         for klass, stats in self.class_counts.items()),
+            tenants=[dict(tenant=tenant, klass=klass, requests=requests,
+                          rejected=rejected)
+                     for rejected, tenant, klass, requests in tenants],
+            limits=[dict(uri=lim.uri, verbs=lim.verbs,
+                         rate_class=getattr(lim, 'rate_class', None),
+                         value=lim.value, unit=lim.unit,
+                         requests=stats[0], rejected=stats[1])
+                    for lim, stats in zip(self.limits, self.limit_counts)],
+        )
+
+
+def _load_limits(limits_file):
+    """
+    Load the limits from a limits file, as used by the Turnstile
+    setup_limits command.
+
+    :param limits_file: The name of the XML limits file.
+
+    :returns: A list of limits.
+    """
+
+    # Only needed here
+    from lxml import etree
+
+    lims = []
+    for idx, lim in enumerate(etree.parse(limits_file).getroot()):
+        if lim.tag == 'limit':
+            lims.append(tools.parse_limit_node(None, idx, lim))
+
+    return lims
+
+
+def _load_classes(classes_file):
+    """
+    Load a mapping of tenants to rate-limit classes.  Each line of
+    the file contains a tenant ID and the name of its rate-limit
+    class; blank lines and lines beginning with "#" are ignored.
+
+    :param classes_file: The name of the file.
+
+    :returns: A dictionary mapping tenant IDs to rate-limit classes.
+    """
+
+    classes = {}
+    with open(classes_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2 and not fields[0].startswith('#'):
+                classes[fields[0]] = fields[1]
+
+    return classes
+
+
+def _read_events(simulator, files, batch_size):
+    """
+    Read requests from request logs, in batches.  Each line of a log
+    contains the time of a request (seconds since the epoch), the
+    tenant ID, the HTTP verb, and the path; blank lines and lines
+    beginning with "#" are ignored, and malformed lines are counted as
+    skipped.  Logs ending in ".gz" are decompressed.
+
+    :param simulator: The _Simulator, for counting skipped lines.
+    :param files: The names of the logs; "-" is standard input.
+    :param batch_size: The number of requests in each batch.
+
+    :returns: A generator of lists of requests, as expected by
+              _Simulator.run().
+    """
+
+    # Only needed here
+    import gzip
+
+    batch = []
+    for fname in files:
+        if fname == '-':
+            f = sys.stdin
+        elif fname.endswith('.gz'):
+            f = gzip.open(fname)
+        else:
+            f = open(fname)
+
+        try:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+
+                try:
+                    now, tenant, verb, path = fields
+                    batch.append((float(now), tenant, verb.upper(), path))
+                except ValueError:
+                    simulator.skipped += 1
+                    continue
+
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    if batch:
+        yield batch
+
+
+def _report_simulation(args, result):
+    """
+    Report the results of a simulation.  This is a postprocessor for
+    the limit_class_simulate() function, when being called in console
+    script mode.
+
+    :param args: A Namespace object.
+    :param result: The result of the limit_class_simulate() function
+                   call.  This will be a dictionary, or an error
+                   message.
+
+    :returns: None to indicate success, or the error message.
+    """
+
+    if isinstance(result, basestring):
+        return result
+
+    def pct(stats):
+        if not stats['requests']:
+            return 0.0
+        return 100.0 * stats['rejected'] / stats['requests']
+
+    print ("Replayed %d request(s), %d rejected (%.2f%%), using %d "
+           "bucket(s)" % (result['requests'], result['rejected'], pct(result),
+                          result['buckets']))
+    if result['skipped']:
+        print "Skipped %d malformed line(s)" % result['skipped']
+
+    print
+    print "%-20s %12s %12s %8s" % ('class', 'requests', 'rejected', 'pct')
+    for klass, stats in sorted(result['classes'].items()):
+        print "%-20s %12d %12d %7.2f%%" % (klass, stats['requests'],
+                                           stats['rejected'], pct(stats))
+
+    print
+    print "%-30s %-12s %-10s %12s %12s %8s" % (
+        'limit', 'class', 'value', 'requests', 'rejected', 'pct')
+    for lim in result['limits']:
+        desc = '%s %s' % (','.join(lim['verbs']) or '*', lim['uri'])
+        print "%-30s %-12s %-10s %12d %12d %7.2f%%" % (
+            desc, lim['rate_class'] or '-',
+            '%d/%s' % (lim['value'], lim['unit']), lim['requests'],
+            lim['rejected'], pct(lim))
+
+    if result['tenants']:
+        print
+        print "%-30s %-20s %12s %12s %8s" % (
+            'tenant', 'class', 'requests', 'rejected', 'pct')
+        for tenant in result['tenants']:
+            print "%-30s %-20s %12d %12d %7.2f%%" % (
+                tenant['tenant'], tenant['klass'], tenant['requests'],
+                tenant['rejected'], pct(tenant))
+
+    return None
+
+
+@tools.add_argument('limits_file',
+                    metavar='limits',
+                    help="Name of the XML file describing the limits, as "
+                    "used by the Turnstile setup_limits command.")
+@tools.add_argument('logs',
+                    metavar='log',
+                    nargs='+',
+                    help="Name of a request log to replay; \"-\" reads "
+                    "standard input.  Each line contains the time, tenant "
+                    "ID, HTTP verb, and path of a request, separated by "
+                    "whitespace, in time order.")
+@tools.add_argument('--classes', '-c',
+                    dest='classes_file',
+                    action='store',
+                    default=None,
+                    help="Name of a file mapping tenants to rate-limit "
+                    "classes; each line contains a tenant ID and a class. "
+                    " Tenants not listed have the \"default\" class.")
+@tools.add_argument('--parents', '-P',
+                    dest='class_parents',
+                    action='store',
+                    default='',
+                    help="Rate-limit class inheritance, as for the "
+                    "\"class_parents\" option, e.g., \"gold:default\".")
+@tools.add_argument('--batch', '-b',
+                    dest='batch_size',
+                    type=int,
+                    action='store',
+                    default=100000,
+                    help="Number of requests to replay at a time.  "
+                    "Defaults to 100000.")
+@tools.add_argument('--top', '-t',
+                    type=int,
+                    action='store',
+                    default=20,
+                    help="Maximum number of tenants to report.  Defaults "
+                    "to 20.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_postprocessor(_report_simulation)
+def limit_class_simulate(limits_file, logs, classes_file=None,
+                         class_parents='', batch_size=100000, top=20):
+    """
+    Replay request logs through a set of limits, offline, and report
+    the requests which would have been rejected.
+
+    :param limits_file: Name of the XML file describing the limits.
+    :param logs: A list of the names of the request logs.
+    :param classes_file: Name of a file mapping tenants to rate-limit
+                         classes.
+    :param class_parents: The rate-limit class inheritance, as for the
+                          "class_parents" option.
+    :param batch_size: The number of requests to replay at a time.
+    :param top: The maximum number of tenants to report.
+
+    Returns a dictionary summarizing the simulation; see
+    _Simulator.results().
+    """
+
+    classes = _load_classes(classes_file) if classes_file else {}
+    simulator = _Simulator(_load_limits(limits_file), classes,
+                           class_parents)
+
+    for batch in _read_events(simulator, logs, batch_size):
+        simulator.run(batch)
+
+    return simulator.results(top)
+
+
+def _report_profile(args, result):
+    """
+    Report the merged request profiles.  This is a postprocessor for
+    the limit_class_profile() function, when being called in console
+    script mode.
+
+    :param args: A Namespace object.
+    :param result: The result of the limit_class_profile() function
+                   call.  This will be a dict, or an error message.
+
+    :returns: None to indicate success, or the error message.
+    """
+
+    if isinstance(result, basestring):
+        return result
+
+    if not result['files']:
+        print "No request profiles found"
+        return None
+
+    print "Merged %d profile(s)" % result['files']
+    if args.output:
+        print "Wrote the merged profile to %s" % args.output
+    print
+
+    result['stats'].sort_stats(args.sort).print_stats(args.top)
+
+    return None
+
+
+@tools.add_argument('files',
+                    metavar='file',
+                    nargs='+',
+                    help="Request profile files, or directories "
+                    "containing them.")
+@tools.add_argument('--output', '-o',
+                    action='store',
+                    default=None,
+                    help="Name of a file to write the merged profile to, "
+                    "for further analysis with pstats.")
+@tools.add_argument('--sort', '-s',
+                    action='store',
+                    default='cumulative',
+                    help="Key to sort the report by, as for "
+                    "pstats.Stats.sort_stats().  Defaults to "
+                    "\"cumulative\".")
+@tools.add_argument('--top', '-t',
+                    type=int,
+                    action='store',
+                    default=20,
+                    help="Number of functions to report.  Defaults to 20.")
+@tools.add_argument('--debug', '-d',
+                    dest='debug',
+                    action='store_true',
+                    default=False,
+                    help="Run the tool in debug mode.")
+@tools.add_postprocessor(_report_profile)
+def limit_class_profile(files, output=None, sort='cumulative', top=20):
+    """
+    Merge the request profiles from several workers.
+
+    :param files: A list of profile files, or of directories
+                  containing profile files.
+    :param output: The name of a file to write the merged profile
+                   to.  Optional.
+    :param sort: The key to sort the report by.  Used only by the
+                 console script.
+    :param top: The number of functions to report.  Used only by the
+                console script.
+
+    Returns a dict with the keys "files" (the number of profile files
+    merged) and "stats" (a pstats.Stats object containing the merged
+    profiles, or None if there were no profiles).
+    """
+
+    # Only needed here
+    import pstats
+
+    names = []
+    for fname in files:
+        if os.path.isdir(fname):
+            names.extend(sorted(glob.glob(os.path.join(fname,
+                                                       'profile.*.prof'))))
+        else:
+            names.append(fname)
+
+    stats = None
+    if names:
+        stats = pstats.Stats(*names)
+        if output:
+            stats.dump_stats(output)
+
+    return dict(files=len(names), stats=stats)
@@ -53,6 +53,20 @@ setup(
     entry_points={
         'console_scripts': [
             'limit_class = nova_limits:limit_class.console',
+            'limit_class_table = nova_limits:limit_class_table.console',
+            'limit_class_hitters = nova_limits:limit_class_hitters.console',
+            'limit_class_filter = nova_limits:limit_class_filter.console',
+            'limit_class_server = nova_limits:limit_class_server.console',
+            'limit_class_usage = nova_limits:limit_class_usage.console',
+            'limit_class_audit = nova_limits:limit_class_audit.console',
+            'limit_class_simulate = nova_limits:limit_class_simulate.console',
+            'limit_class_profile = nova_limits:limit_class_profile.console',
+        ],
+        'turnstile.command': [
+            'profile = nova_limits:profile_command',
+        ],
+        'turnstile.connection_pool': [
+            'nova_limits = nova_limits:GreenConnectionPool',
         ],
         'turnstile.formatter': [
             'nova_limits = nova_limits:nova_formatter',
@@ -60,6 +74,9 @@ setup(
         'turnstile.limit': [
             'nova_limits = nova_limits:NovaClassLimit',
         ],
+        'turnstile.middleware': [
+            'nova_limits = nova_limits:NovaTurnstileMiddleware',
+        ],
         'turnstile.postprocessor': [
             'nova_limits = nova_limits:nova_postprocess',
         ],
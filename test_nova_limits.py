@@ -13,19 +13,47 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+import json
+import os
+import shutil
+import socket
 import StringIO
+import subprocess
 import sys
+import tempfile
 
+import eventlet
 import mock
+import msgpack
 from nova.api.openstack import wsgi
+import redis
 from turnstile import config
+from turnstile import database
 from turnstile import limits
+from turnstile import middleware
 from turnstile import tools
 import unittest2
 
 import nova_limits
 
 
+class TestImport(unittest2.TestCase):
+    def test_no_nova(self):
+        topdir = os.path.dirname(os.path.abspath(nova_limits.__file__))
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(
+            [topdir] + [p for p in [env.get('PYTHONPATH')] if p])
+
+        output = subprocess.Popen([
+            sys.executable, '-c',
+            "import sys; import nova_limits; "
+            "print sorted(m for m in sys.modules if m.startswith('nova.'))",
+        ], env=env, stdout=subprocess.PIPE).communicate()[0]
+
+        self.assertEqual(output, "[]\n")
+
+
 class TestParamsDict(unittest2.TestCase):
     def test_known_keys(self):
         d = nova_limits.ParamsDict(dict(a=1, bravo=2))
@@ -40,682 +68,4888 @@ class TestParamsDict(unittest2.TestCase):
         self.assertEqual(d['delta'], '{delta}')
 
 
-class TestPreprocess(unittest2.TestCase):
-    @mock.patch('time.time', return_value=1000000.0)
-    def test_basic(self, mock_time):
-        db = mock.Mock(**{'get.return_value': None})
-        midware = mock.Mock(db=db)
-        environ = {}
+class TestClassTable(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'classes')
 
-        nova_limits.nova_preprocess(midware, environ)
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
 
-        self.assertDictContainsSubset({
-            'turnstile.nova.tenant': '<NONE>',
-            'turnstile.nova.limitclass': 'default',
-            'turnstile.bucket_set': 'bucket_set:<NONE>',
-        }, environ)
-        db.assert_has_calls([
-            mock.call.get('limit-class:<NONE>'),
-            mock.call.zremrangebyscore('bucket_set:<NONE>', 0, 1000000.0),
+    def test_write(self):
+        result = nova_limits.ClassTable.write(self.path, dict(
+            spam='gold',
+            eggs='platinum',
+            bacon='default',
+        ), now=1000000.0)
+
+        self.assertEqual(result, 2)
+        self.assertEqual(os.listdir(self.tmpdir), ['classes'])
+        with open(self.path, 'rb') as f:
+            header = nova_limits.ClassTable.header.unpack(
+                f.read(nova_limits.ClassTable.header.size))
+        self.assertEqual(header, ('NLCLSTB1', 1000000.0, 2))
+
+    def test_lookup(self):
+        tenants = dict(('tenant%d' % i, 'class%d' % (i % 7))
+                       for i in range(100))
+        nova_limits.ClassTable.write(self.path, tenants)
+        table = nova_limits.ClassTable(self.path)
+
+        for tenant, klass in tenants.items():
+            self.assertEqual(table.lookup(tenant), klass)
+        self.assertEqual(table.lookup('other'), 'default')
+        self.assertEqual(table.lookup(u'tenant5'), 'class5')
+
+    def test_lookup_missing(self):
+        table = nova_limits.ClassTable(self.path)
+
+        self.assertEqual(table.lookup('spam'), None)
+
+    def test_lookup_corrupt(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a class table')
+        table = nova_limits.ClassTable(self.path)
+
+        self.assertEqual(table.lookup('spam'), None)
+
+    def test_lookup_stale(self):
+        nova_limits.ClassTable.write(self.path, dict(spam='gold'),
+                                     now=1000000.0)
+        table = nova_limits.ClassTable(self.path, max_age=300)
+
+        self.assertEqual(table.lookup('spam', now=1000300.0), 'gold')
+        self.assertEqual(table.lookup('spam', now=1000301.0), None)
+
+    def test_lookup_replaced(self):
+        nova_limits.ClassTable.write(self.path, dict(spam='gold'))
+        table = nova_limits.ClassTable(self.path, recheck=0)
+
+        self.assertEqual(table.lookup('spam'), 'gold')
+
+        nova_limits.ClassTable.write(self.path, dict(spam='platinum',
+                                                     eggs='gold'))
+
+        self.assertEqual(table.lookup('spam'), 'platinum')
+        self.assertEqual(table.lookup('eggs'), 'gold')
+
+    def test_lookup_recheck(self):
+        nova_limits.ClassTable.write(self.path, dict(spam='gold'))
+        table = nova_limits.ClassTable(self.path, recheck=60)
+
+        self.assertEqual(table.lookup('spam', now=1000000.0), 'gold')
+
+        os.unlink(self.path)
+
+        self.assertEqual(table.lookup('spam', now=1000059.0), 'gold')
+        self.assertEqual(table.lookup('spam', now=1000060.0), None)
+
+
+class TestExpiringCache(unittest2.TestCase):
+    def test_lookup(self):
+        cache = nova_limits.ExpiringCache(10)
+        cache.store('spam', 'value', 1000000.0)
+
+        self.assertEqual(cache.lookup('spam', 999999.0), 'value')
+        self.assertEqual(cache.lookup('spam', 1000000.0), None)
+        self.assertEqual(cache.lookup('eggs', 999999.0), None)
+
+    def test_store_evict(self):
+        cache = nova_limits.ExpiringCache(2)
+
+        cache.store('spam', 'value1', 1000000.0)
+        cache.store('eggs', 'value2', 1000000.0)
+        cache.store('spam', 'value3', 1000000.0)
+        cache.store('bacon', 'value4', 1000000.0)
+
+        self.assertEqual(cache.items(), [
+            ('spam', ('value3', 1000000.0)),
+            ('bacon', ('value4', 1000000.0)),
         ])
 
-    @mock.patch('time.time', return_value=1000000.0)
-    def test_tenant(self, mock_time):
+
+class TestClassFilter(unittest2.TestCase):
+    def test_add_contains(self):
+        class_filter = nova_limits.ClassFilter(bytearray(1024))
+
+        for i in range(50):
+            class_filter.add('tenant%d' % i)
+
+        for i in range(50):
+            self.assertIn('tenant%d' % i, class_filter)
+        self.assertIn(u'tenant5', class_filter)
+        misses = sum(1 for i in range(1000)
+                     if 'other%d' % i not in class_filter)
+        self.assertGreater(misses, 990)
+
+    def test_bit_numbering(self):
+        class_filter = nova_limits.ClassFilter(bytearray(16))
+
+        class_filter.add('spam')
+
+        # Bits are numbered as by SETBIT: bit 0 is the high bit of
+        # the first byte
+        expected = bytearray(16)
+        for idx in nova_limits.ClassFilter._indexes(16, 'spam'):
+            expected[idx // 8] |= 1 << (7 - idx % 8)
+        self.assertEqual(class_filter.bits, expected)
+
+    def test_load(self):
+        db = mock.Mock(**{'get.return_value': '\xff' * 4})
+
+        result = nova_limits.ClassFilter.load(db)
+
+        db.get.assert_called_once_with('limit-class-filter')
+        self.assertEqual(result.bits, bytearray('\xff' * 4))
+        self.assertIn('spam', result)
+
+    def test_load_missing(self):
         db = mock.Mock(**{'get.return_value': None})
-        midware = mock.Mock(db=db)
-        environ = {
-            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
-        }
 
-        nova_limits.nova_preprocess(midware, environ)
+        self.assertEqual(nova_limits.ClassFilter.load(db), None)
+
+    def test_save(self):
+        db = mock.Mock()
+        class_filter = nova_limits.ClassFilter(bytearray(4))
+        class_filter.add('spam')
+
+        with mock.patch('os.getpid', return_value=1234):
+            class_filter.save(db)
 
-        self.assertDictContainsSubset({
-            'turnstile.nova.tenant': 'spam',
-            'turnstile.nova.limitclass': 'default',
-            'turnstile.bucket_set': 'bucket_set:spam',
-        }, environ)
         db.assert_has_calls([
-            mock.call.get('limit-class:spam'),
-            mock.call.zremrangebyscore('bucket_set:spam', 0, 1000000.0),
+            mock.call.set('limit-class-filter:1234', str(class_filter.bits)),
+            mock.call.rename('limit-class-filter:1234', 'limit-class-filter'),
         ])
 
-    @mock.patch('time.time', return_value=1000000.0)
-    def test_configured_class(self, mock_time):
-        db = mock.Mock(**{'get.return_value': 'lim_class'})
-        midware = mock.Mock(db=db)
-        environ = {
-            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
-        }
+    def test_update(self):
+        db = mock.Mock(**{'strlen.return_value': 16})
+        pipe = db.pipeline.return_value
 
-        nova_limits.nova_preprocess(midware, environ)
+        nova_limits.ClassFilter.update(db, 'spam')
 
-        self.assertDictContainsSubset({
-            'turnstile.nova.tenant': 'spam',
-            'turnstile.nova.limitclass': 'lim_class',
-            'turnstile.bucket_set': 'bucket_set:spam',
-        }, environ)
-        db.assert_has_calls([
-            mock.call.get('limit-class:spam'),
-            mock.call.zremrangebyscore('bucket_set:spam', 0, 1000000.0),
-        ])
+        db.strlen.assert_called_once_with('limit-class-filter')
+        db.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(pipe.setbit.call_args_list, [
+            mock.call('limit-class-filter', idx, 1)
+            for idx in nova_limits.ClassFilter._indexes(16, 'spam')])
+        pipe.execute.assert_called_once_with()
 
-    @mock.patch('time.time', return_value=1000000.0)
-    def test_configured_class_quotaclass(self, mock_time):
-        db = mock.Mock(**{'get.return_value': 'lim_class'})
-        midware = mock.Mock(db=db)
-        environ = {
-            'nova.context': mock.Mock(project_id='spam', quota_class=None,
-                                      spec=['project_id', 'quota_class']),
-        }
+    def test_update_not_built(self):
+        db = mock.Mock(**{'strlen.return_value': 0})
 
-        nova_limits.nova_preprocess(midware, environ)
+        nova_limits.ClassFilter.update(db, 'spam')
 
-        self.assertDictContainsSubset({
-            'turnstile.nova.tenant': 'spam',
-            'turnstile.nova.limitclass': 'lim_class',
-            'turnstile.bucket_set': 'bucket_set:spam',
-        }, environ)
-        db.assert_has_calls([
-            mock.call.get('limit-class:spam'),
-            mock.call.zremrangebyscore('bucket_set:spam', 0, 1000000.0),
-        ])
-        self.assertEqual(environ['nova.context'].quota_class, 'lim_class')
+        self.assertFalse(db.pipeline.called)
+
+    def test_update_many(self):
+        db = mock.Mock(**{'strlen.return_value': 16})
+        pipe = db.pipeline.return_value
+
+        nova_limits.ClassFilter.update(db, 'spam', 'eggs')
+
+        db.strlen.assert_called_once_with('limit-class-filter')
+        self.assertEqual(pipe.setbit.call_count,
+                         2 * nova_limits.ClassFilter.hashes)
+        pipe.execute.assert_called_once_with()
+
+    def test_update_none(self):
+        db = mock.Mock(**{'strlen.return_value': 16})
+
+        nova_limits.ClassFilter.update(db)
+
+        self.assertFalse(db.pipeline.called)
+
+
+class TestCountMinSketch(unittest2.TestCase):
+    def test_add_estimate(self):
+        sketch = nova_limits.CountMinSketch(64, 4)
+
+        for i in range(10):
+            self.assertEqual(sketch.add('spam'), i + 1)
+        sketch.add('eggs', 3)
+
+        self.assertGreaterEqual(sketch.estimate('spam'), 10)
+        self.assertGreaterEqual(sketch.estimate('eggs'), 3)
+        self.assertEqual(sketch.estimate(u'spam'), sketch.estimate('spam'))
+        self.assertEqual(sum(sketch.rows[0]), 13)
+
+    def test_merge(self):
+        sketch1 = nova_limits.CountMinSketch(64, 4)
+        sketch2 = nova_limits.CountMinSketch(64, 4)
+        sketch1.add('spam', 5)
+        sketch2.add('spam', 7)
+
+        sketch1.merge(sketch2)
+
+        self.assertGreaterEqual(sketch1.estimate('spam'), 12)
+        self.assertEqual(sum(sketch1.rows[0]), 12)
+
+    def test_merge_mismatch(self):
+        sketch1 = nova_limits.CountMinSketch(64, 4)
+        sketch2 = nova_limits.CountMinSketch(32, 4)
+
+        self.assertRaises(ValueError, sketch1.merge, sketch2)
+
+
+class TestTopK(unittest2.TestCase):
+    def test_add(self):
+        topk = nova_limits.TopK(3, 1024, 4)
+
+        for i in range(10):
+            for _j in range(i + 1):
+                topk.add('tenant%d' % i)
+
+        self.assertEqual([key for key, _count in topk.items()],
+                         ['tenant9', 'tenant8', 'tenant7'])
+        self.assertLessEqual(len(topk._heap), 12)
+
+    def test_hydrate(self):
+        topk = nova_limits.TopK(2, 64, 2)
+        topk.add('spam', 5)
+        topk.add('eggs', 3)
+
+        result = nova_limits.TopK.hydrate(topk.dehydrate())
+
+        self.assertEqual(result.top, 2)
+        self.assertEqual(result.items(), topk.items())
+        self.assertEqual(result.sketch.rows, topk.sketch.rows)
+
+    def test_merge(self):
+        topk1 = nova_limits.TopK(2, 1024, 4)
+        topk2 = nova_limits.TopK(2, 1024, 4)
+        topk1.add('spam', 5)
+        topk1.add('eggs', 3)
+        topk2.add('bacon', 4)
+        topk2.add('eggs', 3)
+
+        topk1.merge(topk2)
 
+        self.assertEqual(topk1.items(), [('eggs', 6), ('spam', 5)])
+
+
+class TestHeavyHitters(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_count(self):
+        hitters = nova_limits.HeavyHitters(top=2, now=1000000.0)
+
+        hitters.request('spam', 'default', 1000001.0)
+        hitters.request('spam', 'default', 1000002.0)
+        hitters.request('eggs', 'gold', 1000003.0)
+        hitters.reject('spam', 'default')
+
+        self.assertEqual(hitters.requests.items(), [('spam', 2), ('eggs', 1)])
+        self.assertEqual(hitters.rejections.items(), [('spam', 1)])
+        self.assertEqual(hitters.classes, dict(default=[2, 1], gold=[1, 0]))
+
+    @mock.patch('os.getpid', return_value=1234)
+    def test_dump_file(self, mock_getpid):
+        hitters = nova_limits.HeavyHitters(self.tmpdir, 60, top=2,
+                                           now=1000000.0)
+        hitters.request('spam', 'default', 1000001.0)
+
+        hitters.request('eggs', 'default', 1000060.0)
+
+        path = os.path.join(self.tmpdir, 'hitters.1234.json')
+        dump = list(nova_limits._load_hitters([path]))
+        self.assertEqual(len(dump), 1)
+        self.assertEqual(dump[0]['start'], 1000000.0)
+        self.assertEqual(dump[0]['end'], 1000060.0)
+        self.assertEqual(dump[0]['classes'], dict(default=[1, 0]))
+        self.assertEqual(dump[0]['requests']['candidates'], ['spam'])
+        self.assertEqual(hitters.start, 1000060.0)
+        self.assertEqual(hitters.requests.items(), [('eggs', 1)])
+
+    @mock.patch('socket.socket')
+    def test_dump_socket(self, mock_socket):
+        sock = mock_socket.return_value
+        hitters = nova_limits.HeavyHitters('unix:/spam/sock', 60,
+                                           now=1000000.0)
+
+        hitters.dump(1000010.0)
+
+        sock.settimeout.assert_called_once_with(1.0)
+        sock.connect.assert_called_once_with('/spam/sock')
+        self.assertTrue(sock.sendall.call_args[0][0].endswith('\n'))
+        sock.close.assert_called_once_with()
+        self.assertEqual(hitters.start, 1000010.0)
+
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    @mock.patch('socket.socket')
+    def test_dump_socket_timeout(self, mock_socket, mock_exception):
+        sock = mock_socket.return_value
+        sock.sendall.side_effect = socket.timeout('timed out')
+        hitters = nova_limits.HeavyHitters('unix:/spam/sock', 60,
+                                           timeout=0.25, now=1000000.0)
+        hitters.request('spam', 'default', 1000001.0)
+
+        hitters.dump(1000010.0)
+
+        sock.settimeout.assert_called_once_with(0.25)
+        sock.close.assert_called_once_with()
+        mock_exception.assert_called_once_with(
+            "Failed to send heavy hitters to unix:/spam/sock; "
+            "dropping the dump")
+        self.assertEqual(hitters.start, 1000010.0)
+        self.assertEqual(hitters.requests.items(), [])
+
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    def test_dump_error(self, mock_exception):
+        hitters = nova_limits.HeavyHitters(
+            os.path.join(self.tmpdir, 'missing'), 60, now=1000000.0)
+
+        hitters.dump(1000010.0)
+
+        self.assertEqual(mock_exception.call_count, 1)
+        self.assertEqual(hitters.start, 1000010.0)
+
+
+class TestGreenConnectionPool(unittest2.TestCase):
+    def _make_pool(self, **kwargs):
+        connection_class = mock.Mock(side_effect=lambda **kw: mock.Mock(
+            pid=os.getpid()))
+        return nova_limits.GreenConnectionPool(
+            connection_class=connection_class, **kwargs)
+
+    def test_init(self):
+        pool = self._make_pool(max_connections='5', timeout='2.5',
+                               host='localhost')
+
+        self.assertEqual(pool.max_connections, 5)
+        self.assertEqual(pool.timeout, 2.5)
+        self.assertEqual(pool.queue_class, eventlet.queue.LifoQueue)
+        self.assertEqual(pool.connection_kwargs, dict(host='localhost'))
+
+    def test_init_no_timeout(self):
+        pool = self._make_pool(timeout='None')
+
+        self.assertEqual(pool.timeout, None)
+
+    def test_reuse(self):
+        pool = self._make_pool(max_connections=2)
+
+        conn1 = pool.get_connection('GET')
+        conn2 = pool.get_connection('GET')
+        pool.release(conn1)
+        pool.release(conn2)
+
+        self.assertIs(pool.get_connection('GET'), conn2)
+        self.assertIs(pool.get_connection('GET'), conn1)
+        self.assertEqual(pool.connection_class.call_count, 2)
+
+    def test_exhausted(self):
+        pool = self._make_pool(max_connections=1, timeout=0.01)
+
+        pool.get_connection('GET')
+
+        self.assertRaises(redis.ConnectionError, pool.get_connection, 'GET')
+
+    def test_green_wait(self):
+        pool = self._make_pool(max_connections=1, timeout=1)
+        conn = pool.get_connection('GET')
+
+        waiter = eventlet.spawn(pool.get_connection, 'GET')
+        eventlet.sleep(0)
+        pool.release(conn)
+
+        self.assertIs(waiter.wait(), conn)
+        self.assertEqual(pool.connection_class.call_count, 1)
+
+
+class TestInFlightLimit(unittest2.TestCase):
+    def test_init(self):
+        lim = nova_limits.InFlightLimit('db', 'class', 'gold', 10)
+
+        self.assertEqual(lim.db, 'db')
+        self.assertEqual(lim.scope, 'class')
+        self.assertEqual(lim.name, 'gold')
+        self.assertEqual(lim.value, 10)
+
+    def test_format(self):
+        lim = nova_limits.InFlightLimit('db', 'class', 'gold', 10)
+        headers = {}
+
+        result = lim.format('413 Request Entity Too Large', headers, {},
+                            None, 1)
+
+        self.assertEqual(result, (
+            '413 Request Entity Too Large',
+            "Only 10 request(s) can be in progress at once for this class."))
+        self.assertEqual(headers, {'Content-Type': 'text/plain'})
+
+
+class TestInFlight(unittest2.TestCase):
+    def test_init_defaults(self):
+        inflight = nova_limits.InFlight()
+
+        self.assertEqual(inflight.tenant_limits, {})
+        self.assertEqual(inflight.class_limits, {})
+        self.assertEqual(inflight.shared, False)
+        self.assertEqual(inflight.ttl, 300)
+        self.assertEqual(inflight.retry, 1.0)
+        self.assertEqual(inflight.counts, {})
+
+    def test_parse(self):
+        self.assertEqual(nova_limits.InFlight.parse(''), {})
+        self.assertEqual(nova_limits.InFlight.parse('default:2, gold:5'),
+                         dict(default=2, gold=5))
+
+    def test_unlimited(self):
+        inflight = nova_limits.InFlight(dict(gold=1), dict(gold=1))
+
+        release, limit = inflight.acquire('db', 'spam', 'default')
+
+        self.assertEqual(limit, None)
+        self.assertEqual(inflight.counts, {})
+        release()
+
+    def test_local(self):
+        inflight = nova_limits.InFlight(dict(gold=2), dict(gold=3))
+
+        releases = [inflight.acquire('db', tenant, 'gold')[0]
+                    for tenant in ('spam', 'spam', 'eggs')]
+
+        self.assertEqual(inflight.counts, {
+            'inflight:spam': 2,
+            'inflight:eggs': 1,
+            'inflight-class:gold': 3,
+        })
+
+        release, limit = inflight.acquire('db', 'spam', 'gold')
+
+        self.assertEqual(release, None)
+        self.assertEqual((limit.db, limit.scope, limit.name, limit.value),
+                         ('db', 'tenant', 'spam', 2))
+
+        release, limit = inflight.acquire('db', 'foo', 'gold')
+
+        self.assertEqual(release, None)
+        self.assertEqual((limit.scope, limit.name, limit.value),
+                         ('class', 'gold', 3))
+
+        for release in releases:
+            release()
+
+        self.assertEqual(inflight.counts, {})
+
+    @mock.patch('uuid.uuid4', return_value='request')
     @mock.patch('time.time', return_value=1000000.0)
-    def test_class_no_override(self, mock_time):
-        db = mock.Mock(**{'get.return_value': 'lim_class'})
-        midware = mock.Mock(db=db)
-        environ = {
-            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
-            'turnstile.nova.limitclass': 'override',
-        }
+    def test_shared(self, mock_time, mock_uuid4):
+        db = mock.Mock()
+        pipe = db.pipeline.return_value
+        pipe.execute.side_effect = [[0, 1, 1, True, 1, 1, 3, True],
+                                    [1, 1]]
+        inflight = nova_limits.InFlight(dict(gold=2), dict(gold=3),
+                                        shared=True, ttl=60)
 
-        nova_limits.nova_preprocess(midware, environ)
+        release, limit = inflight.acquire(db, 'spam', 'gold')
 
-        self.assertDictContainsSubset({
-            'turnstile.nova.tenant': 'spam',
-            'turnstile.nova.limitclass': 'override',
-            'turnstile.bucket_set': 'bucket_set:spam',
-        }, environ)
-        db.assert_has_calls([
-            mock.call.get('limit-class:spam'),
-            mock.call.zremrangebyscore('bucket_set:spam', 0, 1000000.0),
+        self.assertEqual(limit, None)
+        self.assertEqual(inflight.counts, {})
+        db.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(pipe.mock_calls, [
+            mock.call.zremrangebyscore('inflight:spam', '-inf', 1000000.0),
+            mock.call.zadd('inflight:spam', 1000060.0, 'request'),
+            mock.call.zcard('inflight:spam'),
+            mock.call.expire('inflight:spam', 60),
+            mock.call.zremrangebyscore('inflight-class:gold', '-inf',
+                                       1000000.0),
+            mock.call.zadd('inflight-class:gold', 1000060.0, 'request'),
+            mock.call.zcard('inflight-class:gold'),
+            mock.call.expire('inflight-class:gold', 60),
+            mock.call.execute(),
         ])
 
-    @mock.patch('time.time', return_value=1000000.0)
-    def test_class_no_override_quotaclass(self, mock_time):
-        db = mock.Mock(**{'get.return_value': 'lim_class'})
-        midware = mock.Mock(db=db)
-        environ = {
-            'nova.context': mock.Mock(project_id='spam', quota_class=None,
-                                      spec=['project_id', 'quota_class']),
-            'turnstile.nova.limitclass': 'override',
-        }
+        pipe.reset_mock()
+        release()
 
-        nova_limits.nova_preprocess(midware, environ)
+        self.assertEqual(pipe.mock_calls, [
+            mock.call.zrem('inflight:spam', 'request'),
+            mock.call.zrem('inflight-class:gold', 'request'),
+            mock.call.execute(),
+        ])
 
-        self.assertDictContainsSubset({
-            'turnstile.nova.tenant': 'spam',
-            'turnstile.nova.limitclass': 'override',
-            'turnstile.bucket_set': 'bucket_set:spam',
-        }, environ)
-        db.assert_has_calls([
-            mock.call.get('limit-class:spam'),
-            mock.call.zremrangebyscore('bucket_set:spam', 0, 1000000.0),
+    @mock.patch('uuid.uuid4', return_value='request')
+    def test_shared_rejected(self, mock_uuid4):
+        db = mock.Mock()
+        pipe = db.pipeline.return_value
+        pipe.execute.side_effect = [[0, 1, 1, True, 0, 1, 4, True],
+                                    [1, 1]]
+        inflight = nova_limits.InFlight(dict(gold=2), dict(gold=3),
+                                        shared=True)
+
+        release, limit = inflight.acquire(db, 'spam', 'gold')
+
+        self.assertEqual(release, None)
+        self.assertEqual((limit.scope, limit.name, limit.value),
+                         ('class', 'gold', 3))
+        self.assertEqual(pipe.zrem.mock_calls, [
+            mock.call('inflight:spam', 'request'),
+            mock.call('inflight-class:gold', 'request'),
         ])
-        self.assertEqual(environ['nova.context'].quota_class, 'override')
 
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    def test_shared_fallback(self, mock_exception):
+        db = mock.Mock()
+        db.pipeline.return_value.execute.side_effect = redis.ConnectionError
+        inflight = nova_limits.InFlight(dict(gold=2), shared=True)
 
-class TestPostprocess(unittest2.TestCase):
-    def _make_limit(self, **kwargs):
-        attrs = kwargs.keys() + ['load']
-        kwargs['load.side_effect'] = lambda key: mock.Mock(**key.bucket)
-        return mock.Mock(spec=attrs, **kwargs)
+        release, limit = inflight.acquire(db, 'spam', 'gold')
 
-    @mock.patch('time.time', return_value=1000000.0)
-    @mock.patch('turnstile.limits.BucketKey.decode',
-                side_effect=lambda key: mock.Mock(**key))
-    def test_limits(self, mock_decode, mock_time):
-        db = mock.Mock(**{'zrange.return_value': []})
-        limits = [
-            self._make_limit(
-                uuid='uuid',
-                queries=[],
-                verbs=['GET', 'PUT'],
-                unit='minute',
-                uri='/spam/uri',
-                value=23,
-            ),
-            self._make_limit(
-                uuid='uuid2',
-                queries=[],
-                verbs=[],
-                unit='second',
-                uri='/spam/uri2',
-                value=18,
-            ),
-            self._make_limit(
-                uuid='uuid3',
-                rate_class='spam',
-                queries=[],
-                verbs=['GET'],
+        self.assertEqual(limit, None)
+        self.assertEqual(inflight.counts, {'inflight:spam': 1})
+        mock_exception.assert_called_once_with(
+            "Failed to update shared in-flight counts")
+
+        release()
+
+        self.assertEqual(inflight.counts, {})
+
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    def test_shared_release_fails(self, mock_exception):
+        db = mock.Mock()
+        pipe = db.pipeline.return_value
+        pipe.execute.side_effect = [[0, 1, 1, True],
+                                    redis.ConnectionError()]
+        inflight = nova_limits.InFlight(dict(gold=2), shared=True)
+
+        release, limit = inflight.acquire(db, 'spam', 'gold')
+        release()
+
+        mock_exception.assert_called_once_with(
+            "Failed to update shared in-flight counts")
+
+
+class TestInFlightBody(unittest2.TestCase):
+    def test_iter(self):
+        body = nova_limits._InFlightBody(['a', 'b'], mock.Mock())
+
+        self.assertEqual(list(body), ['a', 'b'])
+
+    def test_close(self):
+        app_iter = mock.Mock()
+        release = mock.Mock()
+        body = nova_limits._InFlightBody(app_iter, release)
+
+        body.close()
+        body.close()
+
+        self.assertEqual(app_iter.close.call_count, 2)
+        release.assert_called_once_with()
+
+    def test_close_fails(self):
+        app_iter = mock.Mock(**{'close.side_effect': Exception('failed')})
+        release = mock.Mock()
+        body = nova_limits._InFlightBody(app_iter, release)
+
+        self.assertRaises(Exception, body.close)
+        release.assert_called_once_with()
+
+    def test_close_no_close(self):
+        release = mock.Mock()
+        body = nova_limits._InFlightBody(['a'], release)
+
+        body.close()
+
+        release.assert_called_once_with()
+
+
+class TestAdaptiveLimits(unittest2.TestCase):
+    def test_init_defaults(self):
+        adaptive = nova_limits.AdaptiveLimits(1.0)
+
+        self.assertEqual(adaptive.target, 1.0)
+        self.assertEqual(adaptive.interval, 30.0)
+        self.assertEqual(adaptive.increase, 0.05)
+        self.assertEqual(adaptive.decrease, 0.5)
+        self.assertEqual(adaptive.minimum, 0.1)
+        self.assertEqual(adaptive.maximum, 2.0)
+        self.assertEqual(adaptive.min_requests, 10)
+        self.assertEqual(adaptive.flush, 1.0)
+        self.assertEqual(adaptive.multipliers, {})
+        self.assertEqual(adaptive.latency, {})
+
+    def test_multiplier(self):
+        adaptive = nova_limits.AdaptiveLimits(1.0)
+        adaptive.multipliers = dict(gold=0.5)
+
+        self.assertEqual(adaptive.multiplier('gold'), 0.5)
+        self.assertEqual(adaptive.multiplier('default'), 1.0)
+
+    def test_multiplier_bounds(self):
+        adaptive = nova_limits.AdaptiveLimits(1.0, minimum=1.5, maximum=3.0)
+
+        self.assertEqual(adaptive.multiplier('default'), 1.5)
+
+    def test_record(self):
+        adaptive = nova_limits.AdaptiveLimits(1.0, interval=10.0)
+
+        adaptive.record('gold', 0.5, 999999.0)
+        adaptive.record('gold', 0.25, 1000000.0)
+        adaptive.record('gold', 0.25, 1000001.0)
+        adaptive.record('default', 2.0, 1000009.0)
+
+        self.assertEqual(adaptive.latency, {
+            99999: dict(gold=[0.5, 1]),
+            100000: dict(gold=[0.5, 2], default=[2.0, 1]),
+        })
+
+    @mock.patch.object(nova_limits.AdaptiveLimits, 'adjust')
+    def test_update(self, mock_adjust):
+        db = mock.Mock(**{'set.return_value': True})
+        pipe = db.pipeline.return_value
+        pipe.execute.return_value = [0.5, 1, True, 1.5, 2, True,
+                                     dict(gold='0.5')]
+        adaptive = nova_limits.AdaptiveLimits(1.0, interval=10.0)
+        adaptive.record('gold', 0.5, 999999.5)
+        adaptive.record('gold', 1.5, 1000004.0)
+        adaptive.record('gold', 0.0, 1000004.5)
+
+        adaptive.update(db, 1000005.0)
+
+        self.assertEqual(adaptive.latency, {})
+        self.assertEqual(adaptive.multipliers, dict(gold=0.5))
+        self.assertEqual(adaptive.next_flush, 1000006.0)
+        self.assertEqual(adaptive.window, 100000)
+        db.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(pipe.mock_calls, [
+            mock.call.hincrbyfloat('limit-latency:99999', 'gold:sum', 0.5),
+            mock.call.hincrby('limit-latency:99999', 'gold:count', 1),
+            mock.call.expire('limit-latency:99999', 30),
+            mock.call.hincrbyfloat('limit-latency:100000', 'gold:sum', 1.5),
+            mock.call.hincrby('limit-latency:100000', 'gold:count', 2),
+            mock.call.expire('limit-latency:100000', 30),
+            mock.call.hgetall('limit-multipliers'),
+            mock.call.execute(),
+        ])
+        db.set.assert_called_once_with('limit-adjust:99999', 1000005.0,
+                                       nx=True, ex=30)
+        mock_adjust.assert_called_once_with(db, 99999)
+
+        # Not yet time to flush again
+        db.reset_mock()
+        adaptive.update(db, 1000005.5)
+
+        self.assertFalse(db.pipeline.called)
+
+        # Time to flush, but the interval has already been adjusted
+        pipe.execute.return_value = [{}]
+        adaptive.update(db, 1000006.0)
+
+        self.assertEqual(pipe.mock_calls, [
+            mock.call.hgetall('limit-multipliers'),
+            mock.call.execute(),
+        ])
+        self.assertFalse(db.set.called)
+        self.assertEqual(mock_adjust.call_count, 1)
+
+    @mock.patch.object(nova_limits.AdaptiveLimits, 'adjust')
+    def test_update_waits_for_flush(self, mock_adjust):
+        db = mock.Mock(**{'set.return_value': True})
+        db.pipeline.return_value.execute.return_value = [{}]
+        adaptive = nova_limits.AdaptiveLimits(1.0, interval=10.0)
+        adaptive.window = 99999
+
+        # Other workers may not yet have added their totals for the
+        # previous interval
+        adaptive.update(db, 1000000.5)
+
+        self.assertFalse(db.set.called)
+        self.assertFalse(mock_adjust.called)
+
+        adaptive.update(db, 1000001.5)
+
+        db.set.assert_called_once_with('limit-adjust:99999', 1000001.5,
+                                       nx=True, ex=30)
+        mock_adjust.assert_called_once_with(db, 99999)
+
+    @mock.patch.object(nova_limits.AdaptiveLimits, 'adjust')
+    def test_update_adjusted_elsewhere(self, mock_adjust):
+        db = mock.Mock(**{'set.return_value': None})
+        db.pipeline.return_value.execute.return_value = [{}]
+        adaptive = nova_limits.AdaptiveLimits(1.0, interval=10.0)
+
+        adaptive.update(db, 1000005.0)
+
+        self.assertTrue(db.set.called)
+        self.assertFalse(mock_adjust.called)
+
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    def test_update_fails(self, mock_exception):
+        db = mock.Mock()
+        db.pipeline.return_value.execute.side_effect = redis.ConnectionError
+        adaptive = nova_limits.AdaptiveLimits(1.0)
+        adaptive.multipliers = dict(gold=0.5)
+
+        adaptive.update(db, 1000005.0)
+
+        self.assertEqual(adaptive.multipliers, dict(gold=0.5))
+        mock_exception.assert_called_once_with(
+            "Failed to update the adaptive limits")
+
+    def test_adjust(self):
+        db = mock.Mock(**{'hgetall.return_value': {
+            'gold:sum': '30.0', 'gold:count': '20',
+            'silver:sum': '5.0', 'silver:count': '20',
+            'bronze:sum': '1.0', 'bronze:count': '2',
+            'a:b:sum': '0.0', 'a:b:count': '10',
+        }})
+        adaptive = nova_limits.AdaptiveLimits(1.0, increase=0.25,
+                                              decrease=0.5, minimum=0.5)
+        adaptive.multipliers = dict(gold=0.75, silver=1.0, bronze=1.0,
+                                    other=1.5)
+
+        result = adaptive.adjust(db, 99999)
+
+        self.assertEqual(result, {'gold': 0.5, 'silver': 1.25, 'a:b': 1.25})
+        db.hgetall.assert_called_once_with('limit-latency:99999')
+        db.hmset.assert_called_once_with('limit-multipliers', result)
+        self.assertEqual(adaptive.multipliers, {
+            'gold': 0.5,
+            'silver': 1.25,
+            'bronze': 1.0,
+            'other': 1.5,
+            'a:b': 1.25,
+        })
+
+    def test_adjust_maximum(self):
+        db = mock.Mock(**{'hgetall.return_value': {
+            'gold:sum': '0.0', 'gold:count': '20',
+        }})
+        adaptive = nova_limits.AdaptiveLimits(1.0, maximum=2.0)
+        adaptive.multipliers = dict(gold=1.99)
+
+        result = adaptive.adjust(db, 99999)
+
+        self.assertEqual(result, dict(gold=2.0))
+
+    def test_adjust_nothing(self):
+        db = mock.Mock(**{'hgetall.return_value': {}})
+        adaptive = nova_limits.AdaptiveLimits(1.0)
+
+        result = adaptive.adjust(db, 99999)
+
+        self.assertEqual(result, {})
+        self.assertFalse(db.hmset.called)
+
+
+class TestProfiler(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sample_disabled(self):
+        profiler = nova_limits.Profiler()
+
+        self.assertFalse(profiler.sample({}))
+        self.assertEqual(profiler.count, 0)
+
+    def test_sample_rate(self):
+        profiler = nova_limits.Profiler(rate=3)
+
+        result = [profiler.sample({}) for _i in range(7)]
+
+        self.assertEqual(result, [False, False, True, False, False, True,
+                                  False])
+
+    def test_sample_active(self):
+        profiler = nova_limits.Profiler(rate=1)
+        profiler.active = True
+
+        self.assertFalse(profiler.sample({}))
+
+    def test_sample_header(self):
+        profiler = nova_limits.Profiler(header='X-Profile-Limits',
+                                        trusted=['10.0.0.1'])
+
+        self.assertTrue(profiler.sample(dict(HTTP_X_PROFILE_LIMITS='1',
+                                             REMOTE_ADDR='10.0.0.1')))
+        self.assertFalse(profiler.sample(dict(HTTP_X_PROFILE_LIMITS='1',
+                                              REMOTE_ADDR='10.0.0.2')))
+        self.assertFalse(profiler.sample(dict(REMOTE_ADDR='10.0.0.1')))
+
+    @mock.patch('os.getpid', return_value=1234)
+    def test_start_stop(self, mock_getpid):
+        profiler = nova_limits.Profiler(dump=self.tmpdir, interval=60)
+
+        for now in (1000000.0, 1000030.0):
+            prof = profiler.start()
+            self.assertTrue(profiler.active)
+            sorted(range(10))
+            profiler.stop(prof, now)
+            self.assertFalse(profiler.active)
+
+        self.assertEqual(profiler.samples, 2)
+        self.assertEqual(profiler.next_dump, 1000060.0)
+        funcs = dict((func[2], stat) for func, stat in
+                     profiler.stats.stats.items())
+        self.assertEqual(funcs['<sorted>'][1], 2)
+
+        # Only the first profile has been dumped
+        stats = nova_limits.limit_class_profile(
+            [os.path.join(self.tmpdir, 'profile.1234.prof')])['stats']
+        funcs = dict((func[2], stat) for func, stat in stats.stats.items())
+        self.assertEqual(funcs['<sorted>'][1], 1)
+
+    def test_green_threads(self):
+        try:
+            import eventlet
+        except ImportError:
+            self.skipTest("eventlet not available")
+
+        def other():
+            sorted(range(10))
+
+        profiler = nova_limits.Profiler(dump=self.tmpdir, interval=60)
+        prof = profiler.start()
+        thread = eventlet.spawn(other)
+        eventlet.sleep()
+        thread.wait()
+        profiler.stop(prof, 1000000.0)
+
+        # Only the profiled green thread is profiled
+        funcs = set(func[2] for func in profiler.stats.stats)
+        self.assertIn('sleep', funcs)
+        self.assertNotIn('other', funcs)
+        self.assertNotIn('<sorted>', funcs)
+
+    def test_dump_nothing(self):
+        profiler = nova_limits.Profiler(dump=self.tmpdir, interval=60)
+
+        profiler.dump(1000000.0)
+
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        self.assertEqual(profiler.next_dump, 1000060.0)
+
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    def test_dump_error(self, mock_exception):
+        profiler = nova_limits.Profiler(
+            dump=os.path.join(self.tmpdir, 'missing'), interval=60)
+        profiler.stats = mock.Mock(stats={})
+
+        profiler.dump(1000000.0)
+
+        self.assertEqual(mock_exception.call_count, 1)
+        self.assertEqual(profiler.next_dump, 1000060.0)
+
+
+class TestProfileCommand(unittest2.TestCase):
+    def setUp(self):
+        self.state = mock.Mock(profile_rate=10,
+                               profiler=nova_limits.Profiler(
+                                   rate=10, dump='/var/run/profiles'))
+        self.state.profiler.count = 5
+        self.daemon = mock.Mock()
+
+        patcher = mock.patch.object(nova_limits, '_get_state',
+                                    return_value=self.state)
+        self.mock_get_state = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(nova_limits.Profiler, 'dump')
+    def test_set_rate(self, mock_dump):
+        nova_limits.profile_command(self.daemon, '100')
+
+        self.mock_get_state.assert_called_once_with(self.daemon.middleware)
+        self.assertEqual(self.state.profiler.rate, 100)
+        self.assertEqual(self.state.profiler.count, 0)
+        self.assertFalse(mock_dump.called)
+
+    @mock.patch.object(nova_limits.Profiler, 'dump')
+    def test_restore_rate(self, mock_dump):
+        self.state.profiler.rate = 100
+
+        nova_limits.profile_command(self.daemon)
+
+        self.assertEqual(self.state.profiler.rate, 10)
+        self.assertFalse(mock_dump.called)
+
+    def test_set_rate_no_dir(self):
+        self.state.profiler.dump_to = None
+
+        self.assertRaises(ValueError, nova_limits.profile_command,
+                          self.daemon, '100')
+        self.assertEqual(self.state.profiler.rate, 10)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(nova_limits.Profiler, 'dump')
+    def test_disable(self, mock_dump, mock_time):
+        nova_limits.profile_command(self.daemon, '0')
+
+        self.assertEqual(self.state.profiler.rate, 0)
+        mock_dump.assert_called_once_with(1000000.0)
+
+
+class TestNovaState(unittest2.TestCase):
+    def test_init_defaults(self):
+        state = nova_limits._NovaState(config.Config())
+
+        self.assertEqual(state.class_table, None)
+        self.assertEqual(state.class_cache_ttl, 0.0)
+        self.assertEqual(state.class_cache.size, 10000)
+        self.assertEqual(state.warmup_enabled, False)
+        self.assertEqual(state.warmup_budget, 2.0)
+        self.assertEqual(state.warmup_batch, 500)
+        self.assertEqual(state.bucket_grace, 0.0)
+        self.assertEqual(state.limits_cache, None)
+        self.assertEqual(state.limits_cache_ttl, 60.0)
+        self.assertEqual(state.hitters, None)
+        self.assertEqual(state.bucket_set_max, 0)
+        self.assertEqual(state.inflight, None)
+        self.assertEqual(state.adaptive, None)
+        self.assertEqual(state.profile_rate, 0)
+        self.assertIsInstance(state.profiler, nova_limits.Profiler)
+        self.assertEqual(state.profiler.rate, 0)
+        self.assertEqual(state.profiler.header, None)
+        self.assertEqual(state.profiler.trusted, set(['127.0.0.1', '::1']))
+        self.assertEqual(state.profiler.dump_to, None)
+        self.assertEqual(state.profiler.interval, 60.0)
+
+    def test_init_profile(self):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.profile': '100',
+            'nova_limits.profile_header': 'X-Profile-Limits',
+            'nova_limits.profile_trusted': '10.0.0.1, 10.0.0.2',
+            'nova_limits.profile_dir': '/var/run/profiles',
+            'nova_limits.profile_interval': '30',
+        }))
+
+        self.assertEqual(state.profile_rate, 100)
+        self.assertEqual(state.profiler.rate, 100)
+        self.assertEqual(state.profiler.header, 'HTTP_X_PROFILE_LIMITS')
+        self.assertEqual(state.profiler.trusted,
+                         set(['10.0.0.1', '10.0.0.2']))
+        self.assertEqual(state.profiler.dump_to, '/var/run/profiles')
+        self.assertEqual(state.profiler.interval, 30.0)
+
+    def test_init_profile_no_dir(self):
+        for conf_dict in ({'nova_limits.profile': '100'},
+                          {'nova_limits.profile_header': 'X-Profile'}):
+            self.assertRaises(ValueError, nova_limits._NovaState,
+                              config.Config(conf_dict=conf_dict))
+
+    def test_init_adaptive(self):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.adaptive': 'yes',
+            'nova_limits.adaptive_target': '0.5',
+            'nova_limits.adaptive_interval': '10',
+            'nova_limits.adaptive_increase': '0.1',
+            'nova_limits.adaptive_decrease': '0.75',
+            'nova_limits.adaptive_min': '0.25',
+            'nova_limits.adaptive_max': '4',
+            'nova_limits.adaptive_min_requests': '5',
+            'nova_limits.adaptive_flush': '2',
+        }))
+
+        adaptive = state.adaptive
+        self.assertIsInstance(adaptive, nova_limits.AdaptiveLimits)
+        self.assertEqual(adaptive.target, 0.5)
+        self.assertEqual(adaptive.interval, 10.0)
+        self.assertEqual(adaptive.increase, 0.1)
+        self.assertEqual(adaptive.decrease, 0.75)
+        self.assertEqual(adaptive.minimum, 0.25)
+        self.assertEqual(adaptive.maximum, 4.0)
+        self.assertEqual(adaptive.min_requests, 5)
+        self.assertEqual(adaptive.flush, 2.0)
+
+    def test_init_inflight(self):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.inflight_tenant': 'default:2, gold:5',
+            'nova_limits.inflight_class': 'default:100',
+            'nova_limits.inflight_shared': 'yes',
+            'nova_limits.inflight_ttl': '60',
+            'nova_limits.inflight_retry': '2',
+        }))
+
+        self.assertIsInstance(state.inflight, nova_limits.InFlight)
+        self.assertEqual(state.inflight.tenant_limits,
+                         dict(default=2, gold=5))
+        self.assertEqual(state.inflight.class_limits, dict(default=100))
+        self.assertEqual(state.inflight.shared, True)
+        self.assertEqual(state.inflight.ttl, 60)
+        self.assertEqual(state.inflight.retry, 2.0)
+
+    def test_init_hitters(self):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.hitters': 'yes',
+            'nova_limits.hitters_dump': '/var/run/hitters',
+            'nova_limits.hitters_interval': '30',
+            'nova_limits.hitters_top': '5',
+            'nova_limits.hitters_width': '128',
+            'nova_limits.hitters_depth': '3',
+            'nova_limits.hitters_timeout': '0.5',
+        }))
+
+        self.assertIsInstance(state.hitters, nova_limits.HeavyHitters)
+        self.assertEqual(state.hitters.dump_to, '/var/run/hitters')
+        self.assertEqual(state.hitters.interval, 30.0)
+        self.assertEqual(state.hitters.requests.top, 5)
+        self.assertEqual(state.hitters.requests.sketch.width, 128)
+        self.assertEqual(state.hitters.requests.sketch.depth, 3)
+        self.assertEqual(state.hitters.timeout, 0.5)
+
+    def test_init_limits_cache(self):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.limits_cache': 'yes',
+            'nova_limits.limits_cache_size': '5',
+            'nova_limits.limits_cache_ttl': '30',
+        }))
+
+        self.assertIsInstance(state.limits_cache, nova_limits.ExpiringCache)
+        self.assertEqual(state.limits_cache.size, 5)
+        self.assertEqual(state.limits_cache_ttl, 30.0)
+
+    def test_init_class_table(self):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_table': '/dev/shm/classes',
+            'nova_limits.class_table_max_age': '60',
+        }))
+
+        self.assertEqual(state.class_table.path, '/dev/shm/classes')
+        self.assertEqual(state.class_table.max_age, 60.0)
+        self.assertEqual(state.class_table.recheck, 1.0)
+
+    def test_class_cache_disabled(self):
+        state = nova_limits._NovaState(config.Config())
+
+        state.set_class('spam', 'gold', 1000000.0)
+
+        self.assertEqual(state.get_class('spam', 1000000.0), None)
+
+    def test_class_cache(self):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_cache_ttl': '60',
+        }))
+
+        state.set_class('spam', 'gold', 1000000.0)
+
+        self.assertEqual(state.get_class('spam', 1000059.0), 'gold')
+        self.assertEqual(state.get_class('spam', 1000060.0), None)
+        self.assertEqual(state.get_class('eggs', 1000000.0), None)
+
+    def test_class_cache_evict(self):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_cache_ttl': '60',
+            'nova_limits.class_cache_size': '2',
+        }))
+
+        state.set_class('spam', 'gold', 1000000.0)
+        state.set_class('eggs', 'gold', 1000000.0)
+        state.set_class('spam', 'platinum', 1000000.0)
+        state.set_class('bacon', 'gold', 1000000.0)
+
+        self.assertEqual(state.class_cache.keys(), ['spam', 'bacon'])
+        self.assertEqual(state.get_class('spam', 1000000.0), 'platinum')
+
+    def test_may_have_class_disabled(self):
+        db = mock.Mock()
+        state = nova_limits._NovaState(config.Config())
+
+        self.assertEqual(state.may_have_class(db, 'spam', 1000000.0), True)
+        self.assertFalse(db.get.called)
+
+    @mock.patch.object(nova_limits.ClassFilter, 'load')
+    def test_may_have_class(self, mock_load):
+        class_filter = nova_limits.ClassFilter(bytearray(128))
+        class_filter.add('spam')
+        mock_load.return_value = class_filter
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_filter': 'yes',
+            'nova_limits.class_filter_refresh': '30',
+        }))
+
+        self.assertEqual(state.may_have_class('db', 'spam', 1000000.0), True)
+        self.assertEqual(state.may_have_class('db', 'eggs', 1000029.0),
+                         False)
+        mock_load.assert_called_once_with('db')
+
+        # Reloaded after the refresh interval
+        mock_load.return_value = None
+        self.assertEqual(state.may_have_class('db', 'eggs', 1000030.0), True)
+        self.assertEqual(mock_load.call_count, 2)
+
+    @mock.patch.object(nova_limits.ClassFilter, 'load',
+                       side_effect=Exception('failed'))
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    def test_may_have_class_error(self, mock_exception, mock_load):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_filter': 'yes',
+        }))
+
+        self.assertEqual(state.may_have_class('db', 'spam', 1000000.0), True)
+        mock_exception.assert_called_once_with(
+            "Failed to load the class filter")
+        self.assertEqual(state.class_filter_expires, 1000060.0)
+
+    def test_init_class_parents(self):
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_parents': 'gold:default, platinum:gold',
+        }))
+
+        self.assertEqual(state.class_parents, dict(gold='default',
+                                                   platinum='gold'))
+
+    def _inherited_limits(self):
+        def lim(rate_class, verb, uri, value, unit='minute', **kwargs):
+            return nova_limits.NovaClassLimit(
+                'db', uri=uri, value=value, unit=unit, verbs=[verb],
+                rate_class=rate_class, **kwargs)
+
+        return [
+            lim('default', 'POST', '/servers', 10),
+            lim('default', 'GET', '*', 100),
+            lim('default', 'POST', '/servers', 50, unit='day'),
+            lim('gold', 'POST', '/servers', 20),
+            lim('platinum', 'GET', '*', 1000, unit='60'),
+            lim('platinum', 'DELETE', '/servers', 5),
+            lim('other', 'GET', '*', 1),
+            limits.Limit('db', uri='/images', value=3, unit='second'),
+        ]
+
+    def test_get_limits_inherited(self):
+        lims = self._inherited_limits()
+        midware = mock.Mock(limits=lims, limit_sum='sum')
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_parents': 'gold:default platinum:gold',
+        }))
+
+        def compiled(klass):
+            return [lims.index(x[0]) for x in state.get_limits(midware,
+                                                               klass)]
+
+        self.assertEqual(compiled('default'), [0, 1, 2, 7])
+        self.assertEqual(compiled('gold'), [1, 2, 3, 7])
+        self.assertEqual(compiled('platinum'), [2, 3, 4, 5, 7])
+        self.assertEqual(compiled('other'), [6, 7])
+        self.assertEqual(state.get_limit_set(midware, 'platinum'),
+                         frozenset(lims[i].uuid for i in (2, 3, 4, 5)))
+        self.assertEqual(state.get_limit_set(midware, 'spam'), frozenset())
+
+    def test_is_cacheable(self):
+        lims = self._inherited_limits()
+        midware = mock.Mock(limits=lims[:7], limit_sum='sum')
+        state = nova_limits._NovaState(config.Config())
+
+        self.assertEqual(state.is_cacheable(midware, 'gold'), True)
+
+        # Limits which aren't NovaClassLimit limits don't bump the
+        # version
+        midware.limits = lims
+        midware.limit_sum = 'new_sum'
+        self.assertEqual(state.is_cacheable(midware, 'gold'), False)
+
+    def test_inheritance_cycle(self):
+        with self.assertRaises(ValueError) as cm:
+            nova_limits._NovaState(config.Config(conf_dict={
+                'nova_limits.class_parents': 'gold:default default:gold',
+            }))
+
+        self.assertIn("default -> gold -> default", str(cm.exception))
+
+    def test_get_bucket_set_ttl(self):
+        midware = mock.Mock(limits=[
+            mock.Mock(unit_value=1),
+            mock.Mock(unit_value=3600.5),
+        ], limit_sum='sum')
+        state = nova_limits._NovaState(config.Config())
+
+        self.assertEqual(state.get_bucket_set_ttl(midware), 3602)
+
+        # Cached until the limits change
+        midware.limits = []
+        self.assertEqual(state.get_bucket_set_ttl(midware), 3602)
+        midware.limit_sum = 'new_sum'
+        self.assertEqual(state.get_bucket_set_ttl(midware), 0)
+
+    def test_get_limits(self):
+        limits = [
+            mock.Mock(spec=['uri', 'queries', 'verbs', 'unit'],
+                      uri='/spam', queries=[], verbs=['GET'], unit='minute'),
+            mock.Mock(rate_class='gold', uri='/eggs', queries=['b', 'a'],
+                      verbs=[], unit='60'),
+            mock.Mock(rate_class='platinum', uri='/bacon', queries=[],
+                      verbs=[], unit='second'),
+        ]
+        midware = mock.Mock(limits=limits, limit_sum='sum')
+        state = nova_limits._NovaState(config.Config())
+
+        result = state.get_limits(midware, 'gold')
+
+        self.assertEqual(result, [
+            (limits[0], '/spam', ['GET'], 'MINUTE'),
+            (limits[1], '/eggs?a={a}&b={b}',
+             ['GET', 'HEAD', 'POST', 'PUT', 'DELETE'], 'UNKNOWN'),
+        ])
+        self.assertEqual(state.limit_sum, 'sum')
+
+        # Cached until the limits change
+        midware.limits = []
+        self.assertIs(state.get_limits(midware, 'gold'), result)
+        midware.limit_sum = 'new_sum'
+        self.assertEqual(state.get_limits(midware, 'gold'), [])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(nova_limits._NovaState, 'get_limits')
+    def test_warmup(self, mock_get_limits, mock_time):
+        db = mock.Mock(**{
+            'scan_iter.return_value': iter([
+                'bucket_set:spam', 'bucket_set:eggs', 'bucket_set:bacon',
+            ]),
+            'mget.side_effect': [['gold', None], ['platinum']],
+        })
+        midware = mock.Mock(db=db)
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_cache_ttl': '60',
+            'nova_limits.warmup_batch': '2',
+        }))
+
+        state.warmup(midware)
+
+        self.assertEqual(dict(state.class_cache), {
+            'spam': ('gold', 1000060.0),
+            'eggs': ('default', 1000060.0),
+            'bacon': ('platinum', 1000060.0),
+        })
+        db.scan_iter.assert_called_once_with(match='bucket_set:*', count=2)
+        db.mget.assert_has_calls([
+            mock.call(['limit-class:spam', 'limit-class:eggs']),
+            mock.call(['limit-class:bacon']),
+        ])
+        self.assertEqual(sorted(c[0][1] for c in
+                                mock_get_limits.call_args_list),
+                         ['default', 'gold', 'platinum'])
+
+    @mock.patch('time.time', side_effect=[1000000.0, 1000000.5, 1000000.5,
+                                          1000000.5, 1000001.0])
+    @mock.patch.object(nova_limits._NovaState, 'get_limits')
+    def test_warmup_budget(self, mock_get_limits, mock_time):
+        db = mock.Mock(**{
+            'scan_iter.return_value': iter([
+                'bucket_set:spam', 'bucket_set:eggs', 'bucket_set:bacon',
+            ]),
+            'mget.side_effect': [['gold', None], ['platinum']],
+        })
+        midware = mock.Mock(db=db)
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_cache_ttl': '60',
+            'nova_limits.warmup_batch': '2',
+            'nova_limits.warmup_budget': '1',
+        }))
+
+        state.warmup(midware)
+
+        self.assertEqual(sorted(state.class_cache), ['eggs', 'spam'])
+        db.mget.assert_called_once_with(['limit-class:spam',
+                                         'limit-class:eggs'])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(nova_limits._NovaState, 'get_limits')
+    def test_warmup_middleware(self, mock_get_limits, mock_time):
+        midware = mock.MagicMock(spec=middleware.TurnstileMiddleware)
+        midware.mapper_lock = mock.MagicMock()
+        state = nova_limits._NovaState(config.Config())
+
+        state.warmup(midware)
+
+        midware.recheck_limits.assert_called_once_with()
+        self.assertEqual(midware.mapper_lock.__enter__.call_count, 1)
+        mock_get_limits.assert_called_once_with(midware, 'default')
+
+    @mock.patch.object(nova_limits._NovaState, 'get_limits')
+    def test_warmup_no_cache(self, mock_get_limits):
+        db = mock.Mock()
+        midware = mock.Mock(db=db)
+        state = nova_limits._NovaState(config.Config())
+
+        state.warmup(midware)
+
+        self.assertFalse(db.scan_iter.called)
+        mock_get_limits.assert_called_once_with(midware, 'default')
+
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    def test_warmup_failure(self, mock_exception):
+        db = mock.Mock(**{'scan_iter.side_effect': Exception('failed')})
+        midware = mock.Mock(db=db)
+        state = nova_limits._NovaState(config.Config(conf_dict={
+            'nova_limits.class_cache_ttl': '60',
+        }))
+
+        state.warmup(midware)
+
+        mock_exception.assert_called_once_with(
+            "Failed to warm up nova_limits")
+
+
+class TestGetState(unittest2.TestCase):
+    @mock.patch.object(nova_limits._NovaState, 'warmup')
+    def test_cached(self, mock_warmup):
+        midware = mock.Mock(conf=config.Config())
+
+        state = nova_limits._get_state(midware)
+
+        self.assertIsInstance(state, nova_limits._NovaState)
+        self.assertIs(nova_limits._get_state(midware), state)
+        self.assertFalse(mock_warmup.called)
+
+    @mock.patch.object(eventlet, 'spawn_n')
+    def test_warmup(self, mock_spawn_n):
+        midware = mock.Mock(conf=config.Config(conf_dict={
+            'nova_limits.warmup': 'yes',
+        }))
+
+        state = nova_limits._get_state(midware)
+
+        self.assertIs(nova_limits._get_state(midware), state)
+        mock_spawn_n.assert_called_once_with(state.warmup, midware)
+
+
+class TestBumpVersion(unittest2.TestCase):
+    def test_not_updated(self):
+        db = mock.Mock()
+        environ = {}
+
+        result = nova_limits._bump_version(db, environ)
+
+        self.assertEqual(result, None)
+        self.assertFalse(db.pipeline.called)
+
+    def test_updated(self):
+        db = mock.Mock(**{
+            'pipeline.return_value.execute.return_value': [5, True],
+        })
+        pipe = db.pipeline.return_value
+        environ = {
+            'turnstile.conf': config.Config(),
+            'turnstile.nova.version_key': 'limits_version:spam',
+            'turnstile.nova.updated': True,
+        }
+
+        result = nova_limits._bump_version(db, environ)
+
+        self.assertEqual(result, (4, 5))
+        self.assertFalse('turnstile.nova.updated' in environ)
+        db.pipeline.assert_called_once_with(transaction=False)
+        pipe.assert_has_calls([
+            mock.call.incr('limits_version:spam'),
+            mock.call.expire('limits_version:spam', 86400),
+            mock.call.execute(),
+        ])
+
+    def test_updated_ttl(self):
+        db = mock.Mock(**{
+            'pipeline.return_value.execute.return_value': [5, True],
+        })
+        pipe = db.pipeline.return_value
+        environ = {
+            'turnstile.conf': config.Config(conf_dict={
+                'nova_limits.limits_version_ttl': '3600',
+            }),
+            'turnstile.nova.version_key': 'limits_version:spam',
+            'turnstile.nova.updated': True,
+        }
+
+        nova_limits._bump_version(db, environ)
+
+        pipe.expire.assert_called_once_with('limits_version:spam', 3600)
+
+    def test_updated_atomic(self):
+        db = mock.Mock()
+        environ = {
+            'turnstile.conf': config.Config(),
+            'turnstile.nova.version_key': 'limits_version:spam',
+            'turnstile.nova.version': 7,
+            'turnstile.nova.bumps': 2,
+        }
+
+        result = nova_limits._bump_version(db, environ)
+
+        self.assertEqual(result, (5, 7))
+        self.assertEqual(environ, {
+            'turnstile.conf': environ['turnstile.conf'],
+            'turnstile.nova.version_key': 'limits_version:spam',
+        })
+        self.assertFalse(db.pipeline.called)
+
+    def test_updated_mixed(self):
+        db = mock.Mock(**{
+            'pipeline.return_value.execute.return_value': [9, True],
+        })
+        environ = {
+            'turnstile.conf': config.Config(),
+            'turnstile.nova.version_key': 'limits_version:spam',
+            'turnstile.nova.version': 7,
+            'turnstile.nova.bumps': 2,
+            'turnstile.nova.updated': True,
+        }
+
+        result = nova_limits._bump_version(db, environ)
+
+        self.assertEqual(result, (6, 9))
+
+
+class TestPreprocess(unittest2.TestCase):
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_basic(self, mock_time):
+        db = mock.Mock(**{'get.return_value': None})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config())
+        environ = {}
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertDictContainsSubset({
+            'turnstile.nova.tenant': '<NONE>',
+            'turnstile.nova.limitclass': 'default',
+            'turnstile.bucket_set': 'bucket_set:<NONE>',
+        }, environ)
+        db.assert_has_calls([
+            mock.call.get('limit-class:<NONE>'),
+            mock.call.pipeline(transaction=False),
+            mock.call.pipeline().zremrangebyscore('bucket_set:<NONE>', 0,
+                                                  1000000.0),
+            mock.call.pipeline().execute(),
+        ])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_tenant(self, mock_time):
+        db = mock.Mock(**{'get.return_value': None})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config())
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertDictContainsSubset({
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'default',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }, environ)
+        db.assert_has_calls([
+            mock.call.get('limit-class:spam'),
+            mock.call.pipeline(transaction=False),
+            mock.call.pipeline().zremrangebyscore('bucket_set:spam', 0,
+                                                  1000000.0),
+            mock.call.pipeline().execute(),
+        ])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_configured_class(self, mock_time):
+        db = mock.Mock(**{'get.return_value': 'lim_class'})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config())
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertDictContainsSubset({
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }, environ)
+        db.assert_has_calls([
+            mock.call.get('limit-class:spam'),
+            mock.call.pipeline(transaction=False),
+            mock.call.pipeline().zremrangebyscore('bucket_set:spam', 0,
+                                                  1000000.0),
+            mock.call.pipeline().execute(),
+        ])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_configured_class_quotaclass(self, mock_time):
+        db = mock.Mock(**{'get.return_value': 'lim_class'})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config())
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', quota_class=None,
+                                      spec=['project_id', 'quota_class']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertDictContainsSubset({
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }, environ)
+        db.assert_has_calls([
+            mock.call.get('limit-class:spam'),
+            mock.call.pipeline(transaction=False),
+            mock.call.pipeline().zremrangebyscore('bucket_set:spam', 0,
+                                                  1000000.0),
+            mock.call.pipeline().execute(),
+        ])
+        self.assertEqual(environ['nova.context'].quota_class, 'lim_class')
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_class_no_override(self, mock_time):
+        db = mock.Mock(**{'get.return_value': 'lim_class'})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config())
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+            'turnstile.nova.limitclass': 'override',
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertDictContainsSubset({
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'override',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }, environ)
+        db.assert_has_calls([
+            mock.call.get('limit-class:spam'),
+            mock.call.pipeline(transaction=False),
+            mock.call.pipeline().zremrangebyscore('bucket_set:spam', 0,
+                                                  1000000.0),
+            mock.call.pipeline().execute(),
+        ])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_class_no_override_quotaclass(self, mock_time):
+        db = mock.Mock(**{'get.return_value': 'lim_class'})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config())
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', quota_class=None,
+                                      spec=['project_id', 'quota_class']),
+            'turnstile.nova.limitclass': 'override',
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertDictContainsSubset({
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'override',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }, environ)
+        db.assert_has_calls([
+            mock.call.get('limit-class:spam'),
+            mock.call.pipeline(transaction=False),
+            mock.call.pipeline().zremrangebyscore('bucket_set:spam', 0,
+                                                  1000000.0),
+            mock.call.pipeline().execute(),
+        ])
+        self.assertEqual(environ['nova.context'].quota_class, 'override')
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(nova_limits.ClassTable, 'lookup',
+                       return_value='lim_class')
+    def test_class_table(self, mock_lookup, mock_time):
+        db = mock.Mock()
+        midware = mock.Mock(db=db, limits=[], conf=config.Config(conf_dict={
+            'nova_limits.class_table': '/dev/shm/classes',
+        }))
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertDictContainsSubset({
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }, environ)
+        mock_lookup.assert_called_once_with('spam')
+        self.assertFalse(db.get.called)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(nova_limits.ClassFilter, 'load',
+                       return_value=nova_limits.ClassFilter(bytearray(128)))
+    def test_class_filter(self, mock_load, mock_time):
+        db = mock.Mock()
+        midware = mock.Mock(db=db, limits=[], conf=config.Config(conf_dict={
+            'nova_limits.class_filter': 'yes',
+        }))
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limitclass'], 'default')
+        mock_load.assert_called_once_with(db)
+        self.assertFalse(db.get.called)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(nova_limits.ClassTable, 'lookup', return_value=None)
+    def test_class_table_unavailable(self, mock_lookup, mock_time):
+        db = mock.Mock(**{'get.return_value': 'lim_class'})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config(conf_dict={
+            'nova_limits.class_table': '/dev/shm/classes',
+        }))
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertDictContainsSubset({
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }, environ)
+        mock_lookup.assert_called_once_with('spam')
+        db.get.assert_called_once_with('limit-class:spam')
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_class_cache(self, mock_time):
+        db = mock.Mock(**{'get.return_value': 'lim_class'})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config(conf_dict={
+            'nova_limits.class_cache_ttl': '60',
+        }))
+
+        for i in range(2):
+            environ = {
+                'nova.context': mock.Mock(project_id='spam',
+                                          spec=['project_id']),
+            }
+
+            nova_limits.nova_preprocess(midware, environ)
+
+            self.assertDictContainsSubset({
+                'turnstile.nova.tenant': 'spam',
+                'turnstile.nova.limitclass': 'lim_class',
+                'turnstile.bucket_set': 'bucket_set:spam',
+            }, environ)
+
+        db.get.assert_called_once_with('limit-class:spam')
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_limits_cache(self, mock_time):
+        db = mock.Mock(**{'get.return_value': None})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config(conf_dict={
+            'nova_limits.limits_cache': 'yes',
+        }))
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.version_key'],
+                         'limits_version:spam')
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_hitters(self, mock_time):
+        db = mock.Mock(**{'get.return_value': 'gold'})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config(conf_dict={
+            'nova_limits.hitters': 'yes',
+        }))
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        hitters = environ['turnstile.nova.hitters']
+        self.assertIs(hitters, nova_limits._get_state(midware).hitters)
+        self.assertEqual(hitters.requests.items(), [('spam', 1)])
+        self.assertEqual(hitters.classes, dict(gold=[1, 0]))
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(nova_limits.AdaptiveLimits, 'update')
+    def test_adaptive(self, mock_update, mock_time):
+        db = mock.Mock(**{'get.return_value': 'gold'})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config(conf_dict={
+            'nova_limits.adaptive': 'yes',
+        }))
+        nova_limits._get_state(midware).adaptive.multipliers = dict(gold=0.5)
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.multiplier'], 0.5)
+        mock_update.assert_called_once_with(db, 1000000.0)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(nova_limits._NovaState, 'get_limit_set',
+                       return_value=frozenset(['uuid']))
+    def test_class_parents(self, mock_get_limit_set, mock_time):
+        db = mock.Mock(**{'get.return_value': 'gold'})
+        midware = mock.Mock(db=db, limits=[], conf=config.Config(conf_dict={
+            'nova_limits.class_parents': 'gold:default',
+        }))
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        self.assertEqual(environ['turnstile.nova.limit_set'],
+                         frozenset(['uuid']))
+        mock_get_limit_set.assert_called_once_with(midware, 'gold')
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_bucket_set_trim(self, mock_time):
+        db = mock.Mock(**{'get.return_value': None})
+        midware = mock.Mock(db=db, limits=[
+            mock.Mock(unit_value=60),
+            mock.Mock(unit_value=86400),
+        ], conf=config.Config(conf_dict={
+            'nova_limits.bucket_set_max': '100',
+        }))
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+
+        pipe = db.pipeline.return_value
+        self.assertEqual(pipe.mock_calls, [
+            mock.call.zremrangebyscore('bucket_set:spam', 0, 1000000.0),
+            mock.call.zremrangebyrank('bucket_set:spam', 0, -101),
+            mock.call.expire('bucket_set:spam', 86401),
+            mock.call.execute(),
+        ])
+        self.assertEqual(environ['turnstile.nova.bucket_set_ttl'], 86401)
+
+
+class TestExpireBucketSet(unittest2.TestCase):
+    def test_expire(self):
+        db = mock.Mock()
+        environ = {
+            'turnstile.bucket_set': 'bucket_set:spam',
+            'turnstile.nova.bucket_set_ttl': 3601,
+        }
+
+        nova_limits._expire_bucket_set(db, environ)
+
+        db.expire.assert_called_once_with('bucket_set:spam', 3601)
+        self.assertNotIn('turnstile.nova.bucket_set_ttl', environ)
+
+        # Only done once per request
+        nova_limits._expire_bucket_set(db, environ)
+        self.assertEqual(db.expire.call_count, 1)
+
+    def test_no_ttl(self):
+        db = mock.Mock()
+
+        nova_limits._expire_bucket_set(db, {
+            'turnstile.bucket_set': 'bucket_set:spam',
+        })
+
+        self.assertFalse(db.expire.called)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_new_bucket_set(self, mock_time):
+        # The bucket set doesn't exist when nova_preprocess() runs, so
+        # its expiration must be set once Turnstile has created it
+        db = mock.Mock(**{'get.return_value': None,
+                          'zrange.return_value': []})
+        midware = mock.Mock(db=db, limits=[mock.Mock(unit_value=3600)],
+                            conf=config.Config())
+        environ = {
+            'nova.context': mock.Mock(project_id='spam', spec=['project_id']),
+        }
+
+        nova_limits.nova_preprocess(midware, environ)
+        db.zadd('bucket_set:spam', 1003600.0, 'bucket')
+        with mock.patch.object(nova_limits._NovaState, 'get_limits',
+                               return_value=[]):
+            nova_limits.nova_postprocess(midware, environ)
+
+        calls = [c for c in db.mock_calls
+                 if c[0] in ('zadd', 'expire', 'pipeline().expire')]
+        self.assertEqual(calls, [
+            mock.call.pipeline().expire('bucket_set:spam', 3601),
+            mock.call.zadd('bucket_set:spam', 1003600.0, 'bucket'),
+            mock.call.expire('bucket_set:spam', 3601),
+        ])
+
+
+class TestPostprocess(unittest2.TestCase):
+    def _make_limit(self, **kwargs):
+        attrs = kwargs.keys() + ['load']
+        kwargs['load.side_effect'] = lambda key: mock.Mock(**key.bucket)
+        return mock.Mock(spec=attrs, **kwargs)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits(self, mock_decode, mock_time):
+        db = mock.Mock(**{'zrange.return_value': []})
+        limits = [
+            self._make_limit(
+                uuid='uuid',
+                queries=[],
+                verbs=['GET', 'PUT'],
+                unit='minute',
+                uri='/spam/uri',
+                value=23,
+            ),
+            self._make_limit(
+                uuid='uuid2',
+                queries=[],
+                verbs=[],
+                unit='second',
+                uri='/spam/uri2',
+                value=18,
+            ),
+            self._make_limit(
+                uuid='uuid3',
+                rate_class='spam',
+                queries=[],
+                verbs=['GET'],
                 unit='hour',
                 uri='/spam/uri3',
                 value=17,
             ),
             self._make_limit(
                 uuid='uuid4',
-                rate_class='lim_class',
+                rate_class='lim_class',
+                queries=[],
+                verbs=['GET'],
+                unit='day',
+                uri='/spam/uri4',
+                value=1,
+            ),
+            self._make_limit(
+                uuid='uuid5',
+                queries=[],
+                verbs=['GET'],
+                unit='1234',
+                uri='/spam/uri5',
+                value=183,
+            ),
+            self._make_limit(
+                uuid='uuid6',
+                queries=['bravo', 'alfa'],
+                verbs=['GET'],
+                unit='day',
+                uri='/spam/uri6',
+                value=1,
+            ),
+        ]
+        midware = mock.Mock(db=db, limits=limits, conf=config.Config())
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }
+
+        nova_limits.nova_postprocess(midware, environ)
+
+        self.assertEqual(environ['nova.limits'], [
+            dict(
+                verb='GET',
+                URI='/spam/uri',
+                regex='/spam/uri',
+                value=23,
+                unit='MINUTE',
+                remaining=23,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='PUT',
+                URI='/spam/uri',
+                regex='/spam/uri',
+                value=23,
+                unit='MINUTE',
+                remaining=23,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/uri2',
+                regex='/spam/uri2',
+                value=18,
+                unit='SECOND',
+                remaining=18,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='HEAD',
+                URI='/spam/uri2',
+                regex='/spam/uri2',
+                value=18,
+                unit='SECOND',
+                remaining=18,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='POST',
+                URI='/spam/uri2',
+                regex='/spam/uri2',
+                value=18,
+                unit='SECOND',
+                remaining=18,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='PUT',
+                URI='/spam/uri2',
+                regex='/spam/uri2',
+                value=18,
+                unit='SECOND',
+                remaining=18,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='DELETE',
+                URI='/spam/uri2',
+                regex='/spam/uri2',
+                value=18,
+                unit='SECOND',
+                remaining=18,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/uri4',
+                regex='/spam/uri4',
+                value=1,
+                unit='DAY',
+                remaining=1,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/uri5',
+                regex='/spam/uri5',
+                value=183,
+                unit='UNKNOWN',
+                remaining=183,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/uri6?alfa={alfa}&bravo={bravo}',
+                regex='/spam/uri6?alfa={alfa}&bravo={bravo}',
+                value=1,
+                unit='DAY',
+                remaining=1,
+                resetTime=1000000.0,
+            ),
+        ])
+        db.zrange.assert_called_once_with('bucket_set:spam', 0, -1,
+                                          withscores=True)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits_with_buckets(self, mock_decode, mock_time):
+        db = mock.Mock(**{'zrange.return_value': [
+            (dict(
+                uuid='uuid',
+                params={},
+                bucket=dict(messages=2, expire=1000001.0),
+            ), 1000001.0),
+            (dict(
+                uuid='uuid2',
+                params=dict(unused='foo'),
+                bucket=dict(messages=5, expire=999999.0),
+            ), 1000002.0),
+            (dict(
+                uuid='uuid3',
+                params=dict(param='foo'),
+                bucket=dict(messages=10, expire=1000005.0),
+            ), 1000005.0),
+            (dict(
+                uuid='uuid3',
+                params=dict(param='bar'),
+                bucket=dict(messages=5, expire=1000001.0),
+            ), 1000001.0),
+        ]})
+        limits = [
+            self._make_limit(
+                uuid='uuid',
+                queries=[],
+                verbs=['GET'],
+                unit='minute',
+                uri='/spam/{uri}',
+                value=7,
+            ),
+            self._make_limit(
+                uuid='uuid2',
+                queries=[],
+                verbs=['GET'],
+                unit='minute',
+                uri='/spam/{uri2}/{used}',
+                value=20,
+            ),
+            self._make_limit(
+                uuid='uuid3',
+                queries=[],
+                verbs=['GET'],
+                unit='minute',
+                uri='/spam/{uri3}/{param}',
+                value=50,
+            ),
+            self._make_limit(
+                uuid='uuid4',
                 queries=[],
                 verbs=['GET'],
-                unit='day',
-                uri='/spam/uri4',
-                value=1,
+                unit='minute',
+                uri='/spam/{uri4}/{param}',
+                value=50,
             ),
             self._make_limit(
                 uuid='uuid5',
                 queries=[],
                 verbs=['GET'],
-                unit='1234',
-                uri='/spam/uri5',
-                value=183,
+                unit='minute',
+                uri='/spam/{uri5}',
+                value=10,
+            ),
+        ]
+        midware = mock.Mock(db=db, limits=limits, conf=config.Config())
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }
+
+        nova_limits.nova_postprocess(midware, environ)
+
+        self.assertEqual(environ['nova.limits'], [
+            dict(
+                verb='GET',
+                URI='/spam/{uri}',
+                regex='/spam/{uri}',
+                value=7,
+                unit='MINUTE',
+                remaining=2,
+                resetTime=1000001.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/{uri2}/{used}',
+                regex='/spam/{uri2}/{used}',
+                value=20,
+                unit='MINUTE',
+                remaining=5,
+                resetTime=999999.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/{uri3}/foo',
+                regex='/spam/{uri3}/foo',
+                value=50,
+                unit='MINUTE',
+                remaining=10,
+                resetTime=1000005.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/{uri3}/bar',
+                regex='/spam/{uri3}/bar',
+                value=50,
+                unit='MINUTE',
+                remaining=5,
+                resetTime=1000001.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/{uri3}/{param}',
+                regex='/spam/{uri3}/{param}',
+                value=50,
+                unit='MINUTE',
+                remaining=5,
+                resetTime=1000005.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/{uri4}/{param}',
+                regex='/spam/{uri4}/{param}',
+                value=50,
+                unit='MINUTE',
+                remaining=50,
+                resetTime=1000000.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/{uri5}',
+                regex='/spam/{uri5}',
+                value=10,
+                unit='MINUTE',
+                remaining=10,
+                resetTime=1000000.0,
+            ),
+        ])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits_drained_buckets(self, mock_decode, mock_time):
+        db = mock.Mock(**{'zrange.return_value': [
+            (dict(
+                uuid='uuid',
+                params=dict(param='foo'),
+                bucket=dict(messages=2, expire=1000001.0),
+            ), 1000001.0),
+            (dict(
+                uuid='uuid',
+                params=dict(param='bar'),
+                bucket=dict(messages=3, expire=999990.0),
+            ), 999990.0),
+            (dict(
+                uuid='uuid2',
+                params={},
+                bucket=dict(messages=1, expire=1000000.0),
+            ), 1000000.0),
+        ]})
+        limits = [
+            self._make_limit(
+                uuid='uuid',
+                queries=[],
+                verbs=['GET'],
+                unit='minute',
+                uri='/spam/{param}',
+                value=7,
             ),
             self._make_limit(
-                uuid='uuid6',
-                queries=['bravo', 'alfa'],
+                uuid='uuid2',
+                queries=[],
                 verbs=['GET'],
-                unit='day',
-                uri='/spam/uri6',
-                value=1,
+                unit='minute',
+                uri='/spam',
+                value=10,
+            ),
+        ]
+        midware = mock.Mock(db=db, limits=limits, conf=config.Config())
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }
+
+        nova_limits.nova_postprocess(midware, environ)
+
+        self.assertEqual(environ['nova.limits'], [
+            dict(
+                verb='GET',
+                URI='/spam/foo',
+                regex='/spam/foo',
+                value=7,
+                unit='MINUTE',
+                remaining=2,
+                resetTime=1000001.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/bar',
+                regex='/spam/bar',
+                value=7,
+                unit='MINUTE',
+                remaining=7,
+                resetTime=999990.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam/{param}',
+                regex='/spam/{param}',
+                value=7,
+                unit='MINUTE',
+                remaining=2,
+                resetTime=1000001.0,
+            ),
+            dict(
+                verb='GET',
+                URI='/spam',
+                regex='/spam',
+                value=10,
+                unit='MINUTE',
+                remaining=10,
+                resetTime=1000000.0,
+            ),
+        ])
+        self.assertEqual(limits[0].load.call_count, 1)
+        self.assertFalse(limits[1].load.called)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits_grace(self, mock_decode, mock_time):
+        db = mock.Mock(**{'zrange.return_value': [
+            (dict(
+                uuid='uuid',
+                params={},
+                bucket=dict(messages=2, expire=1000001.0),
+            ), 1000001.0),
+        ]})
+        limits = [
+            self._make_limit(
+                uuid='uuid',
+                queries=[],
+                verbs=['GET'],
+                unit='minute',
+                uri='/spam',
+                value=7,
+            ),
+        ]
+        midware = mock.Mock(db=db, limits=limits, conf=config.Config(
+            conf_dict={'nova_limits.bucket_grace': '1'}))
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.bucket_set': 'bucket_set:spam',
+        }
+
+        nova_limits.nova_postprocess(midware, environ)
+
+        self.assertEqual(environ['nova.limits'], [
+            dict(
+                verb='GET',
+                URI='/spam',
+                regex='/spam',
+                value=7,
+                unit='MINUTE',
+                remaining=7,
+                resetTime=1000001.0,
+            ),
+        ])
+        self.assertFalse(limits[0].load.called)
+
+    def _cache_setup(self, version=None, updated=False, cacheable=True):
+        db = mock.Mock(**{
+            'get.return_value': version,
+            'pipeline.return_value.execute.return_value': [8, True],
+            'zrange.return_value': [
+                (dict(
+                    uuid='uuid',
+                    params={},
+                    bucket=dict(messages=2, expire=1000010.0),
+                ), 1000010.0),
+            ],
+        })
+        limits = [
+            self._make_limit(
+                uuid='uuid',
+                queries=[],
+                verbs=['GET'],
+                unit='minute',
+                uri='/spam',
+                value=7,
             ),
         ]
-        midware = mock.Mock(db=db, limits=limits)
-        environ = {
-            'turnstile.nova.limitclass': 'lim_class',
-            'turnstile.bucket_set': 'bucket_set:spam',
-        }
+        if cacheable:
+            limits[0].rate_class = 'lim_class'
+            limits[0].cost = None
+            limits[0].__class__ = nova_limits.NovaClassLimit
+        midware = mock.Mock(db=db, limits=limits, limit_sum='sum',
+                            conf=config.Config(conf_dict={
+                                'nova_limits.limits_cache': 'yes',
+                            }))
+        environ = {
+            'turnstile.conf': midware.conf,
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.bucket_set': 'bucket_set:spam',
+            'turnstile.nova.version_key': 'limits_version:spam',
+        }
+        if updated:
+            environ['turnstile.nova.updated'] = True
+
+        return midware, environ
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits_cache_miss(self, mock_decode, mock_time):
+        midware, environ = self._cache_setup('7')
+        db = midware.db
+
+        nova_limits.nova_postprocess(midware, environ)
+
+        lims = [dict(
+            verb='GET',
+            URI='/spam',
+            regex='/spam',
+            value=7,
+            unit='MINUTE',
+            remaining=2,
+            resetTime=1000010.0,
+        )]
+        etag = '"%s"' % hashlib.md5(
+            repr(('lim_class', 'sum', 7, 1.0, 1000010.0))).hexdigest()
+        self.assertEqual(environ['nova.limits'], lims)
+        self.assertEqual(environ['turnstile.nova.etag'], etag)
+        db.get.assert_called_once_with('limits_version:spam')
+        self.assertFalse(db.pipeline.called)
+        state = nova_limits._get_state(midware)
+        self.assertEqual(state.limits_cache.items(), [
+            ('spam', ((('lim_class', 'sum', 7, 1.0), lims, 1000010.0, etag),
+                      1000010.0)),
+        ])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits_cache_hit(self, mock_decode, mock_time):
+        midware, environ = self._cache_setup('7')
+        db = midware.db
+        state = nova_limits._get_state(midware)
+        state.limits_cache.store(
+            'spam', (('lim_class', 'sum', 7, 1.0), 'lims', 1000001.0,
+                     '"etag"'), 1000001.0)
+
+        nova_limits.nova_postprocess(midware, environ)
+
+        self.assertEqual(environ['nova.limits'], 'lims')
+        self.assertEqual(environ['turnstile.nova.etag'], '"etag"')
+        self.assertFalse(db.zrange.called)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits_cache_stale(self, mock_decode, mock_time):
+        midware, environ = self._cache_setup(updated=True)
+        db = midware.db
+        state = nova_limits._get_state(midware)
+        state.limits_cache.store(
+            'spam', (('lim_class', 'sum', 7, 1.0), 'lims', 1000001.0,
+                     '"etag"'), 1000001.0)
+
+        nova_limits.nova_postprocess(midware, environ)
+
+        self.assertEqual(environ['nova.limits'][0]['remaining'], 2)
+        self.assertEqual(state.limits_cache.lookup('spam', 1000000.0)[0],
+                         ('lim_class', 'sum', 8, 1.0))
+        self.assertFalse(db.get.called)
+        db.pipeline.return_value.incr.assert_called_once_with(
+            'limits_version:spam')
+        db.zrange.assert_called_once_with('bucket_set:spam', 0, -1,
+                                          withscores=True)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits_cache_own_update(self, mock_decode, mock_time):
+        # A request for the limits which updates a bucket itself
+        # still uses the cached copy, and keeps it for the next
+        midware, environ = self._cache_setup(updated=True)
+        environ.update(REQUEST_METHOD='GET', PATH_INFO='/v2/spam/limits')
+        db = midware.db
+        state = nova_limits._get_state(midware)
+        state.limits_cache.store(
+            'spam', (('lim_class', 'sum', 7, 1.0), 'lims', 1000001.0,
+                     '"etag"'), 1000001.0)
+
+        nova_limits.nova_postprocess(midware, environ)
+
+        self.assertEqual(environ['nova.limits'], 'lims')
+        self.assertFalse(db.zrange.called)
+        self.assertEqual(state.limits_cache.items(), [
+            ('spam', ((('lim_class', 'sum', 8, 1.0), 'lims', 1000001.0,
+                       '"etag"'), 1000001.0)),
+        ])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits_cache_polls(self, mock_decode, mock_time):
+        # Poll /limits repeatedly under a matching NovaClassLimit
+        midware, environ = self._cache_setup()
+        db = midware.db
+        db.pipeline.return_value.execute.side_effect = [
+            [version, True] for version in range(1, 6)]
+
+        etags = set()
+        for _i in range(5):
+            environ = dict(environ, REQUEST_METHOD='GET',
+                           PATH_INFO='/v2/spam/limits')
+            environ['turnstile.nova.updated'] = True
+            nova_limits.nova_postprocess(midware, environ)
+
+            self.assertEqual(environ['nova.limits'][0]['remaining'], 2)
+            etags.add(environ['turnstile.nova.etag'])
+        self.assertEqual(len(etags), 1)
+
+        # Only the first poll computes the limits
+        self.assertEqual(db.zrange.call_count, 1)
+        self.assertEqual(db.pipeline.return_value.incr.call_count, 5)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('turnstile.limits.BucketKey.decode',
+                side_effect=lambda key: mock.Mock(**key))
+    def test_limits_not_cacheable(self, mock_decode, mock_time):
+        # Limits other than NovaClassLimit limits don't bump the
+        # version, so their buckets may have changed
+        midware, environ = self._cache_setup('7', cacheable=False)
+        db = midware.db
+        state = nova_limits._get_state(midware)
+        state.limits_cache.store(
+            'spam', (('lim_class', 'sum', 7, 1.0), 'lims', 1000001.0,
+                     '"etag"'), 1000001.0)
+
+        nova_limits.nova_postprocess(midware, environ)
+
+        self.assertEqual(environ['nova.limits'][0]['remaining'], 2)
+        self.assertNotIn('turnstile.nova.etag', environ)
+        self.assertFalse(db.get.called)
+        self.assertEqual(state.limits_cache.lookup('spam', 1000000.0),
+                         (('lim_class', 'sum', 7, 1.0), 'lims', 1000001.0,
+                          '"etag"'))
+
+
+class TestNovaBucket(unittest2.TestCase):
+    def setUp(self):
+        self.lim = nova_limits.NovaClassLimit('db', uri='/spam', value=10,
+                                              unit='minute',
+                                              rate_class='lim_class')
+
+    def test_delay_default_cost(self):
+        bucket = nova_limits.NovaBucket('db', self.lim, 'key')
+
+        result = bucket.delay({}, now=1000000.0)
+
+        self.assertEqual(result, None)
+        self.assertEqual(bucket.level, 6.0)
+        self.assertEqual(bucket.last, 1000000.0)
+        self.assertEqual(bucket.next, 1000000.0)
+        self.assertEqual(bucket.messages, 9)
+
+    def test_delay_cost(self):
+        bucket = nova_limits.NovaBucket('db', self.lim, 'key')
+
+        result = bucket.delay(dict(cost=4), now=1000000.0)
+
+        self.assertEqual(result, None)
+        self.assertEqual(bucket.level, 24.0)
+        self.assertEqual(bucket.messages, 6)
+
+    def test_delay_too_full(self):
+        bucket = nova_limits.NovaBucket('db', self.lim, 'key', last=999990.0,
+                                        next=999990.0, level=40.0)
+
+        result = bucket.delay(dict(cost=5), now=1000000.0)
+
+        self.assertEqual(result, None)
+        self.assertEqual(bucket.level, 60.0)
+        self.assertEqual(bucket.last, 1000000.0)
+
+        result = bucket.delay({}, now=1000000.0)
+
+        self.assertEqual(result, 6.0)
+        self.assertEqual(bucket.level, 60.0)
+        self.assertEqual(bucket.next, 1000006.0)
+
+    def test_delay_past(self):
+        bucket = nova_limits.NovaBucket('db', self.lim, 'key',
+                                        last=1000000.0, level=0.0)
+
+        bucket.delay({}, now=999999.0)
+
+        self.assertEqual(bucket.last, 1000000.0)
+
+
+class TestBuildLimits(unittest2.TestCase):
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_weighted(self, mock_time):
+        db = mock.Mock()
+        lim = nova_limits.NovaClassLimit(db, uri='/servers', value=60,
+                                         unit='minute', verbs=['GET', 'POST'],
+                                         rate_class='default',
+                                         cost={'POST': 10})
+        key = lim.key(dict(tenant='spam'))
+        db.lrange.return_value = [msgpack.dumps(dict(
+            uuid='update%d' % i,
+            update=dict(params=dict(tenant='spam', cost=cost),
+                        time=1000000.0),
+        )) for i, cost in enumerate([10, 1, 10])]
+        buckets = nova_limits._index_buckets([(key, 1000021.0)])
+
+        result = nova_limits._build_limits(
+            [(lim, '/servers', ['GET', 'POST'], 'MINUTE')], buckets,
+            lambda turns_lim, key: turns_lim.load(key), 1000000.0,
+            1000000.0)
+
+        self.assertEqual(result, [
+            dict(verb='GET', URI='/servers', regex='/servers', value=60,
+                 unit='MINUTE', remaining=39, resetTime=1000021, cost=1),
+            dict(verb='POST', URI='/servers', regex='/servers', value=60,
+                 unit='MINUTE', remaining=39, resetTime=1000021, cost=10),
+        ])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_multiplier(self, mock_time):
+        db = mock.Mock()
+        lim = nova_limits.NovaClassLimit(db, uri='/servers', value=60,
+                                         unit='minute', verbs=['GET'],
+                                         rate_class='default')
+        other = mock.Mock(value=10, spec=['value', 'uuid'])
+        key = lim.key(dict(tenant='spam'))
+        db.lrange.return_value = [msgpack.dumps(dict(
+            uuid='update',
+            update=dict(params=dict(tenant='spam', cost=5.0),
+                        time=1000000.0),
+        ))]
+        buckets = nova_limits._index_buckets([(key, 1000005.0)])
+
+        result = nova_limits._build_limits(
+            [(lim, '/servers', ['GET'], 'MINUTE'),
+             (other, '/images', ['GET'], 'MINUTE')], buckets,
+            lambda turns_lim, key: turns_lim.load(key), 1000000.0,
+            1000000.0, multiplier=0.5)
+
+        self.assertEqual(result, [
+            dict(verb='GET', URI='/servers', regex='/servers', value=30,
+                 unit='MINUTE', remaining=27, resetTime=1000005,
+                 multiplier=0.5),
+            dict(verb='GET', URI='/images', regex='/images', value=10,
+                 unit='MINUTE', remaining=10, resetTime=1000000.0),
+        ])
+
+
+class TestNovaClassLimit(unittest2.TestCase):
+    def setUp(self):
+        self.lim = nova_limits.NovaClassLimit('db', uri='/spam', value=18,
+                                              unit='second',
+                                              rate_class='lim_class')
+
+    def test_cost_default(self):
+        self.assertEqual(self.lim.cost, {})
+        self.assertEqual(self.lim.unit_cost, 1.0 / 18)
+        self.assertEqual(self.lim.units('GET'), 1)
+        self.assertIs(self.lim.bucket_class, nova_limits.NovaBucket)
+
+    def test_cost(self):
+        lim = nova_limits.NovaClassLimit('db', uri='/spam', value=100,
+                                         unit='minute', rate_class='lim_class',
+                                         cost={'post': 10, '*': 2})
+
+        self.assertEqual(lim.cost, {'POST': 10, '*': 2})
+        self.assertEqual(lim.unit_cost, 0.6)
+        self.assertEqual(lim.units('POST'), 10)
+        self.assertEqual(lim.units('get'), 2)
+        self.assertEqual(lim.dehydrate()['cost'], {'POST': 10, '*': 2})
+
+    def test_route_base(self):
+        route_args = {}
+        result = self.lim.route('/spam', route_args)
+
+        self.assertEqual(result, '/spam')
+
+    def test_route_v1(self):
+        route_args = {}
+        result = self.lim.route('/v1.1/spam', route_args)
+
+        self.assertEqual(result, '/spam')
+
+    def test_route_v2(self):
+        route_args = {}
+        result = self.lim.route('/v2/spam', route_args)
+
+        self.assertEqual(result, '/spam')
+
+    def test_route_v1_base(self):
+        route_args = {}
+        result = self.lim.route('/v1.1', route_args)
+
+        self.assertEqual(result, '/v1.1')
+
+    def test_route_v2_base(self):
+        route_args = {}
+        result = self.lim.route('/v2', route_args)
+
+        self.assertEqual(result, '/v2')
+
+    def test_filter_noclass(self):
+        environ = {
+            'turnstile.nova.tenant': 'tenant',
+        }
+        params = {}
+        unused = {}
+        with self.assertRaises(limits.DeferLimit):
+            self.lim.filter(environ, params, unused)
+
+        self.assertEqual(environ, {
+            'turnstile.nova.tenant': 'tenant',
+        })
+        self.assertEqual(params, {})
+        self.assertEqual(unused, {})
+
+    def test_filter_notenant(self):
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+        }
+        params = {}
+        unused = {}
+        with self.assertRaises(limits.DeferLimit):
+            self.lim.filter(environ, params, unused)
+
+        self.assertEqual(environ, {
+            'turnstile.nova.limitclass': 'lim_class',
+        })
+        self.assertEqual(params, {})
+        self.assertEqual(unused, {})
+
+    def test_filter_wrong_class(self):
+        environ = {
+            'turnstile.nova.limitclass': 'spam',
+            'turnstile.nova.tenant': 'tenant',
+        }
+        params = {}
+        unused = {}
+        with self.assertRaises(limits.DeferLimit):
+            self.lim.filter(environ, params, unused)
+
+        self.assertEqual(environ, {
+            'turnstile.nova.limitclass': 'spam',
+            'turnstile.nova.tenant': 'tenant',
+        })
+        self.assertEqual(params, {})
+        self.assertEqual(unused, {})
+
+    def test_filter(self):
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+        }
+        params = {}
+        unused = {}
+        self.lim.filter(environ, params, unused)
+
+        self.assertEqual(environ, {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+        })
+        self.assertEqual(params, dict(tenant='tenant'))
+        self.assertEqual(unused, {})
+
+    def test_filter_cost(self):
+        lim = nova_limits.NovaClassLimit('db', uri='/spam', value=100,
+                                         unit='minute', rate_class='lim_class',
+                                         cost={'POST': 10})
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+        }
+        params = {}
+
+        result = lim.filter(environ, params, {})
+
+        self.assertEqual(result, dict(cost=10))
+        self.assertEqual(params, dict(tenant='tenant'))
+
+    def test_filter_multiplier(self):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.nova.multiplier': 0.5,
+        }
+
+        result = self.lim.filter(environ, {}, {})
+
+        self.assertEqual(result, dict(cost=2.0))
+
+    def test_filter_cost_multiplier(self):
+        lim = nova_limits.NovaClassLimit('db', uri='/spam', value=100,
+                                         unit='minute', rate_class='lim_class',
+                                         cost={'POST': 10})
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.nova.multiplier': 4.0,
+        }
+
+        result = lim.filter(environ, {}, {})
+
+        self.assertEqual(result, dict(cost=2.5))
+
+    def test_filter_version(self):
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.nova.version_key': 'limits_version:tenant',
+        }
+        params = {}
+        unused = {}
+        self.lim.filter(environ, params, unused)
+
+        self.assertEqual(environ, {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.nova.version_key': 'limits_version:tenant',
+            'turnstile.nova.updated': True,
+        })
+        self.assertEqual(params, dict(tenant='tenant'))
+
+    def test_filter_limit_set(self):
+        environ = {
+            'turnstile.nova.limitclass': 'gold',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.nova.limit_set': frozenset([self.lim.uuid]),
+        }
+        params = {}
+        self.lim.filter(environ, params, {})
+
+        self.assertEqual(params, dict(tenant='tenant'))
+
+    def test_filter_limit_set_excluded(self):
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.nova.limit_set': frozenset(['other']),
+        }
+        with self.assertRaises(limits.DeferLimit):
+            self.lim.filter(environ, {}, {})
+
+    @mock.patch.object(limits.Limit, '_filter', return_value=True)
+    def test_underscore_filter_not_atomic(self, mock_filter):
+        environ = {}
+        params = {}
+
+        result = self.lim._filter(environ, params)
+
+        self.assertEqual(result, True)
+        mock_filter.assert_called_once_with(environ, params)
+
+    def _atomic_limit(self, script_result, **kwargs):
+        script = mock.Mock(return_value=script_result)
+        db = mock.Mock(**{'register_script.return_value': script})
+        lim = nova_limits.NovaClassLimit(db, uri='/spam', value=18,
+                                         unit='minute', rate_class='lim_class',
+                                         atomic=True, **kwargs)
+        return lim, db, script
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('uuid.uuid4',
+                side_effect=['limit'] + ['update', 'summarize'] * 2)
+    def test_underscore_filter_atomic(self, mock_uuid4, mock_time):
+        lim, db, script = self._atomic_limit([None, '1000000', '1000000',
+                                              '3.3333333333333335', None])
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.bucket_set': 'bucket_set:tenant',
+        }
+        params = dict(other='spam')
+
+        result = lim._filter(environ, params)
+
+        self.assertEqual(result, False)
+        self.assertNotIn('turnstile.delay', environ)
+        self.assertEqual(params, dict(tenant='tenant', other='spam'))
+        db.register_script.assert_called_once_with(
+            nova_limits._BUCKET_SCRIPT)
+        key = lim.key(dict(tenant='tenant'))
+        script.assert_called_once_with(
+            keys=[key, 'bucket_set:tenant', 'compactor', ''],
+            args=[mock.ANY, 'update', '1000000.0', '60.0',
+                  repr(60.0 / 18), '0.1', 0, 600, mock.ANY, 0, 0])
+        args = script.call_args[1]['args']
+        self.assertEqual(msgpack.loads(args[0]), dict(
+            uuid='update',
+            update=dict(params=dict(tenant='tenant', other='spam'),
+                        time=1000000.0),
+        ))
+        self.assertEqual(msgpack.loads(args[8]), dict(
+            summarize=1000000.0,
+            uuid='summarize',
+        ))
+
+        # The script is only registered once
+        lim._filter(environ, params)
+        self.assertEqual(db.register_script.call_count, 1)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_underscore_filter_atomic_cost(self, mock_time):
+        lim, db, script = self._atomic_limit([None, '1000000', '1000000',
+                                              '15', None], cost={'POST': 5})
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+        }
+
+        lim._filter(environ, {})
+
+        args = script.call_args[1]['args']
+        self.assertEqual(args[4], repr(60.0 / 18))
+        self.assertEqual(msgpack.loads(args[0])['update']['params'],
+                         dict(tenant='tenant', cost=5))
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_underscore_filter_atomic_bucket_set_ttl(self, mock_time):
+        lim, db, script = self._atomic_limit([None, '1000000', '1000000',
+                                              '3.3333333333333335', None])
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.bucket_set': 'bucket_set:tenant',
+            'turnstile.nova.bucket_set_ttl': 3601,
+        }
+
+        lim._filter(environ, {})
+
+        self.assertEqual(script.call_args[1]['args'][9], 3601)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_underscore_filter_atomic_version(self, mock_time):
+        lim, db, script = self._atomic_limit([None, '1000000', '1000000',
+                                              '3.3333333333333335', 8])
+        environ = {
+            'turnstile.conf': config.Config(conf_dict={
+                'nova_limits.limits_version_ttl': '3600',
+            }),
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.nova.version_key': 'limits_version:tenant',
+            'turnstile.nova.bumps': 1,
+        }
+
+        lim._filter(environ, {})
+
+        self.assertEqual(script.call_args[1]['keys'][3],
+                         'limits_version:tenant')
+        self.assertEqual(script.call_args[1]['args'][10], 3600)
+        self.assertEqual(environ['turnstile.nova.version'], 8)
+        self.assertEqual(environ['turnstile.nova.bumps'], 2)
+        self.assertNotIn('turnstile.nova.updated', environ)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_underscore_filter_atomic_delay(self, mock_time):
+        lim, db, script = self._atomic_limit(['1.5', '1000000',
+                                              '1000001.5', '59', None],
+                                             continue_scan=False)
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+            'turnstile.conf': config.Config(conf_dict={
+                'compactor.max_updates': '10',
+                'compactor.max_age': '300',
+                'compactor.compactor_key': 'compact',
+            }),
+        }
+
+        result = lim._filter(environ, {})
+
+        self.assertEqual(result, True)
+        self.assertEqual(script.call_args[1]['keys'][1:],
+                         ['', 'compact', ''])
+        self.assertEqual(script.call_args[1]['args'][6:8], [10, 300])
+        self.assertEqual(len(environ['turnstile.delay']), 1)
+        delay, delay_lim, bucket = environ['turnstile.delay'][0]
+        self.assertEqual(delay, 1.5)
+        self.assertIs(delay_lim, lim)
+        self.assertEqual((bucket.last, bucket.next, bucket.level),
+                         (1000000.0, 1000001.5, 59.0))
+
+    def test_underscore_filter_atomic_defer(self):
+        lim, db, script = self._atomic_limit(None)
+
+        result = lim._filter({}, {})
+
+        self.assertEqual(result, False)
+        self.assertFalse(script.called)
+
+    def test_underscore_filter_atomic_queries(self):
+        lim, db, script = self._atomic_limit(None, queries=['a'])
+        environ = {
+            'turnstile.nova.limitclass': 'lim_class',
+            'turnstile.nova.tenant': 'tenant',
+        }
+
+        self.assertEqual(lim._filter(environ, {}), False)
+        environ['QUERY_STRING'] = 'b=1'
+        self.assertEqual(lim._filter(environ, {}), False)
+        self.assertFalse(script.called)
+
+
+class TestEtagMatch(unittest2.TestCase):
+    def test_no_header(self):
+        self.assertFalse(nova_limits._etag_match(None, 'W/"1-abc"'))
+
+    def test_match(self):
+        self.assertTrue(nova_limits._etag_match('W/"1-abc"', 'W/"1-abc"'))
+        self.assertTrue(nova_limits._etag_match('"1-abc"', 'W/"1-abc"'))
+        self.assertTrue(nova_limits._etag_match('"x", W/"1-abc"',
+                                                'W/"1-abc"'))
+        self.assertTrue(nova_limits._etag_match('*', 'W/"1-abc"'))
+
+    def test_no_match(self):
+        self.assertFalse(nova_limits._etag_match('W/"2-abc"', 'W/"1-abc"'))
+        self.assertFalse(nova_limits._etag_match('"x", "y"', 'W/"1-abc"'))
+
+
+class TestNovaTurnstileMiddleware(unittest2.TestCase):
+    @mock.patch.object(middleware.TurnstileMiddleware, '__init__',
+                       return_value=None)
+    @mock.patch.object(nova_limits, '_get_state')
+    def setUp(self, mock_get_state, mock_init):
+        self.app = mock.Mock(return_value=['body'])
+        self.midware = nova_limits.NovaTurnstileMiddleware(self.app, {})
+
+        mock_init.assert_called_once_with(self.app, {})
+        mock_get_state.assert_called_once_with(self.midware)
+
+    def test_init(self):
+        self.assertEqual(self.midware.nova_app, self.app)
+        self.assertEqual(self.midware.app, self.midware.call_app)
+
+    @mock.patch.object(middleware.TurnstileMiddleware, '__call__',
+                       return_value=['body'])
+    @mock.patch.object(nova_limits, '_get_state')
+    def test_call(self, mock_get_state, mock_call):
+        profiler = mock_get_state.return_value.profiler
+        profiler.sample.return_value = False
+        environ = {}
+
+        result = self.midware(environ, 'start_response')
+
+        self.assertEqual(result, ['body'])
+        mock_get_state.assert_called_once_with(self.midware)
+        profiler.sample.assert_called_once_with(environ)
+        mock_call.assert_called_once_with(environ, 'start_response')
+        self.assertFalse(profiler.start.called)
+        self.assertEqual(environ, {})
+
+    @mock.patch.object(middleware.TurnstileMiddleware, '__call__',
+                       return_value=['body'])
+    @mock.patch.object(nova_limits, '_get_state')
+    def test_call_profiled(self, mock_get_state, mock_call):
+        profiler = mock_get_state.return_value.profiler
+        profiler.sample.return_value = True
+        environ = {}
+
+        result = self.midware(environ, 'start_response')
+
+        self.assertEqual(result, ['body'])
+        mock_call.assert_called_once_with(environ, 'start_response')
+        self.assertEqual(environ, {
+            'turnstile.nova.profile': profiler.start.return_value,
+        })
+        profiler.stop.assert_called_once_with(profiler.start.return_value)
+
+    @mock.patch.object(middleware.TurnstileMiddleware, '__call__',
+                       side_effect=Exception('failed'))
+    @mock.patch.object(nova_limits, '_get_state')
+    def test_call_profiled_error(self, mock_get_state, mock_call):
+        profiler = mock_get_state.return_value.profiler
+        profiler.sample.return_value = True
+
+        self.assertRaises(Exception, self.midware, {}, 'start_response')
+        profiler.stop.assert_called_once_with(profiler.start.return_value)
+
+    def test_call_app_profiled(self):
+        prof = mock.Mock()
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/v2/spam/servers',
+            'turnstile.nova.profile': prof,
+        }
+        start_response = mock.Mock()
+
+        result = self.midware.call_app(environ, start_response)
+
+        self.assertEqual(result, ['body'])
+        prof.disable.assert_called_once_with()
+        self.app.assert_called_once_with(environ, start_response)
+
+    def test_call_app_no_etag(self):
+        environ = dict(REQUEST_METHOD='GET', PATH_INFO='/v2/spam/limits')
+        start_response = mock.Mock()
+
+        result = self.midware.call_app(environ, start_response)
+
+        self.assertEqual(result, ['body'])
+        self.app.assert_called_once_with(environ, start_response)
+
+    def test_call_app_other_request(self):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/v2/spam/servers',
+            'turnstile.nova.etag': '"etag"',
+            'HTTP_IF_NONE_MATCH': '"etag"',
+        }
+        start_response = mock.Mock()
+
+        result = self.midware.call_app(environ, start_response)
+
+        self.assertEqual(result, ['body'])
+        self.app.assert_called_once_with(environ, start_response)
+
+    def _limits_app(self, status='200 OK'):
+        def app(environ, start_response):
+            start_response(status, [('Content-Type', 'application/json')])
+            return ['{"limits": {}}']
+
+        self.midware.nova_app = mock.Mock(side_effect=app)
+
+    def test_call_app_head(self):
+        environ = {
+            'REQUEST_METHOD': 'HEAD',
+            'PATH_INFO': '/v2/spam/limits',
+            'turnstile.nova.etag': '"etag"',
+        }
+        start_response = mock.Mock()
+
+        result = self.midware.call_app(environ, start_response)
+
+        self.assertEqual(result, ['body'])
+        self.app.assert_called_once_with(environ, start_response)
+
+    def test_call_app_not_modified(self):
+        self._limits_app()
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/v2/spam/limits.json',
+            'turnstile.nova.etag': '"etag"',
+            'HTTP_IF_NONE_MATCH': '"etag"',
+        }
+        start_response = mock.Mock()
+
+        self.assertEqual(self.midware.call_app(environ, start_response), [])
+        start_response.assert_called_once_with('304 Not Modified',
+                                               [('ETag', '"etag"')])
+
+        # Nova isn't called at all
+        self.assertFalse(self.midware.nova_app.called)
+
+    def test_call_app_modified(self):
+        self._limits_app()
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/v2/spam/limits',
+            'turnstile.nova.etag': '"etag"',
+            'HTTP_IF_NONE_MATCH': '"abc"',
+        }
+        start_response = mock.Mock()
+
+        body = self.midware.call_app(environ, start_response)
+
+        self.assertEqual(body, ['{"limits": {}}'])
+        start_response.assert_called_once_with('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('ETag', '"etag"'),
+        ], None)
+
+    def test_call_app_error(self):
+        self._limits_app('500 Internal Error')
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/v2/spam/limits',
+            'turnstile.nova.etag': '"etag"',
+            'HTTP_IF_NONE_MATCH': '"abc"',
+        }
+        start_response = mock.Mock()
+
+        body = self.midware.call_app(environ, start_response)
+
+        self.assertEqual(body, ['{"limits": {}}'])
+        start_response.assert_called_once_with('500 Internal Error', [
+            ('Content-Type', 'application/json'),
+        ], None)
+
+
+class TestNovaTurnstileMiddlewareInFlight(unittest2.TestCase):
+    @mock.patch.object(middleware.TurnstileMiddleware, '__init__',
+                       return_value=None)
+    @mock.patch.object(nova_limits, '_get_state')
+    def setUp(self, mock_get_state, mock_init):
+        self.app = mock.Mock(return_value=['body'])
+        self.midware = nova_limits.NovaTurnstileMiddleware(self.app, {})
+        self.midware.formatter = mock.Mock(return_value='rejected')
+        self.inflight = nova_limits.InFlight(dict(default=1))
+        self.state = mock.Mock(inflight=self.inflight, adaptive=None)
+        self.environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/v2/spam/servers/detail',
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'default',
+        }
+
+        patcher = mock.patch.dict(nova_limits._states,
+                                  {self.midware: self.state})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(nova_limits.NovaTurnstileMiddleware,
+                                    'db', mock.Mock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_state(self):
+        del nova_limits._states[self.midware]
+
+        result = self.midware.call_app(self.environ, 'start_response')
+
+        self.assertEqual(result, ['body'])
+
+    def test_no_tenant(self):
+        del self.environ['turnstile.nova.tenant']
+
+        result = self.midware.call_app(self.environ, 'start_response')
+
+        self.assertEqual(result, ['body'])
+        self.assertEqual(self.inflight.counts, {})
+
+    def test_in_flight(self):
+        result = self.midware.call_app(self.environ, 'start_response')
+
+        self.assertIsInstance(result, nova_limits._InFlightBody)
+        self.assertEqual(list(result), ['body'])
+        self.assertEqual(self.inflight.counts, {'inflight:spam': 1})
+        self.app.assert_called_once_with(self.environ, 'start_response')
+
+        result.close()
+
+        self.assertEqual(self.inflight.counts, {})
+
+    def test_rejected(self):
+        first = self.midware.call_app(self.environ, 'start_response')
+
+        result = self.midware.call_app(self.environ, 'start_response')
+
+        self.assertEqual(result, 'rejected')
+        self.assertEqual(self.app.call_count, 1)
+        self.assertEqual(self.midware.formatter.call_count, 1)
+        delay, limit, bucket, environ, start_response = \
+            self.midware.formatter.call_args[0]
+        self.assertEqual(delay, 1.0)
+        self.assertIsInstance(limit, nova_limits.InFlightLimit)
+        self.assertEqual(limit.scope, 'tenant')
+        self.assertEqual(limit.name, 'spam')
+        self.assertEqual(limit.value, 1)
+        self.assertEqual(bucket, None)
+        self.assertEqual(environ, self.environ)
+        self.assertEqual(start_response, 'start_response')
+
+        first.close()
+        result = self.midware.call_app(self.environ, 'start_response')
+
+        self.assertIsInstance(result, nova_limits._InFlightBody)
+
+    @mock.patch('time.time', side_effect=[1000000.0, 1000002.5])
+    def test_latency(self, mock_time):
+        self.state.inflight = None
+        self.state.adaptive = nova_limits.AdaptiveLimits(1.0)
+
+        result = self.midware.call_app(self.environ, 'start_response')
+        result.close()
+
+        self.assertEqual(self.state.adaptive.latency,
+                         {33333: dict(default=[2.5, 1])})
+
+    @mock.patch('time.time', side_effect=[1000000.0, 1000002.5])
+    def test_latency_app_fails(self, mock_time):
+        self.state.adaptive = nova_limits.AdaptiveLimits(1.0)
+        self.app.side_effect = Exception('failed')
+
+        self.assertRaises(Exception, self.midware.call_app,
+                          self.environ, 'start_response')
+        self.assertEqual(self.state.adaptive.latency,
+                         {33333: dict(default=[2.5, 1])})
+        self.assertEqual(self.inflight.counts, {})
+
+    def test_app_fails(self):
+        self.app.side_effect = Exception('failed')
+
+        self.assertRaises(Exception, self.midware.call_app,
+                          self.environ, 'start_response')
+        self.assertEqual(self.inflight.counts, {})
+
+
+class TestNovaFormatter(unittest2.TestCase):
+    @mock.patch.object(wsgi, 'OverLimitFault',
+                       return_value=mock.Mock(return_value='rate-limited'))
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_formatter(self, mock_time, mock_OverLimitFault):
+        fault = mock_OverLimitFault.return_value
+        lim = mock.Mock(value=23, uri='/spam', unit='second')
+        environ = dict(REQUEST_METHOD='SPAM')
+
+        result = nova_limits.nova_formatter('status', 18, lim, 'bucket',
+                                            environ, 'start_response')
+
+        self.assertEqual(result, 'rate-limited')
+        mock_OverLimitFault.assert_called_once_with(
+            "This request was rate-limited.",
+            "Only 23 SPAM request(s) can be made to /spam every SECOND.",
+            1000018.0)
+        fault.assert_called_once_with(environ, 'start_response')
+
+    @mock.patch.object(wsgi, 'OverLimitFault',
+                       return_value=mock.Mock(return_value='rate-limited'))
+    @mock.patch.object(nova_limits, '_bump_version')
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_formatter_bump_version(self, mock_time, mock_bump_version,
+                                    mock_OverLimitFault):
+        lim = mock.Mock(value=23, uri='/spam', unit='second')
+        environ = dict(REQUEST_METHOD='SPAM')
+
+        nova_limits.nova_formatter('status', 18, lim, 'bucket', environ,
+                                   'start_response')
+
+        mock_bump_version.assert_called_once_with(lim.db, environ)
+
+    @mock.patch.object(wsgi, 'OverLimitFault',
+                       return_value=mock.Mock(return_value='rate-limited'))
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_formatter_bucket_set_ttl(self, mock_time, mock_OverLimitFault):
+        lim = mock.Mock(value=23, uri='/spam', unit='second')
+        environ = {
+            'REQUEST_METHOD': 'SPAM',
+            'turnstile.bucket_set': 'bucket_set:spam',
+            'turnstile.nova.bucket_set_ttl': 3601,
+        }
+
+        nova_limits.nova_formatter('status', 18, lim, 'bucket', environ,
+                                   'start_response')
+
+        lim.db.expire.assert_called_once_with('bucket_set:spam', 3601)
+
+    @mock.patch.object(wsgi, 'OverLimitFault',
+                       return_value=mock.Mock(return_value='rate-limited'))
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_formatter_hitters(self, mock_time, mock_OverLimitFault):
+        lim = mock.Mock(value=23, uri='/spam', unit='second')
+        hitters = mock.Mock()
+        environ = {
+            'REQUEST_METHOD': 'SPAM',
+            'turnstile.nova.tenant': 'spam',
+            'turnstile.nova.limitclass': 'gold',
+            'turnstile.nova.hitters': hitters,
+        }
+
+        nova_limits.nova_formatter('status', 18, lim, 'bucket', environ,
+                                   'start_response')
+
+        hitters.reject.assert_called_once_with('spam', 'gold')
+
+    @mock.patch.object(wsgi, 'OverLimitFault',
+                       return_value=mock.Mock(return_value='rate-limited'))
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_formatter_weighted(self, mock_time, mock_OverLimitFault):
+        lim = nova_limits.NovaClassLimit(mock.Mock(), uri='/spam', value=100,
+                                         unit='minute', rate_class='default',
+                                         cost={'POST': 10})
+        environ = dict(REQUEST_METHOD='POST')
+
+        nova_limits.nova_formatter('status', 18, lim, 'bucket', environ,
+                                   'start_response')
+
+        mock_OverLimitFault.assert_called_once_with(
+            "This request was rate-limited.",
+            "Only 100 unit(s) of requests can be made to /spam every "
+            "MINUTE; each POST request uses 10 unit(s).",
+            1000018.0)
+
+    @mock.patch.object(wsgi, 'OverLimitFault',
+                       return_value=mock.Mock(return_value='rate-limited'))
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_formatter_multiplier(self, mock_time, mock_OverLimitFault):
+        lim = nova_limits.NovaClassLimit(mock.Mock(), uri='/spam', value=100,
+                                         unit='minute', rate_class='default')
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'turnstile.nova.multiplier': 0.25,
+        }
+
+        nova_limits.nova_formatter('status', 18, lim, 'bucket', environ,
+                                   'start_response')
+
+        mock_OverLimitFault.assert_called_once_with(
+            "This request was rate-limited.",
+            "Only 25 GET request(s) can be made to /spam every MINUTE.",
+            1000018.0)
+
+    @mock.patch.object(wsgi, 'OverLimitFault',
+                       return_value=mock.Mock(return_value='rate-limited'))
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_formatter_inflight(self, mock_time, mock_OverLimitFault):
+        lim = nova_limits.InFlightLimit(mock.Mock(), 'tenant', 'spam', 5)
+        environ = dict(REQUEST_METHOD='SPAM')
+
+        result = nova_limits.nova_formatter('status', 1, lim, None,
+                                            environ, 'start_response')
+
+        self.assertEqual(result, 'rate-limited')
+        mock_OverLimitFault.assert_called_once_with(
+            "This request was rate-limited.",
+            "Only 5 request(s) can be in progress at once for this tenant.",
+            1000001.0)
+
+
+class TestReportLimitClass(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_configured(self):
+        args = mock.Mock(tenant_id='tenant', klass=None)
+
+        result = nova_limits._report_limit_class(args, 'old_class')
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Tenant tenant:\n"
+                         "  Configured rate-limit class: old_class\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_updated(self):
+        args = mock.Mock(tenant_id='tenant', klass='new_class')
+
+        result = nova_limits._report_limit_class(args, 'old_class')
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Tenant tenant:\n"
+                         "  Previous rate-limit class: old_class\n"
+                         "  New rate-limit class: new_class\n")
+
+
+class TestLimitClass(unittest2.TestCase):
+    def test_has_arguments(self):
+        self.assertIsInstance(nova_limits.limit_class, tools.ScriptAdaptor)
+        self.assertGreater(len(nova_limits.limit_class._arguments), 0)
+
+    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+        'get_database.return_value': mock.Mock(**{
+            'get.return_value': 'old_class',
+        }),
+    }))
+    def test_get(self, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = nova_limits.limit_class('config_file', 'spam')
+
+        self.assertEqual(result, 'old_class')
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        db.get.assert_called_once_with('limit-class:spam')
+        self.assertFalse(db.set.called)
+        self.assertFalse(db.delete.called)
+
+    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+        'get_database.return_value': mock.Mock(**{
+            'get.return_value': None,
+        }),
+    }))
+    def test_get_unset(self, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = nova_limits.limit_class('config_file', 'spam')
+
+        self.assertEqual(result, 'default')
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        db.get.assert_called_once_with('limit-class:spam')
+        self.assertFalse(db.set.called)
+        self.assertFalse(db.delete.called)
+
+    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+        'get_database.return_value': mock.Mock(**{
+            'get.return_value': 'old_class',
+        }),
+    }))
+    @mock.patch.object(nova_limits.ClassFilter, 'update')
+    def test_set(self, mock_update, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = nova_limits.limit_class('config_file', 'spam', 'new_class')
+
+        self.assertEqual(result, 'old_class')
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        db.get.assert_called_once_with('limit-class:spam')
+        db.set.assert_called_once_with('limit-class:spam', 'new_class')
+        mock_update.assert_called_once_with(db, 'spam')
+        self.assertFalse(db.delete.called)
+
+    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+        'get_database.return_value': mock.Mock(**{
+            'get.return_value': None,
+        }),
+    }))
+    @mock.patch.object(nova_limits.ClassFilter, 'update')
+    def test_set_unset(self, mock_update, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = nova_limits.limit_class('config_file', 'spam', 'new_class')
+
+        self.assertEqual(result, 'default')
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        db.get.assert_called_once_with('limit-class:spam')
+        db.set.assert_called_once_with('limit-class:spam', 'new_class')
+        mock_update.assert_called_once_with(db, 'spam')
+        self.assertFalse(db.delete.called)
+
+    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+        'get_database.return_value': mock.Mock(**{
+            'get.return_value': 'old_class',
+        }),
+    }))
+    def test_delete(self, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = nova_limits.limit_class('config_file', 'spam', 'default')
+
+        self.assertEqual(result, 'old_class')
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        db.get.assert_called_once_with('limit-class:spam')
+        self.assertFalse(db.set.called)
+        db.delete.assert_called_once_with('limit-class:spam')
+
+    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
+        'get_database.return_value': mock.Mock(**{
+            'get.return_value': None,
+        }),
+    }))
+    def test_delete_unset(self, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = nova_limits.limit_class('config_file', 'spam', 'default')
+
+        self.assertEqual(result, 'default')
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        db.get.assert_called_once_with('limit-class:spam')
+        self.assertFalse(db.set.called)
+        self.assertFalse(db.delete.called)
+
+
+class TestBatches(unittest2.TestCase):
+    def test_batches(self):
+        result = list(nova_limits._batches(xrange(7), 3))
+
+        self.assertEqual(result, [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_batches_exact(self):
+        result = list(nova_limits._batches(xrange(6), 3))
+
+        self.assertEqual(result, [[0, 1, 2], [3, 4, 5]])
+
+
+class TestScanClasses(unittest2.TestCase):
+    def test_scan(self):
+        db = mock.Mock(**{
+            'scan_iter.return_value': iter([
+                'limit-class:spam', 'limit-class:eggs', 'limit-class:bacon',
+            ]),
+            'mget.side_effect': [['gold', None], ['platinum']],
+        })
+
+        result = list(nova_limits._scan_classes(db, 2))
+
+        self.assertEqual(result, [('spam', 'gold'), ('bacon', 'platinum')])
+        db.scan_iter.assert_called_once_with(match='limit-class:*', count=2)
+        db.mget.assert_has_calls([
+            mock.call(['limit-class:spam', 'limit-class:eggs']),
+            mock.call(['limit-class:bacon']),
+        ])
+
+
+class TestReportClassTable(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report(self):
+        result = nova_limits._report_class_table(mock.Mock(), 5)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Wrote 5 tenant(s) to the class table\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_error(self):
+        result = nova_limits._report_class_table(mock.Mock(), 'failed')
+
+        self.assertEqual(result, 'failed')
+        self.assertEqual(sys.stdout.getvalue(), '')
+
+
+class TestLimitClassTable(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'classes')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_has_arguments(self):
+        self.assertIsInstance(nova_limits.limit_class_table,
+                              tools.ScriptAdaptor)
+        self.assertGreater(len(nova_limits.limit_class_table._arguments), 0)
+
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits, '_scan_classes',
+                       return_value=[('spam', 'gold')])
+    @mock.patch.object(nova_limits.ClassTable, 'write', return_value=1)
+    def test_configured_path(self, mock_write, mock_scan_classes,
+                             mock_Config):
+        conf = mock_Config.return_value
+        conf.__getitem__ = mock.Mock(return_value=dict(class_table=self.path))
+        db = conf.get_database.return_value
+
+        result = nova_limits.limit_class_table('config_file')
+
+        self.assertEqual(result, 1)
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        conf.__getitem__.assert_called_once_with('nova_limits')
+        mock_scan_classes.assert_called_once_with(db)
+        mock_write.assert_called_once_with(self.path, dict(spam='gold'))
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock())
+    @mock.patch.object(nova_limits, '_scan_classes',
+                       return_value=[('spam', 'gold')])
+    @mock.patch.object(nova_limits.ClassTable, 'write', return_value=1)
+    def test_explicit_path(self, mock_write, mock_scan_classes, mock_Config):
+        result = nova_limits.limit_class_table('config_file', self.path)
+
+        self.assertEqual(result, 1)
+        mock_write.assert_called_once_with(self.path, dict(spam='gold'))
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock())
+    def test_no_path(self, mock_Config):
+        mock_Config.return_value.__getitem__.return_value = {}
+
+        self.assertRaises(ValueError, nova_limits.limit_class_table,
+                          'config_file')
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock())
+    @mock.patch('fcntl.flock', side_effect=IOError)
+    @mock.patch.object(nova_limits.ClassTable, 'write')
+    def test_locked(self, mock_write, mock_flock, mock_Config):
+        self.assertRaises(ValueError, nova_limits.limit_class_table,
+                          'config_file', self.path)
+        self.assertFalse(mock_write.called)
+
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock())
+    @mock.patch.object(nova_limits, '_scan_classes', return_value=[])
+    @mock.patch.object(nova_limits.ClassTable, 'write', return_value=0)
+    @mock.patch('time.sleep', side_effect=[None, KeyboardInterrupt])
+    def test_interval(self, mock_sleep, mock_write, mock_scan_classes,
+                      mock_Config):
+        self.assertRaises(KeyboardInterrupt, nova_limits.limit_class_table,
+                          'config_file', self.path, 30.0)
+        self.assertEqual(mock_write.call_count, 2)
+        mock_sleep.assert_has_calls([mock.call(30.0), mock.call(30.0)])
+
+
+class TestReportHitters(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report(self):
+        result = nova_limits._report_hitters(mock.Mock(), dict(
+            dumps=2,
+            start=1000000.0,
+            end=1000060.0,
+            requests=[('spam', 10)],
+            rejections=[],
+            classes=dict(default=[10, 2]),
+        ))
+
+        self.assertEqual(result, None)
+        output = sys.stdout.getvalue()
+        self.assertTrue(output.startswith("Merged 2 dump(s) covering "))
+        self.assertIn("Top tenants by requests (estimated):\n"
+                      "    spam%s%10d\n" % (' ' * 37, 10), output)
+        self.assertIn("    default%s%10d %10d\n" % (' ' * 34, 10, 2),
+                      output)
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_no_dumps(self):
+        result = nova_limits._report_hitters(mock.Mock(), dict(dumps=0))
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "No heavy hitter dumps found\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_error(self):
+        result = nova_limits._report_hitters(mock.Mock(), 'failed')
+
+        self.assertEqual(result, 'failed')
+        self.assertEqual(sys.stdout.getvalue(), '')
+
+
+class TestLimitClassHitters(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _dump(self, pid, start, requests, rejections):
+        hitters = nova_limits.HeavyHitters(top=5, width=256, depth=4,
+                                           now=start)
+        for tenant, klass, count in requests:
+            for _i in range(count):
+                hitters.request(tenant, klass, start)
+        for tenant, klass, count in rejections:
+            for _i in range(count):
+                hitters.reject(tenant, klass)
+
+        path = os.path.join(self.tmpdir, 'hitters.%d.json' % pid)
+        with open(path, 'w') as f:
+            f.write(json.dumps(hitters.dehydrate(start + 60)))
+
+    def test_has_arguments(self):
+        self.assertIsInstance(nova_limits.limit_class_hitters,
+                              tools.ScriptAdaptor)
+        self.assertGreater(len(nova_limits.limit_class_hitters._arguments), 0)
+
+    def test_merge(self):
+        self._dump(1, 1000000.0, [('spam', 'default', 5),
+                                  ('eggs', 'gold', 3)],
+                   [('spam', 'default', 1)])
+        self._dump(2, 1000030.0, [('eggs', 'gold', 4),
+                                  ('bacon', 'default', 1)], [])
+
+        result = nova_limits.limit_class_hitters([self.tmpdir], top=2)
+
+        self.assertEqual(result, dict(
+            dumps=2,
+            start=1000000.0,
+            end=1000090.0,
+            requests=[('eggs', 7), ('spam', 5)],
+            rejections=[('spam', 1)],
+            classes=dict(default=[6, 1], gold=[7, 0]),
+        ))
+
+    def test_empty(self):
+        result = nova_limits.limit_class_hitters([self.tmpdir])
+
+        self.assertEqual(result, dict(dumps=0, start=None, end=None,
+                                      requests=[], rejections=[],
+                                      classes={}))
+
+    def test_no_files(self):
+        self.assertRaises(ValueError, nova_limits.limit_class_hitters, [])
+
+    @mock.patch.object(nova_limits, '_listen_hitters', return_value='merged')
+    def test_listen(self, mock_listen_hitters):
+        result = nova_limits.limit_class_hitters([], top=2, listen='sock',
+                                                 interval=30.0, mode='0660')
+
+        self.assertEqual(result, 'merged')
+        mock_listen_hitters.assert_called_once_with('sock', '0660', 30.0, 2)
+
+    @mock.patch.object(nova_limits, '_listen_hitters')
+    def test_listen_files(self, mock_listen_hitters):
+        self.assertRaises(ValueError, nova_limits.limit_class_hitters,
+                          [self.tmpdir], listen='sock')
+        self.assertFalse(mock_listen_hitters.called)
+
+
+class TestHittersHandler(unittest2.TestCase):
+    def _handle(self, data):
+        with mock.patch.object(nova_limits._HittersHandler, '__init__',
+                               return_value=None):
+            handler = nova_limits._HittersHandler()
+        handler.server = mock.Mock(dumps=[])
+        handler.rfile = StringIO.StringIO(data)
+
+        handler.handle()
+
+        return handler.server.dumps
+
+    def test_handle(self):
+        result = self._handle('{"spam": 1}\n\n{"eggs": 2}\n')
+
+        self.assertEqual(result, [dict(spam=1), dict(eggs=2)])
+
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    def test_bad_dump(self, mock_exception):
+        result = self._handle('{"spam": 1}\nspam\n{"eggs": 2}\n')
+
+        self.assertEqual(result, [dict(spam=1)])
+        mock_exception.assert_called_once_with(
+            "Failed to read heavy hitter dumps")
+
+
+class TestListenHitters(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _dump(self, start, tenant):
+        hitters = nova_limits.HeavyHitters(top=5, width=256, depth=4,
+                                           now=start)
+        hitters.request(tenant, 'default', start)
+        return hitters.dehydrate(start + 60)
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch('time.time', side_effect=[1000000.0,
+                                          1000000.0, 1000030.0,
+                                          1000030.0, 1000060.0,
+                                          1000060.0])
+    @mock.patch.object(nova_limits, '_report_hitters')
+    @mock.patch.object(nova_limits._HittersServer, 'handle_request',
+                       autospec=True)
+    def test_listen(self, mock_handle_request, mock_report_hitters,
+                    mock_time):
+        timeouts = []
+
+        def handle_request(server):
+            self.assertEqual(os.stat(self.path).st_mode & 0777, 0660)
+            timeouts.append(server.timeout)
+            if len(timeouts) > 2:
+                raise KeyboardInterrupt()
+            server.dumps.append(self._dump(999940.0 + len(timeouts),
+                                           'tenant%d' % len(timeouts)))
+        mock_handle_request.side_effect = handle_request
+
+        result = nova_limits._listen_hitters(self.path, '0660', 60.0, 5)
+
+        self.assertEqual(timeouts, [60.0, 30.0, 60.0])
+        mock_report_hitters.assert_called_once_with(None, dict(
+            dumps=2,
+            start=999941.0,
+            end=1000002.0,
+            requests=[('tenant1', 1), ('tenant2', 1)],
+            rejections=[],
+            classes=dict(default=[2, 0]),
+        ))
+        self.assertEqual(result, dict(dumps=0, start=None, end=None,
+                                      requests=[], rejections=[],
+                                      classes={}))
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestReportClassFilter(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report(self):
+        result = nova_limits._report_class_filter(mock.Mock(), 5)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(),
+                         "Added 5 tenant(s) to the class filter\n")
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_error(self):
+        result = nova_limits._report_class_filter(mock.Mock(), 'failed')
+
+        self.assertEqual(result, 'failed')
+        self.assertEqual(sys.stdout.getvalue(), '')
+
+
+class TestLimitClassFilter(unittest2.TestCase):
+    def test_has_arguments(self):
+        self.assertIsInstance(nova_limits.limit_class_filter,
+                              tools.ScriptAdaptor)
+        self.assertGreater(len(nova_limits.limit_class_filter._arguments), 0)
+
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits, '_scan_classes',
+                       return_value=[('spam', 'gold'), ('eggs', 'silver')])
+    @mock.patch.object(nova_limits.ClassFilter, 'save', autospec=True)
+    @mock.patch.object(nova_limits.ClassFilter, 'update')
+    def test_rebuild(self, mock_update, mock_save, mock_scan_classes,
+                     mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        result = nova_limits.limit_class_filter('config_file', 1001)
+
+        self.assertEqual(result, 2)
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        self.assertEqual(mock_scan_classes.call_args_list,
+                         [mock.call(db), mock.call(db)])
+        class_filter = mock_save.call_args[0][0]
+        mock_save.assert_called_once_with(class_filter, db)
+        self.assertEqual(len(class_filter.bits), 126)
+        self.assertIn('spam', class_filter)
+        self.assertIn('eggs', class_filter)
+        mock_update.assert_called_once_with(db, 'spam', 'eggs')
+
+
+class TestLimitClassHandler(unittest2.TestCase):
+    def _handle(self, commands, db=None):
+        with mock.patch.object(nova_limits._LimitClassHandler, '__init__',
+                               return_value=None):
+            handler = nova_limits._LimitClassHandler()
+        handler.server = mock.Mock(db=db or mock.Mock())
+        handler.rfile = StringIO.StringIO(commands)
+        handler.wfile = StringIO.StringIO()
+
+        handler.handle()
+
+        return handler.wfile.getvalue()
+
+    @mock.patch.object(nova_limits, '_set_class', return_value='gold')
+    def test_get(self, mock_set_class):
+        db = mock.Mock()
+
+        result = self._handle('get spam\n', db)
+
+        self.assertEqual(result, 'ok gold\n')
+        mock_set_class.assert_called_once_with(db, 'spam')
+
+    @mock.patch.object(nova_limits, '_set_class', return_value='gold')
+    def test_set(self, mock_set_class):
+        db = mock.Mock()
+
+        result = self._handle('\nset spam platinum\nquit\nget eggs\n', db)
+
+        self.assertEqual(result, 'ok gold\n')
+        mock_set_class.assert_called_once_with(db, 'spam', 'platinum')
+
+    @mock.patch.object(nova_limits.ClassFilter, 'update')
+    def test_bulk(self, mock_update):
+        db = mock.Mock()
+        pipe = db.pipeline.return_value
+
+        result = self._handle('bulk 3\nspam gold\neggs default\n'
+                              'bacon silver\nbulk 0\n', db)
+
+        self.assertEqual(result, 'ok 3\nok 0\n')
+        self.assertEqual(pipe.mock_calls[:4], [
+            mock.call.set('limit-class:spam', 'gold'),
+            mock.call.delete('limit-class:eggs'),
+            mock.call.set('limit-class:bacon', 'silver'),
+            mock.call.execute(),
+        ])
+        mock_update.assert_has_calls([
+            mock.call(db, 'spam', 'bacon'),
+            mock.call(db),
+        ])
+
+    @mock.patch.object(nova_limits.LOG, 'exception')
+    def test_bulk_bad_line(self, mock_exception):
+        db = mock.Mock()
+
+        result = self._handle('bulk 2\nspam gold\neggs\nget\n', db)
+
+        self.assertEqual(result, "error Expected a tenant and a rate-limit "
+                         "class\nerror invalid command 'get'\n")
+        self.assertFalse(db.pipeline.called)
+
+    def test_invalid(self):
+        result = self._handle('spam\nset spam\nbulk x\n')
+
+        self.assertEqual(result, "error invalid command 'spam'\n"
+                         "error invalid command 'set spam'\n"
+                         "error invalid command 'bulk x'\n")
+
+
+class TestLimitClassServer(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_has_arguments(self):
+        self.assertIsInstance(nova_limits.limit_class_server,
+                              tools.ScriptAdaptor)
+        self.assertGreater(len(nova_limits.limit_class_server._arguments), 0)
+
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits._LimitClassServer, 'serve_forever',
+                       autospec=True)
+    def test_serve(self, mock_serve_forever, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+
+        # Left behind by a previous server
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+
+        def serve_forever(server):
+            self.assertIs(server.db, db)
+            self.assertEqual(os.stat(self.path).st_mode & 0777, 0640)
+            raise KeyboardInterrupt()
+        mock_serve_forever.side_effect = serve_forever
+
+        result = nova_limits.limit_class_server('config_file', self.path,
+                                                '0640')
+
+        self.assertEqual(result, None)
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        self.assertEqual(mock_serve_forever.call_count, 1)
+        self.assertFalse(os.path.exists(self.path))
+
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits, '_LimitClassServer')
+    def test_not_socket(self, mock_LimitClassServer, mock_Config):
+        with open(self.path, 'w') as f:
+            f.write('spam')
+
+        self.assertRaises(ValueError, nova_limits.limit_class_server,
+                          'config_file', self.path)
+        self.assertFalse(mock_LimitClassServer.called)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'spam')
+
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits, '_LimitClassServer')
+    def test_listening(self, mock_LimitClassServer, mock_Config):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(1)
+
+        try:
+            self.assertRaises(ValueError, nova_limits.limit_class_server,
+                              'config_file', self.path)
+        finally:
+            sock.close()
+        self.assertFalse(mock_LimitClassServer.called)
+        self.assertTrue(os.path.exists(self.path))
+
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits, '_LimitClassServer')
+    @mock.patch('fcntl.flock', side_effect=IOError)
+    def test_locked(self, mock_flock, mock_LimitClassServer, mock_Config):
+        self.assertRaises(ValueError, nova_limits.limit_class_server,
+                          'config_file', self.path)
+        self.assertFalse(mock_LimitClassServer.called)
+
+
+class TestIndexBuckets(unittest2.TestCase):
+    def test_index(self):
+        lim1 = limits.Limit('db', uri='/spam', value=5, unit='second')
+        lim2 = limits.Limit('db', uri='/eggs', value=5, unit='second')
+        key1 = lim1.key(dict(tenant='spam'))
+        key2 = lim1.key(dict(tenant='spam', server='1'))
+        key3 = lim2.key(dict(tenant='spam'))
+
+        result = nova_limits._index_buckets([(key1, 1.0), (key2, 2.0),
+                                             (key3, 3.0)])
+
+        self.assertEqual(sorted(result.keys()), sorted([lim1.uuid,
+                                                        lim2.uuid]))
+        self.assertEqual([(str(k), e) for k, e in result[lim1.uuid]],
+                         [(key1, 1.0), (key2, 2.0)])
+        self.assertEqual([(str(k), e) for k, e in result[lim2.uuid]],
+                         [(key3, 3.0)])
+
+
+class TestTenantUsage(unittest2.TestCase):
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_usage(self, mock_time):
+        db = mock.Mock(**{'zrange.return_value': ['limit']})
+        lim = nova_limits.NovaClassLimit(db, uri='/servers', value=10,
+                                         unit='minute', verbs=['POST'],
+                                         rate_class='default')
+        drained_lim = nova_limits.NovaClassLimit(db, uri='/images', value=5,
+                                                 unit='minute',
+                                                 verbs=['GET'],
+                                                 rate_class='default')
+        key = lim.key(dict(tenant='spam'))
+        drained_key = drained_lim.key(dict(tenant='spam'))
+        records = [msgpack.dumps(dict(
+            uuid='update%d' % i,
+            update=dict(params=dict(tenant='spam'), time=999999.0),
+        )) for i in range(2)]
+        pipe = db.pipeline.return_value
+        pipe.execute.side_effect = [
+            [None, [(key, 1000011.0), (drained_key, 999990.0)],
+             'gold', []],
+            [records],
+        ]
+
+        with mock.patch.object(database, 'limits_hydrate',
+                               return_value=[lim, drained_lim]):
+            result = list(nova_limits._tenant_usage(
+                db, config.Config(), iter(['spam', 'eggs'])))
+
+        db.zrange.assert_called_once_with('limits', 0, -1)
+        self.assertEqual(pipe.mock_calls, [
+            mock.call.get('limit-class:spam'),
+            mock.call.zrange('bucket_set:spam', 0, -1, withscores=True),
+            mock.call.get('limit-class:eggs'),
+            mock.call.zrange('bucket_set:eggs', 0, -1, withscores=True),
+            mock.call.execute(),
+            mock.call.lrange(key, 0, -1),
+            mock.call.execute(),
+        ])
+        self.assertEqual(result, [
+            ('spam', 'default', [
+                dict(verb='POST', URI='/servers', regex='/servers',
+                     value=10, unit='MINUTE', remaining=8,
+                     resetTime=1000011),
+                dict(verb='GET', URI='/images', regex='/images',
+                     value=5, unit='MINUTE', remaining=5,
+                     resetTime=999990.0),
+            ]),
+            ('eggs', 'gold', []),
+        ])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_usage_multiplier(self, mock_time):
+        db = mock.Mock(**{'zrange.return_value': ['limit']})
+        lim = nova_limits.NovaClassLimit(db, uri='/servers', value=10,
+                                         unit='minute', verbs=['POST'],
+                                         rate_class='default')
+        key = lim.key(dict(tenant='spam'))
+        records = [msgpack.dumps(dict(
+            uuid='update%d' % i,
+            update=dict(params=dict(tenant='spam'), time=999999.0),
+        )) for i in range(2)]
+        pipe = db.pipeline.return_value
+        pipe.execute.side_effect = [
+            [None, [(key, 1000011.0)], {'default': '0.5'}],
+            [records],
+        ]
+        conf = config.Config(conf_dict={'nova_limits.adaptive': 'yes'})
+
+        with mock.patch.object(database, 'limits_hydrate',
+                               return_value=[lim]):
+            result = list(nova_limits._tenant_usage(
+                db, conf, iter(['spam'])))
+
+        self.assertEqual(pipe.mock_calls, [
+            mock.call.get('limit-class:spam'),
+            mock.call.zrange('bucket_set:spam', 0, -1, withscores=True),
+            mock.call.hgetall('limit-multipliers'),
+            mock.call.execute(),
+            mock.call.lrange(key, 0, -1),
+            mock.call.execute(),
+        ])
+        self.assertEqual(result, [
+            ('spam', 'default', [
+                dict(verb='POST', URI='/servers', regex='/servers',
+                     value=5, unit='MINUTE', remaining=4,
+                     resetTime=1000011, multiplier=0.5),
+            ]),
+        ])
+
+    @mock.patch.object(database, 'limits_hydrate', return_value=[])
+    def test_batches(self, mock_limits_hydrate):
+        db = mock.Mock()
+        pipe = db.pipeline.return_value
+        pipe.execute.side_effect = [[None, []] * 2, [], [None, []], []]
+
+        result = list(nova_limits._tenant_usage(
+            db, config.Config(), ['a', 'b', 'c'], batch_size=2))
+
+        self.assertEqual([t for t, _k, _l in result], ['a', 'b', 'c'])
+        self.assertEqual(pipe.execute.call_count, 4)
+
+
+class TestLimitClassUsage(unittest2.TestCase):
+    def test_has_arguments(self):
+        self.assertIsInstance(nova_limits.limit_class_usage,
+                              tools.ScriptAdaptor)
+        self.assertGreater(len(nova_limits.limit_class_usage._arguments), 0)
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits, '_tenant_usage', return_value=[
+        ('spam', 'gold', [dict(verb='GET')]),
+        ('eggs', 'default', []),
+    ])
+    def test_tenants(self, mock_tenant_usage, mock_Config):
+        conf = mock_Config.return_value
+        db = conf.get_database.return_value
+
+        result = nova_limits.limit_class_usage('config_file',
+                                               ['spam', 'eggs'])
+
+        self.assertEqual(result, None)
+        mock_tenant_usage.assert_called_once_with(db, conf, ['spam', 'eggs'],
+                                                  100)
+        lines = sys.stdout.getvalue().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'tenant': 'spam', 'class': 'gold', 'limits': [dict(verb='GET')]},
+            {'tenant': 'eggs', 'class': 'default', 'limits': []},
+        ])
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits, '_tenant_usage', return_value=[])
+    def test_pattern(self, mock_tenant_usage, mock_Config):
+        db = mock_Config.return_value.get_database.return_value
+        db.scan_iter.return_value = iter(['bucket_set:spam',
+                                          'bucket_set:spammer'])
+
+        nova_limits.limit_class_usage('config_file', pattern='spam*',
+                                      batch_size=50)
+
+        db.scan_iter.assert_called_once_with(match='bucket_set:spam*',
+                                             count=50)
+        tenants = mock_tenant_usage.call_args[0][2]
+        self.assertEqual(list(tenants), ['spam', 'spammer'])
+
+    @mock.patch.object(config, 'Config')
+    def test_no_tenants(self, mock_Config):
+        self.assertRaises(ValueError, nova_limits.limit_class_usage,
+                          'config_file')
+
+
+class TestMemoryAudit(unittest2.TestCase):
+    def test_init_memory_usage(self):
+        db = mock.Mock()
+
+        audit = nova_limits._MemoryAudit(db, 0.5, 10, 0.0)
+
+        self.assertEqual(audit.db, db)
+        self.assertEqual(audit.sample, 0.5)
+        self.assertEqual(audit.batch_size, 10)
+        self.assertEqual(audit.pause, 0.0)
+        self.assertEqual(audit.method, 'MEMORY USAGE')
+        db.execute_command.assert_called_once_with(
+            'MEMORY', 'USAGE', 'limit-class-filter')
+
+    def test_init_dump(self):
+        db = mock.Mock(**{'execute_command.side_effect':
+                          redis.ResponseError('unknown command')})
+
+        audit = nova_limits._MemoryAudit(db)
+
+        self.assertEqual(audit.method, 'DUMP')
+
+    def test_sampled(self):
+        audit = nova_limits._MemoryAudit(mock.Mock(), sample=0.25)
+        tenants = ['tenant%d' % i for i in range(1000)]
+
+        sampled = [t for t in tenants if audit.sampled(t)]
+
+        self.assertGreater(len(sampled), 200)
+        self.assertLess(len(sampled), 300)
+        self.assertEqual(sampled, [t for t in tenants if audit.sampled(t)])
+
+    def test_sampled_all(self):
+        audit = nova_limits._MemoryAudit(mock.Mock(), sample=1.0)
+
+        self.assertTrue(all(audit.sampled('tenant%d' % i)
+                            for i in range(100)))
+
+    def test_measure_memory_usage(self):
+        audit = nova_limits._MemoryAudit(mock.Mock())
+        pipe = mock.Mock()
+
+        audit._measure(pipe, 'key')
+
+        pipe.execute_command.assert_called_once_with('MEMORY', 'USAGE',
+                                                     'key')
+        self.assertFalse(pipe.dump.called)
+
+    def test_measure_dump(self):
+        audit = nova_limits._MemoryAudit(mock.Mock())
+        audit.method = 'DUMP'
+        pipe = mock.Mock()
+
+        audit._measure(pipe, 'key')
+
+        pipe.dump.assert_called_once_with('key')
+        self.assertFalse(pipe.execute_command.called)
+
+    def test_size(self):
+        audit = nova_limits._MemoryAudit(mock.Mock())
+
+        self.assertEqual(audit._size('key', None), 0)
+        self.assertEqual(audit._size('key', 57), 57)
+        audit.method = 'DUMP'
+        self.assertEqual(audit._size('key', None), 0)
+        self.assertEqual(audit._size('key', 'serialized'), 13)
+
+    @mock.patch('time.sleep')
+    def test_scan(self, mock_sleep):
+        db = mock.Mock(**{'scan_iter.return_value': iter('abcde')})
+        audit = nova_limits._MemoryAudit(db, batch_size=2, pause=0.5)
+
+        result = list(audit._scan('spam:*'))
+
+        self.assertEqual(result, [['a', 'b'], ['c', 'd'], ['e']])
+        db.scan_iter.assert_called_once_with(match='spam:*', count=2)
+        self.assertEqual(mock_sleep.mock_calls, [mock.call(0.5)] * 3)
+
+    @mock.patch('time.sleep')
+    def test_scan_nopause(self, mock_sleep):
+        db = mock.Mock(**{'scan_iter.return_value': iter('abc')})
+        audit = nova_limits._MemoryAudit(db, batch_size=2, pause=0)
+
+        result = list(audit._scan('spam:*'))
+
+        self.assertEqual(result, [['a', 'b'], ['c']])
+        self.assertFalse(mock_sleep.called)
+
+    def test_audit_classes(self):
+        db = mock.Mock()
+        pipe = db.pipeline.return_value
+        pipe.execute.return_value = [100, None]
+        audit = nova_limits._MemoryAudit(db, pause=0)
+        audit.sampled = lambda tenant: tenant in ('spam', 'eggs')
+
+        with mock.patch.object(audit, '_scan', return_value=[
+                ['limit-class:spam', 'limit-class:foo'],
+                ['limit-class:bar'],
+                ['limit-class:eggs']]):
+            result = audit.audit_classes()
+
+        self.assertEqual(result, (4, 2, 200))
+        self.assertEqual(pipe.mock_calls, [
+            mock.call.execute_command('MEMORY', 'USAGE', 'limit-class:spam'),
+            mock.call.execute(),
+            mock.call.execute_command('MEMORY', 'USAGE', 'limit-class:eggs'),
+            mock.call.execute(),
+        ])
+
+    def test_audit_tenants(self):
+        db = mock.Mock()
+        pipe = db.pipeline.return_value
+        pipe.execute.side_effect = [
+            ['gold', ['bucket:a', 'bucket:b'], 100,
+             None, ['bucket:c'], 50],
+            [10, 20, 30],
+        ]
+        audit = nova_limits._MemoryAudit(db, pause=0)
+        audit.sampled = lambda tenant: tenant != 'foo'
 
-        nova_limits.nova_postprocess(midware, environ)
+        with mock.patch.object(audit, '_scan', return_value=[
+                ['bucket_set:spam', 'bucket_set:foo', 'bucket_set:eggs']]):
+            result = audit.audit_tenants()
 
-        self.assertEqual(environ['nova.limits'], [
-            dict(
-                verb='GET',
-                URI='/spam/uri',
-                regex='/spam/uri',
-                value=23,
-                unit='MINUTE',
-                remaining=23,
-                resetTime=1000000.0,
-            ),
-            dict(
-                verb='PUT',
-                URI='/spam/uri',
-                regex='/spam/uri',
-                value=23,
-                unit='MINUTE',
-                remaining=23,
-                resetTime=1000000.0,
-            ),
-            dict(
-                verb='GET',
-                URI='/spam/uri2',
-                regex='/spam/uri2',
-                value=18,
-                unit='SECOND',
-                remaining=18,
-                resetTime=1000000.0,
-            ),
-            dict(
-                verb='HEAD',
-                URI='/spam/uri2',
-                regex='/spam/uri2',
-                value=18,
-                unit='SECOND',
-                remaining=18,
-                resetTime=1000000.0,
-            ),
-            dict(
-                verb='POST',
-                URI='/spam/uri2',
-                regex='/spam/uri2',
-                value=18,
-                unit='SECOND',
-                remaining=18,
-                resetTime=1000000.0,
-            ),
-            dict(
-                verb='PUT',
-                URI='/spam/uri2',
-                regex='/spam/uri2',
-                value=18,
-                unit='SECOND',
-                remaining=18,
-                resetTime=1000000.0,
-            ),
-            dict(
-                verb='DELETE',
-                URI='/spam/uri2',
-                regex='/spam/uri2',
-                value=18,
-                unit='SECOND',
-                remaining=18,
-                resetTime=1000000.0,
-            ),
-            dict(
-                verb='GET',
-                URI='/spam/uri4',
-                regex='/spam/uri4',
-                value=1,
-                unit='DAY',
-                remaining=1,
-                resetTime=1000000.0,
-            ),
-            dict(
-                verb='GET',
-                URI='/spam/uri5',
-                regex='/spam/uri5',
-                value=183,
-                unit='UNKNOWN',
-                remaining=183,
-                resetTime=1000000.0,
-            ),
-            dict(
-                verb='GET',
-                URI='/spam/uri6?alfa={alfa}&bravo={bravo}',
-                regex='/spam/uri6?alfa={alfa}&bravo={bravo}',
-                value=1,
-                unit='DAY',
-                remaining=1,
-                resetTime=1000000.0,
-            ),
+        self.assertEqual(result, (3, [
+            ('spam', 'gold', 2, 130),
+            ('eggs', 'default', 1, 80),
+        ]))
+        db.pipeline.assert_called_with(transaction=False)
+        self.assertEqual(pipe.mock_calls, [
+            mock.call.get('limit-class:spam'),
+            mock.call.zrange('bucket_set:spam', 0, -1),
+            mock.call.execute_command('MEMORY', 'USAGE', 'bucket_set:spam'),
+            mock.call.get('limit-class:eggs'),
+            mock.call.zrange('bucket_set:eggs', 0, -1),
+            mock.call.execute_command('MEMORY', 'USAGE', 'bucket_set:eggs'),
+            mock.call.execute(),
+            mock.call.execute_command('MEMORY', 'USAGE', 'bucket:a'),
+            mock.call.execute_command('MEMORY', 'USAGE', 'bucket:b'),
+            mock.call.execute_command('MEMORY', 'USAGE', 'bucket:c'),
+            mock.call.execute(),
         ])
-        db.zrange.assert_called_once_with('bucket_set:spam', 0, -1)
 
-    @mock.patch('time.time', return_value=1000000.0)
-    @mock.patch('turnstile.limits.BucketKey.decode',
-                side_effect=lambda key: mock.Mock(**key))
-    def test_limits_with_buckets(self, mock_decode, mock_time):
-        db = mock.Mock(**{'zrange.return_value': [
-            dict(
-                uuid='uuid',
-                params={},
-                bucket=dict(messages=2, expire=1000001.0),
-            ),
-            dict(
-                uuid='uuid2',
-                params=dict(unused='foo'),
-                bucket=dict(messages=5, expire=999999.0),
-            ),
-            dict(
-                uuid='uuid3',
-                params=dict(param='foo'),
-                bucket=dict(messages=10, expire=1000005.0),
-            ),
-            dict(
-                uuid='uuid3',
-                params=dict(param='bar'),
-                bucket=dict(messages=5, expire=1000001.0),
-            ),
-        ]})
-        limits = [
-            self._make_limit(
-                uuid='uuid',
-                queries=[],
-                verbs=['GET'],
-                unit='minute',
-                uri='/spam/{uri}',
-                value=7,
-            ),
-            self._make_limit(
-                uuid='uuid2',
-                queries=[],
-                verbs=['GET'],
-                unit='minute',
-                uri='/spam/{uri2}/{used}',
-                value=20,
-            ),
-            self._make_limit(
-                uuid='uuid3',
-                queries=[],
-                verbs=['GET'],
-                unit='minute',
-                uri='/spam/{uri3}/{param}',
-                value=50,
-            ),
-            self._make_limit(
-                uuid='uuid4',
-                queries=[],
-                verbs=['GET'],
-                unit='minute',
-                uri='/spam/{uri4}/{param}',
-                value=50,
-            ),
-            self._make_limit(
-                uuid='uuid5',
-                queries=[],
-                verbs=['GET'],
-                unit='minute',
-                uri='/spam/{uri5}',
-                value=10,
-            ),
+
+class TestSummarizeAudit(unittest2.TestCase):
+    def test_summary(self):
+        tenants = [
+            ('spam', 'gold', 2, 200),
+            ('eggs', 'gold', 4, 400),
+            ('foo', 'default', 1, 100),
         ]
-        midware = mock.Mock(db=db, limits=limits)
-        environ = {
-            'turnstile.nova.limitclass': 'lim_class',
-            'turnstile.bucket_set': 'bucket_set:spam',
-        }
 
-        nova_limits.nova_postprocess(midware, environ)
+        result = nova_limits._summarize_audit((20, 2, 100), 30, tenants)
 
-        self.assertEqual(environ['nova.limits'], [
-            dict(
-                verb='GET',
-                URI='/spam/{uri}',
-                regex='/spam/{uri}',
-                value=7,
-                unit='MINUTE',
-                remaining=2,
-                resetTime=1000001.0,
-            ),
-            dict(
-                verb='GET',
-                URI='/spam/{uri2}/{used}',
-                regex='/spam/{uri2}/{used}',
-                value=20,
-                unit='MINUTE',
-                remaining=5,
-                resetTime=999999.0,
-            ),
-            dict(
-                verb='GET',
-                URI='/spam/{uri3}/foo',
-                regex='/spam/{uri3}/foo',
-                value=50,
-                unit='MINUTE',
-                remaining=10,
-                resetTime=1000005.0,
-            ),
-            dict(
-                verb='GET',
-                URI='/spam/{uri3}/bar',
-                regex='/spam/{uri3}/bar',
-                value=50,
-                unit='MINUTE',
-                remaining=5,
-                resetTime=1000001.0,
-            ),
-            dict(
-                verb='GET',
-                URI='/spam/{uri3}/{param}',
-                regex='/spam/{uri3}/{param}',
-                value=50,
-                unit='MINUTE',
-                remaining=5,
-                resetTime=1000005.0,
-            ),
-            dict(
-                verb='GET',
-                URI='/spam/{uri4}/{param}',
-                regex='/spam/{uri4}/{param}',
-                value=50,
-                unit='MINUTE',
-                remaining=50,
-                resetTime=1000000.0,
+        self.assertEqual(result, dict(
+            limit_class=dict(keys=20, sampled=2, average=50.0, total=1000.0),
+            tenants=30,
+            sampled=3,
+            classes=dict(
+                gold=dict(sampled=2, buckets=3.0, size=600, tenants=20.0,
+                          average=300.0, total=6000.0),
+                default=dict(sampled=1, buckets=1.0, size=100, tenants=10.0,
+                             average=100.0, total=1000.0),
             ),
-            dict(
-                verb='GET',
-                URI='/spam/{uri5}',
-                regex='/spam/{uri5}',
-                value=10,
-                unit='MINUTE',
-                remaining=10,
-                resetTime=1000000.0,
+            outliers=[],
+        ))
+
+    def test_empty(self):
+        result = nova_limits._summarize_audit((0, 0, 0), 0, [])
+
+        self.assertEqual(result, dict(
+            limit_class=dict(keys=0, sampled=0, average=0.0, total=0.0),
+            tenants=0,
+            sampled=0,
+            classes={},
+            outliers=[],
+        ))
+
+    def test_outliers(self):
+        tenants = [('tenant%d' % i, 'default', 1, 100) for i in range(100)]
+        tenants += [
+            ('spam', 'gold', 50, 5000),
+            ('eggs', 'gold', 100, 10000),
+            ('foo', 'gold', 20, 2000),
+        ]
+
+        result = nova_limits._summarize_audit((0, 0, 0), 103, tenants)
+
+        self.assertEqual(result['outliers'], [
+            dict(tenant='eggs', klass='gold', buckets=100, size=10000),
+            dict(tenant='spam', klass='gold', buckets=50, size=5000),
+        ])
+
+
+class TestProjectAudit(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.history = os.path.join(self.tmpdir, 'audit.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def summary(self, now):
+        return dict(
+            time=now,
+            limit_class=dict(total=2000.0),
+            classes=dict(
+                gold=dict(total=6000.0),
+                silver=dict(total=1000.0),
             ),
+        )
+
+    def records(self):
+        with open(self.history) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def test_no_history(self):
+        summary = self.summary(1000000.0)
+
+        nova_limits._project_audit(summary, self.history, 30)
+
+        self.assertNotIn('days', summary)
+        self.assertNotIn('growth', summary['limit_class'])
+        self.assertEqual(self.records(), [dict(
+            time=1000000.0,
+            limit_class=2000.0,
+            classes=dict(gold=6000.0, silver=1000.0),
+        )])
+
+    def test_projection(self):
+        with open(self.history, 'w') as f:
+            f.write(json.dumps(dict(time=500000.0, limit_class=1.0,
+                                    classes={})) + '\n')
+            f.write(json.dumps(dict(time=913600.0, limit_class=1000.0,
+                                    classes=dict(gold=8000.0))) + '\n\n')
+        summary = self.summary(1000000.0)
+
+        nova_limits._project_audit(summary, self.history, 30)
+
+        self.assertEqual(summary['days'], 30)
+        self.assertEqual(summary['limit_class'], dict(
+            total=2000.0, growth=1000.0, projected=32000.0))
+        self.assertEqual(summary['classes'], dict(
+            gold=dict(total=6000.0, growth=-2000.0, projected=0.0),
+            silver=dict(total=1000.0, growth=1000.0, projected=31000.0),
+        ))
+        self.assertEqual(len(self.records()), 3)
+
+    def test_same_time(self):
+        with open(self.history, 'w') as f:
+            f.write(json.dumps(dict(time=1000000.0, limit_class=1.0,
+                                    classes={})) + '\n')
+        summary = self.summary(1000000.0)
+
+        nova_limits._project_audit(summary, self.history, 30)
+
+        self.assertNotIn('days', summary)
+        self.assertEqual(len(self.records()), 2)
+
+
+class TestReportAudit(unittest2.TestCase):
+    result = dict(
+        method='MEMORY USAGE',
+        tenants=30,
+        sampled=3,
+        limit_class=dict(keys=20, sampled=2, average=50.0, total=1000.0),
+        classes=dict(
+            gold=dict(sampled=2, buckets=3.0, size=600, tenants=20.0,
+                      average=300.0, total=6000.0),
+        ),
+        outliers=[],
+    )
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report(self):
+        result = nova_limits._report_audit(mock.Mock(), self.result)
+
+        self.assertEqual(result, None)
+        self.assertEqual(sys.stdout.getvalue(), (
+            "Memory use measured with MEMORY USAGE; sampled 3 of 30 "
+            "tenant(s)\n"
+            "\n"
+            "limit-class keys: 20, average 50 bytes, total 1000 bytes\n"
+            "\n"
+            "class                   tenants    buckets    avg bytes "
+            "   total bytes\n"
+            "gold                         20        3.0          300 "
+            "          6000\n"))
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_report_projected(self):
+        audit = dict(self.result, days=30, outliers=[
+            dict(tenant='spam', klass='gold', buckets=50, size=5000)])
+        audit['limit_class'] = dict(self.result['limit_class'],
+                                    growth=10.0, projected=1300.0)
+        audit['classes'] = dict(gold=dict(self.result['classes']['gold'],
+                                          growth=100.0, projected=9000.0))
+
+        result = nova_limits._report_audit(mock.Mock(), audit)
+
+        self.assertEqual(result, None)
+        lines = sys.stdout.getvalue().splitlines()
+        self.assertEqual(lines[3], "    growth 10 bytes/day, projected 1300 "
+                         "bytes in 30 days")
+        self.assertTrue(lines[5].endswith("   bytes/day     in 30 days"))
+        self.assertTrue(lines[6].endswith("          100           9000"))
+        self.assertEqual(lines[-1].split(),
+                         ['spam', 'gold', '50', 'bucket(s)', '5000', 'bytes'])
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    def test_error(self):
+        result = nova_limits._report_audit(mock.Mock(), 'failed')
+
+        self.assertEqual(result, 'failed')
+        self.assertEqual(sys.stdout.getvalue(), '')
+
+
+class TestLimitClassAudit(unittest2.TestCase):
+    def test_has_arguments(self):
+        self.assertIsInstance(nova_limits.limit_class_audit,
+                              tools.ScriptAdaptor)
+        self.assertGreater(len(nova_limits.limit_class_audit._arguments), 0)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits, '_MemoryAudit')
+    @mock.patch.object(nova_limits, '_summarize_audit',
+                       return_value=dict(tenants=1))
+    @mock.patch.object(nova_limits, '_project_audit')
+    def test_audit(self, mock_project_audit, mock_summarize_audit,
+                   mock_MemoryAudit, mock_Config, mock_time):
+        db = mock_Config.return_value.get_database.return_value
+        audit = mock_MemoryAudit.return_value
+        audit.method = 'DUMP'
+        audit.audit_classes.return_value = (1, 1, 50)
+        audit.audit_tenants.return_value = (1, [('spam', 'gold', 1, 100)])
+
+        result = nova_limits.limit_class_audit('config_file', 0.5, 10, 0.0,
+                                               5)
+
+        self.assertEqual(result, dict(tenants=1, method='DUMP',
+                                      time=1000000.0))
+        mock_Config.assert_called_once_with(conf_file='config_file')
+        mock_MemoryAudit.assert_called_once_with(db, 0.5, 10, 0.0)
+        mock_summarize_audit.assert_called_once_with(
+            (1, 1, 50), 1, [('spam', 'gold', 1, 100)], 5)
+        self.assertFalse(mock_project_audit.called)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(config, 'Config')
+    @mock.patch.object(nova_limits, '_MemoryAudit')
+    @mock.patch.object(nova_limits, '_summarize_audit',
+                       return_value=dict(tenants=0))
+    @mock.patch.object(nova_limits, '_project_audit')
+    def test_history(self, mock_project_audit, mock_summarize_audit,
+                     mock_MemoryAudit, mock_Config, mock_time):
+        audit = mock_MemoryAudit.return_value
+        audit.audit_classes.return_value = (0, 0, 0)
+        audit.audit_tenants.return_value = (0, [])
+
+        result = nova_limits.limit_class_audit('config_file',
+                                               history='audit.log', days=7)
+
+        mock_project_audit.assert_called_once_with(result, 'audit.log', 7)
+
+
+class TestSimulator(unittest2.TestCase):
+    def make_limits(self):
+        return [
+            limits.Limit('db', uri='/{tenant}/images', value=100,
+                         unit='second'),
+            nova_limits.NovaClassLimit('db', uri='/v2/{tenant}/servers',
+                                       value=2, unit='minute',
+                                       verbs=['POST'], rate_class='default',
+                                       cost={'POST': 1}),
+            nova_limits.NovaClassLimit('db', uri='/v2/{tenant}/servers',
+                                       value=4, unit='minute',
+                                       verbs=['POST'], rate_class='gold'),
+            nova_limits.NovaClassLimit('db', uri='/{tenant}/flavors',
+                                       value=3, unit='minute',
+                                       rate_class='default',
+                                       cost={'GET': 2}),
+        ]
+
+    def run_simulation(self, events, **kwargs):
+        kwargs.setdefault('vectorize', False)
+        sim = nova_limits._Simulator(self.make_limits(), **kwargs)
+        for i in range(0, len(events), 3):
+            sim.run(events[i:i + 3])
+        return sim.results()
+
+    def test_init(self):
+        sim = nova_limits._Simulator(self.make_limits(), vectorize=False)
+
+        self.assertEqual(sim.classes, {})
+        self.assertEqual(sim.numpy, None)
+        self.assertEqual(sim.state.class_parents, {})
+        self.assertEqual(sim.buckets, {})
+        self.assertEqual(len(sim.last), 0)
+        self.assertEqual(sim.limit_counts, [[0, 0]] * 4)
+
+    def test_match(self):
+        sim = nova_limits._Simulator(self.make_limits(), vectorize=False)
+
+        result = sim._match('POST', '/spam/servers')
+
+        self.assertEqual(result, [
+            (1, (), 30.0, 60.0, 0.1, frozenset(), 'default',
+             sim.limits[1].uuid, True),
+            (2, (), 15.0, 60.0, 0.1, frozenset(), 'gold',
+             sim.limits[2].uuid, True),
         ])
+        self.assertIs(sim._match('POST', '/spam/servers'), result)
+        self.assertEqual(sim._match('GET', '/spam/servers'), [])
 
+    def test_updates(self):
+        sim = nova_limits._Simulator(self.make_limits(), vectorize=False)
 
-class TestNovaClassLimit(unittest2.TestCase):
-    def setUp(self):
-        self.lim = nova_limits.NovaClassLimit('db', uri='/spam', value=18,
-                                              unit='second',
-                                              rate_class='lim_class')
+        result = sim._updates('spam', 'gold', 'POST', '/v2/spam/servers')
 
-    def test_route_base(self):
-        route_args = {}
-        result = self.lim.route('/spam', route_args)
+        self.assertEqual(result, [(2, 0, 15.0, 60.0, 0.1)])
+        self.assertEqual(sim.buckets, {(2, (), 'spam'): 0})
 
-        self.assertEqual(result, '/spam')
+    def test_reject(self):
+        result = self.run_simulation([
+            (1000000.0, 'spam', 'POST', '/v2/spam/servers'),
+            (1000001.0, 'spam', 'POST', '/v2/spam/servers'),
+            (1000002.0, 'spam', 'POST', '/v2/spam/servers?x=1'),
+            (1000002.0, 'eggs', 'POST', '/v2/eggs/servers'),
+            (1000003.0, 'spam', 'GET', '/v2/spam/images'),
+            (1000062.0, 'spam', 'POST', '/v2/spam/servers'),
+        ])
 
-    def test_route_v1(self):
-        route_args = {}
-        result = self.lim.route('/v1.1/spam', route_args)
+        self.assertEqual(result['requests'], 6)
+        self.assertEqual(result['rejected'], 1)
+        self.assertEqual(result['buckets'], 3)
+        self.assertEqual(result['classes'], dict(
+            default=dict(requests=6, rejected=1),
+        ))
+        self.assertEqual(result['tenants'], [
+            dict(tenant='spam', klass='default', requests=5, rejected=1),
+        ])
+        self.assertEqual([(lim['uri'], lim['rate_class'], lim['requests'],
+                           lim['rejected']) for lim in result['limits']], [
+            ('/{tenant}/images', None, 1, 0),
+            ('/v2/{tenant}/servers', 'default', 5, 1),
+            ('/v2/{tenant}/servers', 'gold', 0, 0),
+            ('/{tenant}/flavors', 'default', 0, 0),
+        ])
 
-        self.assertEqual(result, '/spam')
+    def test_classes(self):
+        result = self.run_simulation([
+            (1000000.0, 'spam', 'POST', '/spam/servers'),
+            (1000001.0, 'spam', 'POST', '/spam/servers'),
+            (1000002.0, 'spam', 'POST', '/spam/servers'),
+            (1000003.0, 'spam', 'GET', '/spam/flavors'),
+            (1000004.0, 'spam', 'GET', '/spam/flavors'),
+        ], classes=dict(spam='gold'))
 
-    def test_route_v2(self):
-        route_args = {}
-        result = self.lim.route('/v2/spam', route_args)
+        self.assertEqual(result['rejected'], 0)
+        self.assertEqual(result['classes'], dict(
+            gold=dict(requests=5, rejected=0),
+        ))
+        self.assertEqual([lim['requests'] for lim in result['limits']],
+                         [0, 0, 3, 0])
 
-        self.assertEqual(result, '/spam')
+    def test_class_parents(self):
+        result = self.run_simulation([
+            (1000000.0, 'spam', 'GET', '/spam/flavors'),
+            (1000001.0, 'spam', 'POST', '/spam/servers'),
+            (1000002.0, 'spam', 'POST', '/spam/servers'),
+            (1000003.0, 'spam', 'POST', '/spam/servers'),
+            (1000004.0, 'eggs', 'POST', '/eggs/servers'),
+            (1000005.0, 'eggs', 'POST', '/eggs/servers'),
+            (1000006.0, 'eggs', 'POST', '/eggs/servers'),
+        ], classes=dict(spam='gold'), class_parents='gold:default')
 
-    def test_route_v1_base(self):
-        route_args = {}
-        result = self.lim.route('/v1.1', route_args)
+        self.assertEqual(result['rejected'], 1)
+        self.assertEqual([(lim['requests'], lim['rejected'])
+                          for lim in result['limits']],
+                         [(0, 0), (3, 1), (3, 0), (1, 0)])
 
-        self.assertEqual(result, '/v1.1')
+    def test_weighted(self):
+        result = self.run_simulation([
+            (1000000.0, 'spam', 'GET', '/spam/flavors'),
+            (1000020.0, 'spam', 'GET', '/spam/flavors'),
+            (1000040.0, 'spam', 'GET', '/spam/flavors'),
+        ])
 
-    def test_route_v2_base(self):
-        route_args = {}
-        result = self.lim.route('/v2', route_args)
+        self.assertEqual(result['rejected'], 1)
+        self.assertEqual(result['limits'][3]['rejected'], 1)
 
-        self.assertEqual(result, '/v2')
+    def test_grow(self):
+        sim = nova_limits._Simulator(self.make_limits(), vectorize=False)
+        sim.run([(1000000.0, 'tenant%d' % i, 'POST', '/tenant%d/servers' % i)
+                 for i in range(5)])
 
-    def test_filter_noclass(self):
-        environ = {
-            'turnstile.nova.tenant': 'tenant',
-        }
-        params = {}
-        unused = {}
-        with self.assertRaises(limits.DeferLimit):
-            self.lim.filter(environ, params, unused)
+        self.assertEqual(len(sim.buckets), 5)
+        self.assertEqual(len(sim.last), 5)
+        self.assertEqual(list(sim.level), [30.0] * 5)
 
-        self.assertEqual(environ, {
-            'turnstile.nova.tenant': 'tenant',
-        })
-        self.assertEqual(params, {})
-        self.assertEqual(unused, {})
+    def test_apply(self):
+        sim = nova_limits._Simulator([], vectorize=False)
+        sim.buckets = dict(a=0, b=1)
+        sim._grow()
+        sim.last[1] = 10.0
+        sim.level[1] = 5.0
 
-    def test_filter_notenant(self):
-        environ = {
-            'turnstile.nova.limitclass': 'lim_class',
-        }
-        params = {}
-        unused = {}
-        with self.assertRaises(limits.DeferLimit):
-            self.lim.filter(environ, params, unused)
+        result = sim._apply([0, 0, 1, 1], [1.0, 1.5, 9.0, 12.0],
+                            [2.0, 2.0, 4.0, 1.0], [3.0, 3.0, 8.0, 8.0],
+                            [0.1, 0.1, 0.1, 0.1])
 
-        self.assertEqual(environ, {
-            'turnstile.nova.limitclass': 'lim_class',
-        })
-        self.assertEqual(params, {})
-        self.assertEqual(unused, {})
+        self.assertEqual(result, [False, True, True, False])
+        self.assertEqual(list(sim.last), [1.5, 12.0])
+        self.assertEqual(list(sim.level), [1.5, 4.0])
 
-    def test_filter_wrong_class(self):
-        environ = {
-            'turnstile.nova.limitclass': 'spam',
-            'turnstile.nova.tenant': 'tenant',
-        }
-        params = {}
-        unused = {}
-        with self.assertRaises(limits.DeferLimit):
-            self.lim.filter(environ, params, unused)
+    @unittest2.skipIf(nova_limits._Simulator([]).numpy is None,
+                      "numpy is not available")
+    def test_apply_vector(self):
+        events = []
+        for i in range(2000):
+            tenant = 'tenant%d' % (i % 7)
+            verb, uri = [('POST', 'servers'), ('GET', 'flavors'),
+                         ('GET', 'images')][i % 3]
+            events.append((1000000.0 + i * 0.5, tenant, verb,
+                           '/%s/%s' % (tenant, uri)))
+        classes = dict(tenant1='gold', tenant2='gold')
 
-        self.assertEqual(environ, {
-            'turnstile.nova.limitclass': 'spam',
-            'turnstile.nova.tenant': 'tenant',
-        })
-        self.assertEqual(params, {})
-        self.assertEqual(unused, {})
+        expected = self.run_simulation(events, classes=classes)
+        result = self.run_simulation(events, classes=classes,
+                                     vectorize=True)
 
-    def test_filter(self):
-        environ = {
-            'turnstile.nova.limitclass': 'lim_class',
-            'turnstile.nova.tenant': 'tenant',
-        }
-        params = {}
-        unused = {}
-        self.lim.filter(environ, params, unused)
+        self.assertGreater(expected['rejected'], 0)
+        self.assertEqual(result, expected)
 
-        self.assertEqual(environ, {
-            'turnstile.nova.limitclass': 'lim_class',
-            'turnstile.nova.tenant': 'tenant',
-        })
-        self.assertEqual(params, dict(tenant='tenant'))
-        self.assertEqual(unused, {})
+    def _updates(self, hot, every):
+        # 200 buckets with 5 updates each, interleaved with updates to
+        # the hot buckets
+        buckets = []
+        for i in range(1000):
+            buckets.append(i % 200)
+            if i % every == 0:
+                buckets.extend(hot)
+        count = len(buckets)
+        return (buckets, [1000.0 + i * 0.01 for i in range(count)],
+                [(i % 3) + 1.0 for i in range(count)], [8.0] * count,
+                [0.1] * count)
 
+    def _compare_apply(self, updates):
+        sims = []
+        for vectorize in (False, True):
+            sim = nova_limits._Simulator([], vectorize=vectorize)
+            sim.buckets = range(200)
+            sim._grow()
+            sim.last[1] = 1005.0
+            sim.level[1] = 3.0
+            sims.append(sim)
+        expected = sims[0]._apply(*updates)
 
-class TestNovaFormatter(unittest2.TestCase):
-    @mock.patch.object(wsgi, 'OverLimitFault',
-                       return_value=mock.Mock(return_value='rate-limited'))
-    @mock.patch('time.time', return_value=1000000.0)
-    def test_formatter(self, mock_time, mock_OverLimitFault):
-        fault = mock_OverLimitFault.return_value
-        lim = mock.Mock(value=23, uri='/spam', unit='second')
-        environ = dict(REQUEST_METHOD='SPAM')
+        result = sims[1]._apply_vector(*updates)
 
-        result = nova_limits.nova_formatter('status', 18, lim, 'bucket',
-                                            environ, 'start_response')
+        self.assertIn(True, expected)
+        self.assertEqual(result, expected)
+        self.assertEqual(list(sims[1].last), list(sims[0].last))
+        self.assertEqual(list(sims[1].level), list(sims[0].level))
+        return sims[1]
 
-        self.assertEqual(result, 'rate-limited')
-        mock_OverLimitFault.assert_called_once_with(
-            "This request was rate-limited.",
-            "Only 23 SPAM request(s) can be made to /spam every SECOND.",
-            1000018.0)
-        fault.assert_called_once_with(environ, 'start_response')
+    @unittest2.skipIf(nova_limits._Simulator([]).numpy is None,
+                      "numpy is not available")
+    def test_apply_vector_hot_bucket(self):
+        updates = self._updates([7], 5)
 
+        with mock.patch.object(nova_limits._Simulator, '_apply_copy',
+                               autospec=True,
+                               side_effect=nova_limits._Simulator.
+                               _apply_copy) as mock_apply_copy:
+            self._compare_apply(updates)
 
-class TestReportLimitClass(unittest2.TestCase):
-    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
-    def test_configured(self):
-        args = mock.Mock(tenant_id='tenant', klass=None)
+        # The updates beyond the fifth to the hot bucket are applied
+        # one at a time
+        self.assertEqual(mock_apply_copy.call_count, 1)
+        self.assertEqual(list(mock_apply_copy.call_args[0][1]), [7] * 200)
 
-        result = nova_limits._report_limit_class(args, 'old_class')
+    @unittest2.skipIf(nova_limits._Simulator([]).numpy is None,
+                      "numpy is not available")
+    def test_apply_vector_hot_buckets(self):
+        updates = self._updates([7, 8, 9], 1)
 
-        self.assertEqual(result, None)
-        self.assertEqual(sys.stdout.getvalue(),
-                         "Tenant tenant:\n"
-                         "  Configured rate-limit class: old_class\n")
+        with mock.patch.object(nova_limits._Simulator, '_apply_copy',
+                               autospec=True,
+                               side_effect=nova_limits._Simulator.
+                               _apply_copy) as mock_apply_copy:
+            self._compare_apply(updates)
 
-    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
-    def test_updated(self):
-        args = mock.Mock(tenant_id='tenant', klass='new_class')
+        # Too few of the updates would be applied as array operations
+        self.assertEqual(mock_apply_copy.call_count, 1)
+        self.assertEqual(list(mock_apply_copy.call_args[0][1]),
+                         updates[0])
 
-        result = nova_limits._report_limit_class(args, 'old_class')
+
+class TestLoadClasses(unittest2.TestCase):
+    def test_load(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fname = os.path.join(tmpdir, 'classes')
+        with open(fname, 'w') as f:
+            f.write('# tenant class\nspam gold\n\neggs  silver\nbad\n')
+
+        result = nova_limits._load_classes(fname)
+
+        self.assertEqual(result, dict(spam='gold', eggs='silver'))
+
+
+class TestReadEvents(unittest2.TestCase):
+    def test_read(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fname = os.path.join(tmpdir, 'requests.log')
+        with open(fname, 'w') as f:
+            f.write('# time tenant verb path\n'
+                    '1000000.0 spam post /spam/servers\n'
+                    '\n'
+                    'bad line\n'
+                    '1000001.5 eggs GET /eggs/flavors\n'
+                    '1000002 spam GET /spam/images\n')
+        sim = mock.Mock(skipped=0)
+
+        result = list(nova_limits._read_events(sim, [fname], 2))
+
+        self.assertEqual(result, [
+            [(1000000.0, 'spam', 'POST', '/spam/servers'),
+             (1000001.5, 'eggs', 'GET', '/eggs/flavors')],
+            [(1000002.0, 'spam', 'GET', '/spam/images')],
+        ])
+        self.assertEqual(sim.skipped, 1)
+
+
+class TestReportSimulation(unittest2.TestCase):
+    @mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_error(self, mock_stdout):
+        result = nova_limits._report_simulation(None, 'error')
+
+        self.assertEqual(result, 'error')
+        self.assertEqual(mock_stdout.getvalue(), '')
+
+    @mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_report(self, mock_stdout):
+        result = nova_limits._report_simulation(None, dict(
+            requests=10,
+            rejected=2,
+            skipped=1,
+            buckets=3,
+            classes=dict(default=dict(requests=10, rejected=2)),
+            tenants=[dict(tenant='spam', klass='default', requests=4,
+                          rejected=2)],
+            limits=[dict(uri='/servers', verbs=['POST'],
+                         rate_class='default', value=2, unit='minute',
+                         requests=4, rejected=2),
+                    dict(uri='/images', verbs=[], rate_class=None,
+                         value=100, unit='second', requests=0,
+                         rejected=0)],
+        ))
 
         self.assertEqual(result, None)
-        self.assertEqual(sys.stdout.getvalue(),
-                         "Tenant tenant:\n"
-                         "  Previous rate-limit class: old_class\n"
-                         "  New rate-limit class: new_class\n")
+        output = mock_stdout.getvalue()
+        self.assertIn('Replayed 10 request(s), 2 rejected (20.00%), using '
+                      '3 bucket(s)', output)
+        self.assertIn('Skipped 1 malformed line(s)', output)
+        self.assertIn('POST /servers', output)
+        self.assertIn('* /images', output)
+        self.assertIn('50.00%', output)
 
 
-class TestLimitClass(unittest2.TestCase):
+class TestLimitClassSimulate(unittest2.TestCase):
     def test_has_arguments(self):
-        self.assertIsInstance(nova_limits.limit_class, tools.ScriptAdaptor)
-        self.assertGreater(len(nova_limits.limit_class._arguments), 0)
+        self.assertIsInstance(nova_limits.limit_class_simulate,
+                              tools.ScriptAdaptor)
+        self.assertGreater(len(nova_limits.limit_class_simulate._arguments),
+                           0)
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
-        'get_database.return_value': mock.Mock(**{
-            'get.return_value': 'old_class',
-        }),
-    }))
-    def test_get(self, mock_Config):
-        db = mock_Config.return_value.get_database.return_value
+    @mock.patch.object(nova_limits, '_load_limits', return_value=['lim'])
+    @mock.patch.object(nova_limits, '_load_classes',
+                       return_value=dict(spam='gold'))
+    @mock.patch.object(nova_limits, '_Simulator')
+    @mock.patch.object(nova_limits, '_read_events',
+                       return_value=[['batch1'], ['batch2']])
+    def test_simulate(self, mock_read_events, mock_Simulator,
+                      mock_load_classes, mock_load_limits):
+        sim = mock_Simulator.return_value
 
-        result = nova_limits.limit_class('config_file', 'spam')
+        result = nova_limits.limit_class_simulate(
+            'limits.xml', ['a.log', 'b.log'], 'classes', 'gold:default',
+            1000, 5)
 
-        self.assertEqual(result, 'old_class')
-        mock_Config.assert_called_once_with(conf_file='config_file')
-        db.get.assert_called_once_with('limit-class:spam')
-        self.assertFalse(db.set.called)
-        self.assertFalse(db.delete.called)
+        self.assertEqual(result, sim.results.return_value)
+        mock_load_limits.assert_called_once_with('limits.xml')
+        mock_load_classes.assert_called_once_with('classes')
+        mock_Simulator.assert_called_once_with(['lim'], dict(spam='gold'),
+                                               'gold:default')
+        mock_read_events.assert_called_once_with(sim, ['a.log', 'b.log'],
+                                                 1000)
+        sim.run.assert_has_calls([mock.call(['batch1']),
+                                  mock.call(['batch2'])])
+        sim.results.assert_called_once_with(5)
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
-        'get_database.return_value': mock.Mock(**{
-            'get.return_value': None,
-        }),
-    }))
-    def test_get_unset(self, mock_Config):
-        db = mock_Config.return_value.get_database.return_value
+    @mock.patch.object(nova_limits, '_load_limits', return_value=[])
+    @mock.patch.object(nova_limits, '_load_classes')
+    @mock.patch.object(nova_limits, '_Simulator')
+    @mock.patch.object(nova_limits, '_read_events', return_value=[])
+    def test_no_classes(self, mock_read_events, mock_Simulator,
+                        mock_load_classes, mock_load_limits):
+        nova_limits.limit_class_simulate('limits.xml', ['-'])
 
-        result = nova_limits.limit_class('config_file', 'spam')
+        self.assertFalse(mock_load_classes.called)
+        mock_Simulator.assert_called_once_with([], {}, '')
 
-        self.assertEqual(result, 'default')
-        mock_Config.assert_called_once_with(conf_file='config_file')
-        db.get.assert_called_once_with('limit-class:spam')
-        self.assertFalse(db.set.called)
-        self.assertFalse(db.delete.called)
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
-        'get_database.return_value': mock.Mock(**{
-            'get.return_value': 'old_class',
-        }),
-    }))
-    def test_set(self, mock_Config):
-        db = mock_Config.return_value.get_database.return_value
+class TestReportProfile(unittest2.TestCase):
+    @mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_error(self, mock_stdout):
+        result = nova_limits._report_profile(None, 'error')
 
-        result = nova_limits.limit_class('config_file', 'spam', 'new_class')
+        self.assertEqual(result, 'error')
+        self.assertEqual(mock_stdout.getvalue(), '')
 
-        self.assertEqual(result, 'old_class')
-        mock_Config.assert_called_once_with(conf_file='config_file')
-        db.get.assert_called_once_with('limit-class:spam')
-        db.set.assert_called_once_with('limit-class:spam', 'new_class')
-        self.assertFalse(db.delete.called)
+    @mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_no_files(self, mock_stdout):
+        result = nova_limits._report_profile(None, dict(files=0, stats=None))
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
-        'get_database.return_value': mock.Mock(**{
-            'get.return_value': None,
-        }),
-    }))
-    def test_set_unset(self, mock_Config):
-        db = mock_Config.return_value.get_database.return_value
+        self.assertEqual(result, None)
+        self.assertEqual(mock_stdout.getvalue(), "No request profiles found\n")
 
-        result = nova_limits.limit_class('config_file', 'spam', 'new_class')
+    @mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_report(self, mock_stdout):
+        args = mock.Mock(output='merged.prof', sort='time', top=5)
+        stats = mock.Mock()
 
-        self.assertEqual(result, 'default')
-        mock_Config.assert_called_once_with(conf_file='config_file')
-        db.get.assert_called_once_with('limit-class:spam')
-        db.set.assert_called_once_with('limit-class:spam', 'new_class')
-        self.assertFalse(db.delete.called)
+        result = nova_limits._report_profile(args, dict(files=2,
+                                                        stats=stats))
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
-        'get_database.return_value': mock.Mock(**{
-            'get.return_value': 'old_class',
-        }),
-    }))
-    def test_delete(self, mock_Config):
-        db = mock_Config.return_value.get_database.return_value
+        self.assertEqual(result, None)
+        self.assertEqual(mock_stdout.getvalue(),
+                         "Merged 2 profile(s)\n"
+                         "Wrote the merged profile to merged.prof\n\n")
+        stats.sort_stats.assert_called_once_with('time')
+        stats.sort_stats.return_value.print_stats.assert_called_once_with(5)
 
-        result = nova_limits.limit_class('config_file', 'spam', 'default')
 
-        self.assertEqual(result, 'old_class')
-        mock_Config.assert_called_once_with(conf_file='config_file')
-        db.get.assert_called_once_with('limit-class:spam')
-        self.assertFalse(db.set.called)
-        db.delete.assert_called_once_with('limit-class:spam')
+class TestLimitClassProfile(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
 
-    @mock.patch.object(config, 'Config', return_value=mock.Mock(**{
-        'get_database.return_value': mock.Mock(**{
-            'get.return_value': None,
-        }),
-    }))
-    def test_delete_unset(self, mock_Config):
-        db = mock_Config.return_value.get_database.return_value
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
 
-        result = nova_limits.limit_class('config_file', 'spam', 'default')
+    @mock.patch('os.getpid')
+    def _dump(self, pid, count, mock_getpid):
+        mock_getpid.return_value = pid
+        profiler = nova_limits.Profiler(dump=self.tmpdir)
+        for _i in range(count):
+            prof = profiler.start()
+            sorted(range(10))
+            profiler.stop(prof, 1000000.0)
 
-        self.assertEqual(result, 'default')
-        mock_Config.assert_called_once_with(conf_file='config_file')
-        db.get.assert_called_once_with('limit-class:spam')
-        self.assertFalse(db.set.called)
-        self.assertFalse(db.delete.called)
+        profiler.dump(1000000.0)
+
+    def _calls(self, stats, name):
+        for func, stat in stats.stats.items():
+            if func[2] == name:
+                return stat[1]
+
+    def test_has_arguments(self):
+        self.assertIsInstance(nova_limits.limit_class_profile,
+                              tools.ScriptAdaptor)
+        self.assertGreater(len(nova_limits.limit_class_profile._arguments), 0)
+
+    def test_merge(self):
+        self._dump(1, 2)
+        self._dump(2, 3)
+        output = os.path.join(self.tmpdir, 'merged.out')
+
+        result = nova_limits.limit_class_profile([self.tmpdir], output)
+
+        self.assertEqual(result['files'], 2)
+        self.assertEqual(self._calls(result['stats'], '<sorted>'), 5)
+        merged = nova_limits.limit_class_profile([output])
+        self.assertEqual(merged['files'], 1)
+        self.assertEqual(self._calls(merged['stats'], '<sorted>'), 5)
+
+    def test_no_files(self):
+        result = nova_limits.limit_class_profile([self.tmpdir])
+
+        self.assertEqual(result, dict(files=0, stats=None))